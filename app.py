@@ -1,6 +1,18 @@
-from flask import Flask
+import atexit
 
+from flask import Flask, abort, request
 
+import new
+
+# Webhook mode is opt-in: with GIVEAWAY_MODE=webhook this app runs the bot
+# (instead of `python new.py`). Run it with a single worker so there is one
+# bot instance, e.g.
+#   GIVEAWAY_MODE=webhook GIVEAWAY_WEBHOOK_SECRET=... GIVEAWAY_WEBHOOK_URL=https://example.com/telegram \
+#   gunicorn -w 1 --threads 8 -b 0.0.0.0:8080 app:app
+# Without GIVEAWAY_WEBHOOK_URL no webhook is registered, so recorded updates can
+# be replayed locally:
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $GIVEAWAY_WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json localhost:8080/telegram
 
 app = Flask(__name__)
 
@@ -14,6 +26,45 @@ def hello():
 
 
 
+if new.RUN_MODE == 'webhook':
+
+    bot = new.WebhookRunner()
+    bot.start()
+    atexit.register(bot.stop)
+
+
+    @app.route('/metrics')
+
+    def metrics():
+
+        return new.metrics.render(), 200, {'Content-Type': new.METRICS_CONTENT_TYPE}
+
+
+    @app.route('/healthz')
+
+    def healthz():
+
+        ok, detail = new.health_status(bot.app)
+        return detail, 200 if ok else 503
+
+
+    @app.route(new.WEBHOOK_PATH, methods=['POST'])
+
+    def telegram_webhook():
+
+        if not bot.check_secret(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+            abort(403)
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            abort(400)
+        try:
+            bot.submit(payload)
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        return ''
+
+
+
 if __name__ == '__main__':
 
     # Run the Flask app on port 80
@@ -0,0 +1,345 @@
+"""Redemption throughput benchmark against a stubbed Bot API.
+
+Drives the handlers registered by new.build_application() (the /redeem
+command, codes sent as plain text, /leaderboard, /stats and /listcodes)
+with synthetic updates. Bot API calls are answered in-process. Each pool
+size runs in its own subprocess so peak RSS is measured per scenario.
+redemptions_per_sec counts codes actually won; updates turned away by the
+redemption queue or the flood guard are counted as shed and flood_dropped.
+
+    python benchmark.py                               # 1k..1M codes and users, JSON store
+    python benchmark.py --backend sqlite --sizes 1000,100000
+    python benchmark.py --codes 1000000 --users 1000,1000000 --redemptions 50000
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import new
+
+# ---------------------------
+# Stub Bot API
+# ---------------------------
+
+BOT_ID = 1
+USER_ID_BASE = 10_000_000
+
+
+class StubRequest(BaseRequest):
+    """Answers Bot API calls in-process with minimal valid responses."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif api_method == "getChatMember":
+            result = {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "u"}}
+        elif api_method in ("sendMessage", "editMessageText", "sendDocument", "forwardMessage"):
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 1)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# ---------------------------
+# Synthetic data
+# ---------------------------
+
+_update_ids = itertools.count(1)
+
+
+def bench_code(i: int) -> str:
+    return f"BENCH-{i // 100_000_000 % 10000:04d}-{i // 10000 % 10000:04d}-{i % 10000:04d}"
+
+
+def make_update(bot, user_id: int, text: str) -> Update:
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "U", "username": f"u{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": next(_update_ids), "message": message}, bot)
+
+
+def write_pool(backend: str, codes: int, users: int) -> None:
+    """Write a store with `codes` unredeemed codes and `users` known users to the cwd."""
+    data = new.default_data()
+    created_at = new.initialize_code_details()["created_at"]
+    data["codes"] = {bench_code(i): new.initialize_code_details(created_at) for i in range(codes)}
+    data["users"] = [USER_ID_BASE + i for i in range(users)]
+    if backend == "sqlite":
+        store = new.SqliteStore(new.SQLITE_FILE)
+        store.load()
+        store.import_data(data)
+        store.conn.close()
+    else:
+        new.save_data(data)
+
+
+# ---------------------------
+# Scenario
+# ---------------------------
+
+
+# Futures of the redemption jobs queued by the update being driven (see drive()).
+queued_jobs: ContextVar[Optional[List[asyncio.Future]]] = ContextVar("queued_jobs", default=None)
+
+
+def track_redemption_queue(queue: new.RedemptionQueue) -> None:
+    """Make each queued job resolve a future drive() waits for, so latencies cover the redemption itself."""
+    submit = queue.submit
+
+    def tracked_submit(user_id, job):
+        jobs = queued_jobs.get()
+        if jobs is None:
+            return submit(user_id, job)
+        done = asyncio.get_running_loop().create_future()
+
+        async def run() -> None:
+            try:
+                await job()
+            finally:
+                done.set_result(None)
+
+        rejected = submit(user_id, run)
+        if rejected is None:
+            jobs.append(done)
+        return rejected
+
+    queue.submit = tracked_submit
+
+
+def counter_by_reason(name: str) -> Counter:
+    """Current values of the metrics counter `name`, by its reason label."""
+    totals: Counter = Counter()
+    for line in new.metrics.render().splitlines():
+        if line.startswith(name + "{"):
+            totals[re.search(r'reason="(\w+)"', line).group(1)] += float(line.rsplit(" ", 1)[1])
+    return totals
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def drive(app, updates: List[Update], concurrency: int) -> Dict:
+    """Process updates with at most `concurrency` in flight; returns throughput and latencies.
+
+    An update counts as done once the redemptions it queued are done too.
+    """
+    latencies: List[float] = []
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(update: Update) -> None:
+        async with gate:
+            start = time.perf_counter()
+            jobs: List[asyncio.Future] = []
+            queued_jobs.set(jobs)
+            await app.process_update(update)
+            await asyncio.gather(*jobs)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in updates))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "count": len(updates),
+        "seconds": elapsed,
+        "per_sec": round(len(updates) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+async def run_scenario(args) -> Dict:
+    """Load the pool written by --prepare in the cwd, then time each handler."""
+    setup_start = time.perf_counter()
+    new.STORAGE_BACKEND = args.backend
+    new.BOT_TOKEN = "1:bench"
+    request = StubRequest(args.api_latency)
+    app = new.build_application(request)
+    await app.initialize()
+    await app.start()
+    # Nothing is scheduled here, and a code-scheduler tick cut off by the
+    # shutdown only logs a CancelledError, so the JobQueue is not needed.
+    await app.job_queue.stop()
+    await new.on_startup(app)
+    track_redemption_queue(app.bot_data["redemption_queue"])
+    setup_s = time.perf_counter() - setup_start
+
+    bot = app.bot
+    redemptions = min(args.redemptions, args.codes)
+    # Users are drawn with replacement, so some try to win twice; codes are
+    # drawn with replacement too, so some are already taken.
+    rng = random.Random(42)
+    updates = []
+    for n in range(redemptions):
+        user_id = USER_ID_BASE + rng.randrange(args.users)
+        code = bench_code(rng.randrange(args.codes))
+        # Alternate between /redeem and sending the bare code.
+        updates.append(make_update(bot, user_id, f"/redeem {code}" if n % 2 else code))
+    result = {"backend": args.backend, "codes": args.codes, "users": args.users, "setup_s": round(setup_s, 2)}
+    store = new.get_store_from_app(app)
+    redeemed_before = store.stats()["redeemed"]
+    shed_before = counter_by_reason("giveaway_redemptions_shed_total")
+    dropped_before = counter_by_reason("giveaway_spam_rejected_total")
+    redeem = await drive(app, updates, args.concurrency)
+    # Only codes actually won count as redemptions; the other updates were
+    # turned away (shed, flood-dropped) or answered "already redeemed/won".
+    redeemed = store.stats()["redeemed"] - redeemed_before
+    result["redemptions_per_sec"] = round(redeemed / redeem["seconds"], 1) if redeem["seconds"] else 0.0
+    result["updates_per_sec"] = redeem["per_sec"]
+    result["redeem_p50_ms"] = redeem["p50_ms"]
+    result["redeem_p99_ms"] = redeem["p99_ms"]
+    result["shed"] = int(sum((counter_by_reason("giveaway_redemptions_shed_total") - shed_before).values()))
+    result["flood_dropped"] = int(sum((counter_by_reason("giveaway_spam_rejected_total") - dropped_before).values()))
+
+    admin = new.ADMIN_IDS[0]
+    for name, text in (("leaderboard", "/leaderboard"), ("stats", "/stats"), ("listcodes", "/listcodes BENCH")):
+        timing = await drive(app, [make_update(bot, admin, text) for _ in range(args.admin_calls)], args.concurrency)
+        result[f"{name}_p50_ms"] = timing["p50_ms"]
+        result[f"{name}_p99_ms"] = timing["p99_ms"]
+
+    # Every code has at most one winner and no user won twice.
+    winners = [store.get_code(bench_code(i))["redeemed_by"] for i in range(args.codes)]
+    winners = [w for w in winners if w]
+    result["redeemed"] = len(winners)
+    result["double_awards"] = len(winners) - len(set(winners))
+
+    await app.stop()
+    await new.on_shutdown(app)
+    await app.shutdown()
+    # ru_maxrss is in KiB on Linux.
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    result["api_calls"] = request.calls
+    return result
+
+
+# ---------------------------
+# Driver
+# ---------------------------
+
+COLUMNS = [
+    "backend", "codes", "users", "prepare_s", "setup_s", "redemptions_per_sec", "updates_per_sec", "redeemed", "shed",
+    "flood_dropped", "redeem_p50_ms", "redeem_p99_ms", "leaderboard_p99_ms", "stats_p99_ms", "listcodes_p99_ms", "peak_rss_mb", "double_awards",
+]
+
+
+def parse_sizes(text: str) -> List[int]:
+    return [int(float(part)) for part in text.split(",") if part]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="code pool and user counts, run pairwise")
+    parser.add_argument("--codes", help="code pool sizes; combined with --users as a grid")
+    parser.add_argument("--users", help="user counts; combined with --codes as a grid")
+    parser.add_argument("--redemptions", type=int, default=20000, help="redemption updates per scenario")
+    parser.add_argument("--admin-calls", type=int, default=50, help="calls of each admin command per scenario")
+    parser.add_argument("--concurrency", type=int, default=new.CONCURRENT_UPDATES, help="updates in flight")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds added to every Bot API call")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per scenario")
+    parser.add_argument("--prepare", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--scenario", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.prepare or args.scenario:
+        # Child processes, run in the scratch directory: write the pool, or
+        # run one scenario against it and print the result.
+        args.codes, args.users = int(args.codes), int(args.users)
+        logging.getLogger().setLevel(logging.WARNING)
+        if args.prepare:
+            write_pool(args.backend, args.codes, args.users)
+        else:
+            print(json.dumps(asyncio.run(run_scenario(args))))
+        return
+
+    if args.codes or args.users:
+        pairs = list(itertools.product(parse_sizes(args.codes or args.sizes), parse_sizes(args.users or args.sizes)))
+    else:
+        pairs = [(n, n) for n in parse_sizes(args.sizes)]
+
+    if not args.json:
+        print(" ".join(f"{c:>{max(10, len(c))}}" for c in COLUMNS))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    for codes, users in pairs:
+        child_args = [
+            sys.executable, os.path.abspath(__file__), "--backend", args.backend,
+            "--codes", str(codes), "--users", str(users), "--redemptions", str(args.redemptions),
+            "--admin-calls", str(args.admin_calls), "--concurrency", str(args.concurrency),
+            "--api-latency", str(args.api_latency),
+        ]
+        workdir = tempfile.mkdtemp(prefix="giveaway-bench-")
+        try:
+            prep_start = time.perf_counter()
+            subprocess.run(child_args + ["--prepare"], cwd=workdir, env=env, check=True)
+            prep_s = time.perf_counter() - prep_start
+            proc = subprocess.run(child_args + ["--scenario"], cwd=workdir, env=env, stdout=subprocess.PIPE, text=True)
+        except subprocess.CalledProcessError as e:
+            print(f"preparing codes={codes} users={users} failed (exit {e.returncode})", file=sys.stderr)
+            continue
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if proc.returncode != 0:
+            print(f"scenario codes={codes} users={users} failed (exit {proc.returncode})", file=sys.stderr)
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result["prepare_s"] = round(prep_s, 2)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(" ".join(f"{result.get(c, ''):>{max(10, len(c))}}" for c in COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""Local stand-in for the Telegram Bot API, for end-to-end load testing.
+
+Speaks enough of the HTTP API for python-telegram-bot to run the real bot
+against it: getMe, getUpdates (long polling), sendMessage, forwardMessage,
+getChatMember, sendDocument and editMessageText. Any other method returns
+True. Responses can be delayed, and a fraction of calls can fail with 429
+(retry_after) or 500, to see how the bot behaves under pressure.
+
+Updates to deliver are queued with FakeBotApi.push_update() (see
+loadtest.py) or, when run standalone, by POSTing Update JSON to /_inject:
+
+    python fake_bot_api.py --port 8081 --latency 0.02 --rate-limit 0.01
+    GIVEAWAY_BOT_API_URL=http://127.0.0.1:8081 python new.py
+"""
+
+import argparse
+import asyncio
+import email.parser
+import email.policy
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter, deque
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger("fake_bot_api")
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Giveaway", "username": "giveaway_test_bot"}
+
+# Bookkeeping calls that are never delayed or failed on purpose.
+FAULT_EXEMPT = {"getMe", "getUpdates", "deleteWebhook", "setWebhook", "close", "logOut"}
+
+
+class FakeBotApi:
+    """In-memory Bot API with configurable latency and fault injection."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: float = 0.0,
+                 retry_after: int = 1, error_rate: float = 0.0, member_status: str = "member"):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.member_status = member_status
+        # Called with (method, params) for every message the bot sends.
+        self.on_send: Optional[Callable[[str, Dict], None]] = None
+        self.calls: Counter = Counter()
+        self.faults: Counter = Counter()
+        self.polling = asyncio.Event()
+        self._updates: deque = deque()
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    # --- updates ---
+
+    def push_update(self, update: Dict) -> int:
+        """Queue an Update (without update_id) for the next getUpdates. Returns its update_id."""
+        update = {**update, "update_id": next(self._update_ids)}
+        self._updates.append(update)
+        self._new_updates.set()
+        return update["update_id"]
+
+    def message_update(self, user_id: int, text: str) -> Dict:
+        """Build a private-chat text message Update from `user_id`."""
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    async def _get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        # Updates below the offset have been confirmed by the bot.
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        self.polling.set()
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    # --- methods ---
+
+    def _message(self, chat_id, **fields) -> Dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    async def call(self, method: str, params: Dict) -> Tuple[int, Dict]:
+        """Answer one Bot API call. Returns (HTTP status, JSON body)."""
+        self.calls[method] += 1
+        if method not in FAULT_EXEMPT:
+            if self.latency or self.jitter:
+                await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+            roll = random.random()
+            if roll < self.rate_limit:
+                self.faults["429"] += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            if roll < self.rate_limit + self.error_rate:
+                self.faults["500"] += 1
+                return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "getMe":
+            result = {**BOT_USER, "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method == "getChatMember":
+            result = {"status": self.member_status,
+                      "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "User"}}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(params.get("chat_id", 0), text=params.get("text", ""))
+        elif method == "forwardMessage":
+            result = self._message(params["chat_id"], text="(forwarded)")
+        elif method == "sendDocument":
+            result = self._message(params["chat_id"], document={
+                "file_id": f"doc{next(self._message_ids)}", "file_unique_id": "doc", "file_name": "file.txt",
+            })
+        else:
+            result = True
+        if method in ("sendMessage", "forwardMessage", "sendDocument") and self.on_send is not None:
+            self.on_send(method, params)
+        return 200, {"ok": True, "result": result}
+
+    # --- HTTP ---
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Start listening; returns the bound port."""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        """Stop listening and let open connections, including long polls, finish."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        self._new_updates.set()
+        for writer in self._connections.values():
+            writer.close()
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=5)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # HTTP/1.1 with keep-alive, which is what httpx's connection pool expects.
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                status, payload = await self._route(target, headers, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            del self._connections[asyncio.current_task()]
+            writer.close()
+
+    async def _route(self, target: str, headers: Dict[str, str], body: bytes) -> Tuple[int, Dict]:
+        path = target.split("?", 1)[0]
+        if path == "/_inject":
+            updates = json.loads(body or b"[]")
+            ids = [self.push_update(u) for u in (updates if isinstance(updates, list) else [updates])]
+            return 200, {"ok": True, "result": ids}
+        if path == "/_stats":
+            return 200, {"ok": True, "result": {"calls": self.calls, "faults": self.faults}}
+        parts = path.strip("/").split("/")
+        # /bot<token>/<method>
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        return await self.call(parts[1], parse_params(headers.get("content-type", ""), body))
+
+
+def parse_params(content_type: str, body: bytes) -> Dict:
+    """Decode Bot API parameters from a form, multipart or JSON request body."""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                params[name] = f"<{len(part.get_payload(decode=True) or b'')} bytes>"
+            else:
+                params[name] = part.get_content().strip()
+        return params
+    return dict(parse_qsl(body.decode("utf-8")))
+
+
+async def serve_forever(args) -> None:
+    api = FakeBotApi(args.latency, args.jitter, args.rate_limit, args.retry_after, args.error_rate, args.member_status)
+    port = await api.start(args.host, args.port)
+    logger.info("Fake Bot API on http://%s:%d (POST Update JSON to /_inject)", args.host, port)
+    while True:
+        await asyncio.sleep(10)
+        logger.info("calls %s faults %s", dict(api.calls), dict(api.faults))
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds on top of --latency")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after sent with 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 500")
+    parser.add_argument("--member-status", default="member", help="status returned by getChatMember")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local fake Telegram Bot API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    try:
+        asyncio.run(serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""End-to-end load test: the real bot process against fake_bot_api.py.
+
+Starts the fake Bot API in this process, then runs `python new.py` as a
+subprocess pointed at it via GIVEAWAY_BOT_API_URL, in a scratch directory
+holding a store with a prepared code pool. Simulated users send /start and
+then a code, each waiting for the bot's reply. The latency measured is
+from the update being queued for getUpdates to the bot's sendMessage
+reaching the server, so it covers HTTP, polling, handlers and storage.
+A redeem step ends with the redemption's result, not the "you're in the
+queue" note before it. At the end the bot's /metrics are scraped to show
+where its handler time went, including waits for a free send slot.
+
+    python loadtest.py --users 5000 --concurrency 50
+    python loadtest.py --users 20000 --codes 500 --latency 0.05 --rate-limit 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+from benchmark import USER_ID_BASE, bench_code, percentile, write_pool
+from fake_bot_api import FakeBotApi, add_fault_arguments
+
+logger = logging.getLogger("loadtest")
+
+# Start of the note a queued redemption gets before its result.
+QUEUE_ACK_PREFIX = "⏳ You're in the queue"
+
+
+class LoadGenerator:
+    """Simulated users talking to the bot through a FakeBotApi."""
+
+    def __init__(self, api: FakeBotApi, reply_timeout: float):
+        self.api = api
+        self.reply_timeout = reply_timeout
+        self.latencies: Dict[str, List[float]] = {}
+        self.timeouts: Dict[str, int] = {}
+        self.queue_acks = 0
+        self._waiting: Dict[int, asyncio.Future] = {}
+        api.on_send = self._on_send
+
+    def _on_send(self, method: str, params: Dict) -> None:
+        try:
+            chat_id = int(params.get("chat_id", 0))
+        except ValueError:
+            return
+        if str(params.get("text", "")).startswith(QUEUE_ACK_PREFIX):
+            self.queue_acks += 1
+            return
+        waiter = self._waiting.pop(chat_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(time.perf_counter())
+
+    async def send(self, step: str, user_id: int, text: str) -> None:
+        """Send one message as `user_id` and wait for the first reply to their chat (queue notes aside)."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting[user_id] = waiter
+        start = time.perf_counter()
+        self.api.push_update(self.api.message_update(user_id, text))
+        try:
+            replied = await asyncio.wait_for(waiter, self.reply_timeout)
+        except asyncio.TimeoutError:
+            self._waiting.pop(user_id, None)
+            self.timeouts[step] = self.timeouts.get(step, 0) + 1
+            return
+        self.latencies.setdefault(step, []).append(replied - start)
+
+    async def user(self, n: int, codes: int) -> None:
+        user_id = USER_ID_BASE + n
+        await self.send("start", user_id, "/start")
+        await self.send("redeem", user_id, bench_code(n % codes))
+
+    async def run(self, users: int, codes: int, concurrency: int) -> float:
+        gate = asyncio.Semaphore(concurrency)
+
+        async def one(n: int) -> None:
+            async with gate:
+                await self.user(n, codes)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(n) for n in range(users)))
+        return time.perf_counter() - start
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def scrape_metrics(port: int) -> Optional[str]:
+    """GET the bot's /metrics, or None if it does not answer."""
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n")
+        response = await asyncio.wait_for(reader.read(), 10)
+        writer.close()
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning("Could not scrape the bot's metrics: %s", e)
+        return None
+    return response.partition(b"\r\n\r\n")[2].decode("utf-8")
+
+
+SAMPLE_RE = re.compile(r"^(\w+)(?:\{(.*)\})? (\S+)$")
+LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def bot_time_breakdown(text: str) -> Dict:
+    """Where the bot's time went: Bot API calls, the part spent waiting for a send slot, and handler time by part."""
+    api: Counter = Counter()
+    wait_sum: Counter = Counter()
+    wait_count: Counter = Counter()
+    handlers: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for line in text.splitlines():
+        match = SAMPLE_RE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.group(1), dict(LABEL_RE.findall(match.group(2) or "")), float(match.group(3))
+        if name.startswith("giveaway_bot_api_seconds_"):
+            api[name] += value
+        elif name == "giveaway_bot_api_wait_seconds_sum":
+            wait_sum[labels["priority"]] += value
+        elif name == "giveaway_bot_api_wait_seconds_count":
+            wait_count[labels["priority"]] += value
+        elif name == "giveaway_handler_time_seconds_total":
+            handlers[labels["handler"]][labels["part"]] = round(value, 2)
+    calls, seconds = api["giveaway_bot_api_seconds_count"], api["giveaway_bot_api_seconds_sum"]
+    return {
+        "api_calls": int(calls),
+        "api_call_mean_ms": round(seconds / calls * 1000, 2) if calls else None,
+        # Queueing inside the bot for a free connection of its send pools, by priority.
+        "send_slot_wait_mean_ms": {p: round(wait_sum[p] / n * 1000, 2) for p, n in wait_count.items() if n},
+        "send_slot_wait_share": round(sum(wait_sum.values()) / seconds, 3) if seconds else None,
+        "handler_seconds": dict(handlers),
+    }
+
+
+def start_bot(args, api_url: str, workdir: str, metrics_port: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        GIVEAWAY_BOT_API_URL=api_url,
+        GIVEAWAY_BOT_TOKEN="1:loadtest",
+        GIVEAWAY_STORAGE=args.backend,
+        GIVEAWAY_METRICS_PORT=str(metrics_port),
+        PYTHONPATH=os.path.dirname(os.path.abspath(__file__)),
+    )
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    return subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "new.py")],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+def stop_bot(bot: subprocess.Popen) -> None:
+    if bot.poll() is None:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+            bot.wait()
+
+
+async def run_load_test(args, workdir: str) -> Dict:
+    api = FakeBotApi(args.latency, args.jitter, args.rate_limit, args.retry_after, args.error_rate, args.member_status)
+    port = await api.start()
+    metrics_port = free_port()
+    bot = start_bot(args, f"http://127.0.0.1:{port}", workdir, metrics_port)
+    bot_metrics = None
+    try:
+        try:
+            await asyncio.wait_for(api.polling.wait(), args.startup_timeout)
+        except asyncio.TimeoutError:
+            raise SystemExit(f"bot did not start polling; see {os.path.join(workdir, 'bot.log')}")
+        generator = LoadGenerator(api, args.reply_timeout)
+        elapsed = await generator.run(args.users, args.codes, args.concurrency)
+        bot_metrics = await scrape_metrics(metrics_port)
+    finally:
+        await asyncio.to_thread(stop_bot, bot)
+        await api.close()
+
+    result = {
+        "backend": args.backend,
+        "users": args.users,
+        "codes": args.codes,
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 2),
+        "replies_per_sec": round(sum(len(v) for v in generator.latencies.values()) / elapsed, 1),
+        "timeouts": generator.timeouts,
+        "queue_acks": generator.queue_acks,
+        "api_calls": dict(api.calls),
+        "injected_faults": dict(api.faults),
+        "bot_exit_code": bot.returncode,
+        "bot": bot_time_breakdown(bot_metrics) if bot_metrics else None,
+    }
+    for step, values in generator.latencies.items():
+        values.sort()
+        result[f"{step}_p50_ms"] = round(percentile(values, 0.50) * 1000, 2)
+        result[f"{step}_p95_ms"] = round(percentile(values, 0.95) * 1000, 2)
+        result[f"{step}_p99_ms"] = round(percentile(values, 0.99) * 1000, 2)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end load test against a fake Bot API.")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--users", type=int, default=2000, help="simulated users, each sends /start and a code")
+    parser.add_argument("--codes", type=int, default=None, help="code pool size (default: one per user)")
+    # Past the bot's send pool (GIVEAWAY_SEND_POOL_SIZE, 64) replies mostly wait for a
+    # connection; that wait is reported under "bot" as send_slot_wait_mean_ms.
+    parser.add_argument("--concurrency", type=int, default=50, help="users active at once")
+    parser.add_argument("--reply-timeout", type=float, default=30.0, help="seconds to wait for each reply")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory (store, bot.log)")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+    args.codes = args.codes or args.users
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    workdir = tempfile.mkdtemp(prefix="giveaway-load-")
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        write_pool(args.backend, args.codes, args.users)
+        os.chdir(cwd)
+        print(json.dumps(asyncio.run(run_load_test(args, workdir)), indent=2))
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            logger.info("Scratch directory kept at %s", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,55 @@
 import asyncio
+import base64
+import bisect
+import cProfile
+import csv
+import gzip
+import heapq
+import hmac
+import io
+import itertools
 import json
 import logging
+import operator
 import os
 import random
 import re
+import secrets
 import signal
+import sqlite3
 import sys
-from functools import wraps
-from typing import Dict, List, Optional, Tuple
-from datetime import datetime, timezone
+import tempfile
+import threading
+import time
+import warnings
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from functools import partial, wraps
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from datetime import datetime, timedelta, timezone
 
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputFile,
     Message,
     Update,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.warnings import PTBUserWarning
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CallbackContext,
+    CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
@@ -39,10 +67,121 @@ ADMIN_IDS: List[int] = [
 ]
 
 DATA_FILE = "giveaway_data.json"
+# Append-only log of state changes since the last snapshot of DATA_FILE
+JOURNAL_FILE = DATA_FILE + ".journal"
+# Seconds to gather journal records into one fsync
+JOURNAL_BATCH_DELAY = float(os.getenv("GIVEAWAY_JOURNAL_BATCH_DELAY", "0.005"))
+# Journal records between background compactions into DATA_FILE
+COMPACT_EVERY = int(os.getenv("GIVEAWAY_COMPACT_EVERY", "10000"))
+# One file per campaign (the codes sharing a prefix) with its codes and winners
+CAMPAIGN_DIR = DATA_FILE + ".campaigns"
+# One file per scheduled drop or expiry of listed codes, holding those codes
+SCHEDULE_DIR = DATA_FILE + ".schedules"
+# The codes created by the last /gencode, kept for prize assignment
+LAST_GENERATED_FILE = DATA_FILE + ".last_generated"
+# "json" (snapshot + journal, all in memory) or "sqlite" (indexed tables on disk)
+STORAGE_BACKEND = os.getenv("GIVEAWAY_STORAGE", "json")
+SQLITE_FILE = os.getenv("GIVEAWAY_SQLITE_FILE", "giveaway_data.db")
+SQLITE_CACHE_MB = int(os.getenv("GIVEAWAY_SQLITE_CACHE_MB", "256"))
+# Updates processed in parallel (1 = sequential)
+CONCURRENT_UPDATES = int(os.getenv("GIVEAWAY_CONCURRENT_UPDATES", "256"))
+
+# Bot API server, e.g. http://127.0.0.1:8081 for fake_bot_api.py (empty = api.telegram.org)
+BOT_API_URL = os.getenv("GIVEAWAY_BOT_API_URL", "").rstrip("/")
+# Bot API connections: user replies and membership checks, broadcasts and admin
+# notifications, and long polling. Sends beyond a pool's size wait by priority.
+SEND_POOL_SIZE = int(os.getenv("GIVEAWAY_SEND_POOL_SIZE", "64"))
+BULK_POOL_SIZE = int(os.getenv("GIVEAWAY_BULK_POOL_SIZE", "16"))
+GET_UPDATES_POOL_SIZE = int(os.getenv("GIVEAWAY_GET_UPDATES_POOL_SIZE", "2"))
+
+# "polling" (python new.py) or "webhook" (app.py runs the bot behind its Flask app);
+# exactly one of them may run the bot against a data file
+RUN_MODE = os.getenv("GIVEAWAY_MODE", "polling")
+
+# Webhook mode (app.py): public URL Telegram posts to (empty = don't register one,
+# e.g. when testing locally), local route, shared secret and Telegram's connection limit
+WEBHOOK_URL = os.getenv("GIVEAWAY_WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("GIVEAWAY_WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("GIVEAWAY_WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("GIVEAWAY_WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Channel membership cache: entries kept, seconds to trust "member" / "not member"
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("GIVEAWAY_MEMBERSHIP_CACHE_SIZE", "100000"))
+MEMBER_TTL = float(os.getenv("GIVEAWAY_MEMBER_TTL", "600"))
+NON_MEMBER_TTL = float(os.getenv("GIVEAWAY_NON_MEMBER_TTL", "30"))
+
+# Spam limits (admins exempt): messages per user per window; failed code guesses per
+# window before a temporary ban, and its length; most users tracked at once
+RATE_LIMIT_MESSAGES = int(os.getenv("GIVEAWAY_RATE_LIMIT_MESSAGES", "20"))
+RATE_LIMIT_WINDOW = float(os.getenv("GIVEAWAY_RATE_LIMIT_WINDOW", "10"))
+GUESS_LIMIT = int(os.getenv("GIVEAWAY_GUESS_LIMIT", "5"))
+GUESS_WINDOW = float(os.getenv("GIVEAWAY_GUESS_WINDOW", "60"))
+GUESS_BAN_SECONDS = float(os.getenv("GIVEAWAY_GUESS_BAN_SECONDS", "900"))
+SPAM_TRACKED_USERS = 100000
+
+# Entries shown by /leaderboard
+LEADERBOARD_SIZE = 20
+# Per-prefix lines shown by /stats
+STATS_MAX_PREFIXES = 30
+# Codes per /listcodes page
+LISTCODES_PAGE_SIZE = 20
+
+# /gencode: largest batch, codes per committed chunk, most codes listed in chat instead of a file
+GENCODE_MAX = 2_000_000
+GENCODE_CHUNK = 10_000
+GENCODE_INLINE_MAX = 20
+# Code file imports: codes per committed batch, seconds between progress edits
+IMPORT_BATCH = 5_000
+IMPORT_PROGRESS_INTERVAL = 3.0
+
+# Scheduled drops and expiry: seconds between checks for due schedules
+SCHEDULE_TICK = float(os.getenv("GIVEAWAY_SCHEDULE_TICK", "1"))
+# Pending schedules listed by /schedules
+SCHEDULES_LIST_MAX = 30
+# Random bytes per schedule id (hex, so twice as many characters)
+SCHEDULE_ID_BYTES = 4
+
+# Broadcasts: messages per second (Telegram allows ~30), parallel sends, retries per user
+BROADCAST_RATE = float(os.getenv("GIVEAWAY_BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("GIVEAWAY_BROADCAST_CONCURRENCY", "20"))
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_CHECKPOINT_INTERVAL = 2.0
+BROADCAST_PROGRESS_INTERVAL = 5.0
+
+# Redemption queue: codes processed at once (default: one per user reply connection, as
+# each ends in a reply), most codes waiting before new ones are turned away, and the
+# queue position from which a code gets a "you're in the queue" reply (each one is an
+# extra message, so short waits are not acknowledged)
+REDEMPTION_WORKERS = int(os.getenv("GIVEAWAY_REDEMPTION_WORKERS", str(SEND_POOL_SIZE)))
+REDEMPTION_QUEUE_SIZE = int(os.getenv("GIVEAWAY_REDEMPTION_QUEUE_SIZE", "5000"))
+REDEMPTION_ACK_POSITION = int(os.getenv("GIVEAWAY_REDEMPTION_ACK_POSITION", "100"))
+
+# Admin notifications: seconds to collect redemptions into one digest (0 = one message each)
+ADMIN_DIGEST_WINDOW = float(os.getenv("GIVEAWAY_ADMIN_DIGEST_WINDOW", "0"))
+NOTIFY_CONCURRENCY = 8
+NOTIFY_QUEUE_SIZE = 10000
+DIGEST_MAX_LINES = 40
+
+# Monitoring: port for the built-in /metrics and /healthz server in polling mode
+# (0 = off; app.py serves them in webhook mode), event loop probe interval and
+# the longest the loop may go without running the probe before /healthz fails
+METRICS_PORT = int(os.getenv("GIVEAWAY_METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("GIVEAWAY_METRICS_HOST", "127.0.0.1")
+LOOP_LAG_INTERVAL = 0.5
+HEALTH_MAX_STALL = 10.0
+# Handler calls slower than this (seconds) are logged with their time breakdown;
+# a sampled fraction is also run under cProfile, keeping the slowest few as .prof files
+SLOW_UPDATE_SECONDS = float(os.getenv("GIVEAWAY_SLOW_UPDATE_SECONDS", "1.0"))
+PROFILE_SAMPLE_RATE = float(os.getenv("GIVEAWAY_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("GIVEAWAY_PROFILE_DIR", "profiles")
+PROFILE_KEEP = 20
 LOG_LEVEL = logging.INFO
 
 # Regex for code validation: PREFIX-XXXX-XXXX-XXXX (prefix letters/digits allowed)
 CODE_REGEX = re.compile(r"^[A-Z0-9]+-[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}$")
+# Campaign prefixes taken by /listcodes, short enough for its buttons' 64-byte callback data
+PREFIX_MAX_LENGTH = 32
+PREFIX_REGEX = re.compile(rf"^[A-Z0-9]{{1,{PREFIX_MAX_LENGTH}}}$")
 
 # ---------------------------
 # Logging
@@ -53,43 +192,2047 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ---------------------------
+# Metrics
+# ---------------------------
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metrics:
+    """Small registry rendered in the Prometheus text format.
+
+    Counters and histograms are updated on the bot's event loop and read
+    by the web server's threads, hence the lock. Gauges are callables
+    evaluated at scrape time.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._series: Dict[str, Dict[Tuple, object]] = {}
+        self._readers: Dict[str, Callable[[], Optional[float]]] = {}
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._meta[name] = ("counter", help_text)
+        self._series.setdefault(name, {})
+
+    def histogram(self, name: str, help_text: str) -> None:
+        self._meta[name] = ("histogram", help_text)
+        self._series.setdefault(name, {})
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], Optional[float]], kind: str = "gauge") -> None:
+        """Register a value read at scrape time (kind="counter" for running totals kept elsewhere)."""
+        self._meta[name] = (kind, help_text)
+        self._readers[name] = read
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            counts = series.get(key)
+            if counts is None:
+                # One slot per bucket plus +Inf, then the running sum.
+                counts = series[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+            counts[-1] += value
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if name in self._readers:
+                    try:
+                        value = self._readers[name]()
+                    except Exception:
+                        value = None
+                    if value is not None:
+                        lines.append(f"{name} {value}")
+                elif kind == "counter":
+                    lines.extend(f"{name}{format_labels(key)} {value}" for key, value in self._series[name].items())
+                else:
+                    for key, counts in self._series[name].items():
+                        total = 0
+                        for le, n in zip(self.BUCKETS + ("+Inf",), counts):
+                            total += n
+                            lines.append(f"{name}_bucket{format_labels(key + (('le', le),))} {total}")
+                        lines.append(f"{name}_sum{format_labels(key)} {counts[-1]}")
+                        lines.append(f"{name}_count{format_labels(key)} {total}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(key: Tuple) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in key) + "}"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+metrics.counter("giveaway_handler_calls_total", "Handler calls by handler and outcome.")
+metrics.histogram("giveaway_handler_seconds", "Handler wall time in seconds.")
+metrics.counter("giveaway_handler_time_seconds_total", "Handler wall time split into storage, api and own (everything else).")
+metrics.counter("giveaway_bot_api_errors_total", "Failed Bot API requests by method and error.")
+metrics.histogram("giveaway_bot_api_seconds", "Bot API request latency in seconds by method.")
+metrics.histogram("giveaway_bot_api_wait_seconds", "Time Bot API requests waited for a connection, by priority.")
+metrics.counter("giveaway_store_flush_bytes_total", "Bytes persisted by kind (journal, snapshot).")
+metrics.histogram("giveaway_store_flush_seconds", "Time to persist state in seconds by kind (journal, snapshot, sqlite).")
+metrics.counter("giveaway_spam_rejected_total", "Updates dropped by the spam guard by reason (flood, banned).")
+metrics.counter("giveaway_temp_bans_total", "Temporary bans for repeated invalid code guesses.")
+metrics.histogram("giveaway_redemption_wait_seconds", "Time redemptions waited in the admission queue.")
+metrics.histogram("giveaway_redemption_seconds", "Time from queueing a redemption to its reply, in seconds.")
+metrics.counter("giveaway_redemptions_shed_total", "Redemptions turned away by reason (full, pending).")
+metrics.histogram("giveaway_event_loop_lag_seconds", "How late the periodic event loop probe woke up, in seconds.")
+
 # ---------------------------
 # Data helpers
 # ---------------------------
 
 
+class IntSet:
+    """Set of 64-bit ints: a sorted array('q') plus small add/remove sets.
+
+    Membership is a set lookup or a binary search. Adds and removes only
+    touch the small sets; they are merged into the array once they grow
+    past a fraction of it. Iterates in ascending order. In the data file
+    it is stored as {"intset": base64(zlib(first value + deltas))}, and
+    a plain list (the old format) is accepted on load.
+    """
+
+    __slots__ = ("_base", "_added", "_removed")
+
+    def __init__(self, values: Iterable[int] = ()):
+        self._base = array("q", sorted(set(values)))
+        self._added: set = set()
+        self._removed: set = set()  # values still in _base that are no longer members
+
+    def __contains__(self, value: int) -> bool:
+        if value in self._added:
+            return True
+        base = self._base
+        i = bisect.bisect_left(base, value)
+        return i < len(base) and base[i] == value and value not in self._removed
+
+    def __len__(self) -> int:
+        return len(self._base) - len(self._removed) + len(self._added)
+
+    def __iter__(self) -> Iterator[int]:
+        self.compact()
+        return iter(self._base)
+
+    def add(self, value: int) -> bool:
+        """Add `value`; returns False if it was already a member."""
+        if value in self:
+            return False
+        if value in self._removed:
+            self._removed.discard(value)
+        else:
+            self._added.add(value)
+            self._maybe_compact()
+        return True
+
+    def discard(self, value: int) -> bool:
+        """Remove `value`; returns False if it was not a member."""
+        if value in self._added:
+            self._added.discard(value)
+            return True
+        if value not in self:
+            return False
+        self._removed.add(value)
+        self._maybe_compact()
+        return True
+
+    def _maybe_compact(self) -> None:
+        if len(self._added) + len(self._removed) > max(4096, len(self._base) >> 4):
+            self.compact()
+
+    def compact(self) -> None:
+        """Merge pending adds and removes into the sorted array."""
+        if not self._added and not self._removed:
+            return
+        values = self._base.tolist()
+        if self._removed:
+            removed = self._removed
+            values = [v for v in values if v not in removed]
+        # Timsort merges the two sorted runs in linear time.
+        values.extend(sorted(self._added))
+        values.sort()
+        self._base = array("q", values)
+        self._added = set()
+        self._removed = set()
+
+    def copy(self) -> "IntSet":
+        other = IntSet.__new__(IntSet)
+        other._base = array("q", self._base)
+        other._added = set(self._added)
+        other._removed = set(self._removed)
+        return other
+
+    def to_json(self) -> Dict:
+        self.compact()
+        base = self._base
+        deltas = array("q", base[:1])
+        deltas.extend(map(operator.sub, itertools.islice(base, 1, None), base))
+        if sys.byteorder == "big":
+            deltas.byteswap()
+        return {"intset": base64.b64encode(zlib.compress(deltas.tobytes(), 6)).decode("ascii")}
+
+    @classmethod
+    def from_json(cls, value) -> "IntSet":
+        if isinstance(value, dict):
+            deltas = array("q")
+            deltas.frombytes(zlib.decompress(base64.b64decode(value["intset"])))
+            if sys.byteorder == "big":
+                deltas.byteswap()
+            result = cls.__new__(cls)
+            result._base = array("q", itertools.accumulate(deltas))
+            result._added = set()
+            result._removed = set()
+            return result
+        return cls(value)
+
+
+# Keys of the data file holding IntSets ("past_winners" only in files from before campaigns)
+INT_SET_KEYS = ("users", "past_winners", "banned_users", "awaiting_screenshot")
+
+
+def json_default(value):
+    if isinstance(value, IntSet):
+        return value.to_json()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
 def default_data() -> Dict:
+    """The main data file. Codes and winners live in per-campaign files, see Campaign.
+
+    Files from before campaigns hold every code in "codes" and all winners
+    in "past_winners"; the store splits them into campaigns on load.
+    """
     return {
-        "codes": {},  # code -> {"redeemed_by": None/int, "redeemed_by_username": None/str, "redeemed_at": None/iso, "prize": None, "created_at": iso}
-        "past_winners": [],
-        "users": [],
+        "campaigns": [],  # prefixes of the campaigns held in memory
+        "archived": {},  # prefix -> {"total": int, "redeemed": int, "winners": int} of archived campaigns
+        "users": IntSet(),
         "leaderboard": {},  # user_id_str -> {"username": str, "score": int}
-        "banned_users": [],
-        "awaiting_screenshot": [],  # user ids expecting to upload screenshot
-        "last_generated_codes": [],  # codes created by last /gencode
+        "banned_users": IntSet(),
+        "awaiting_screenshot": IntSet(),  # user ids expecting to upload screenshot
+        "last_generated_codes": [],  # codes created by last /gencode (files from before LAST_GENERATED_FILE)
+        "last_generated_count": 0,  # codes in LAST_GENERATED_FILE
+        "broadcast": None,  # checkpoint of the running /broadcast, see run_broadcast()
+        "schedules": {},  # id -> pending release or expiry, see CodeScheduler
     }
 
 
 def load_data() -> Dict:
+    """Read the JSON snapshot from disk (used once at startup by the store)."""
     if not os.path.exists(DATA_FILE):
         data = default_data()
         save_data(data)
         return data
     try:
         with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+            data = json.load(f)
     except (json.JSONDecodeError, IOError) as e:
         logger.error("Failed to load data file: %s - reinitializing", e)
         data = default_data()
         save_data(data)
         return data
+    for key, value in default_data().items():
+        data.setdefault(key, value)
+    for key in INT_SET_KEYS:
+        if key in data:
+            data[key] = IntSet.from_json(data[key])
+    return data
+
+
+def write_json_atomic(path: str, data: Dict) -> int:
+    """Write `data` to `path` via a fsynced temporary file. Returns the number of bytes written."""
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=json_default).encode("utf-8")
+    return write_file_atomic(path, payload)
+
+
+def encode_code_list(codes: List[str], **fields) -> bytes:
+    """JSON {**fields, "codes": codes}, encoded a chunk of codes at a time.
+
+    One json.dumps() of millions of codes holds the GIL throughout, which
+    stalls the event loop even when it runs in a worker thread.
+    """
+    head = json.dumps(fields, ensure_ascii=False, separators=(",", ":"))[:-1]
+    parts = [head + ("," if fields else "") + '"codes":[']
+    for start in range(0, len(codes), GENCODE_CHUNK):
+        parts.append(("," if start else "") + json.dumps(codes[start:start + GENCODE_CHUNK], separators=(",", ":"))[1:-1])
+    parts.append("]}")
+    return "".join(parts).encode("utf-8")
+
+
+def write_file_atomic(path: str, payload: bytes) -> int:
+    """Write `payload` to `path` via a fsynced temporary file. Returns the number of bytes written."""
+    # A temporary file of its own, so concurrent writers never share one.
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return len(payload)
+
+
+def save_data(data: Dict) -> int:
+    """Atomically write a snapshot to disk. Returns the number of bytes written."""
+    return write_json_atomic(DATA_FILE, data)
+
+
+def campaign_file(prefix: str) -> str:
+    return os.path.join(CAMPAIGN_DIR, f"{prefix}.json")
+
+
+def load_campaign(prefix: str) -> Optional[Dict]:
+    """Read a campaign file, or None if there is none."""
+    try:
+        with open(campaign_file(prefix), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_campaign(doc: Dict) -> int:
+    os.makedirs(CAMPAIGN_DIR, exist_ok=True)
+    return write_json_atomic(campaign_file(doc["prefix"]), doc)
+
+
+def load_last_generated() -> List[str]:
+    """Read LAST_GENERATED_FILE, or [] if there is none."""
+    try:
+        with open(LAST_GENERATED_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)["codes"]
+    except FileNotFoundError:
+        return []
+
+
+def schedule_codes_file(schedule_id: str) -> str:
+    return os.path.join(SCHEDULE_DIR, f"{schedule_id}.json")
+
+
+def load_schedule_codes(schedule_id: str) -> Optional[Dict]:
+    """Read the {"codes": [...], "prizes": {...}} file of a schedule, or None if there is none."""
+    try:
+        with open(schedule_codes_file(schedule_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_schedule_codes(schedule_id: str, codes: List[str], prizes: Dict[str, str]) -> int:
+    os.makedirs(SCHEDULE_DIR, exist_ok=True)
+    return write_file_atomic(schedule_codes_file(schedule_id), encode_code_list(codes, prizes=prizes))
+
+
+# ---------------------------
+# State repository
+# ---------------------------
+
+# Redemption outcomes returned by GiveawayStore.redeem_code() and claim_code()
+REDEEM_OK = "ok"
+REDEEM_ALREADY_WON = "already_won"
+REDEEM_UNKNOWN_CODE = "unknown_code"
+REDEEM_ALREADY_REDEEMED = "already_redeemed"
+REDEEM_CAMPAIGN_ARCHIVED = "campaign_archived"
+REDEEM_NONE_AVAILABLE = "none_available"
+
+# Stale entries a claim queue may hold beyond twice its live codes before it is rebuilt
+CLAIM_QUEUE_SLACK = 1024
+
+
+def journal_segments() -> List[Tuple[int, str]]:
+    """Closed journal segments as (last_seq, path), oldest first."""
+    directory = os.path.dirname(JOURNAL_FILE) or "."
+    base = os.path.basename(JOURNAL_FILE) + "."
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(base) and name[len(base):].isdigit():
+            segments.append((int(name[len(base):]), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def read_journal(path: str, repair: bool = False) -> List[Dict]:
+    """Records of a journal file, up to the first torn one.
+
+    A torn final line from a crash mid-write was never acknowledged. With
+    `repair` the file is truncated to the end of the last good record, so
+    records appended later do not land on the partial line (and get lost
+    behind it on the next replay).
+    """
+    records = []
+    if not os.path.exists(path):
+        return records
+    good = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("no line end")
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning("Ignoring unreadable journal record in %s", path)
+                break
+            good += len(line)
+    if repair and good < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(good)
+            f.flush()
+            os.fsync(f.fileno())
+        logger.warning("Truncated torn tail of %s at byte %d", path, good)
+    return records
+
+
+def code_prefix(code: str) -> str:
+    return code.split("-", 1)[0]
+
+
+class CodeCounters:
+    """Per-prefix [total, redeemed] code counts, kept current at mutation time."""
+
+    def __init__(self):
+        self.by_prefix: Dict[str, List[int]] = {}
+        self.total = 0
+        self.redeemed = 0
+
+    def added(self, code: str, redeemed: bool = False) -> None:
+        counts = self.by_prefix.setdefault(code_prefix(code), [0, 0])
+        counts[0] += 1
+        self.total += 1
+        if redeemed:
+            counts[1] += 1
+            self.redeemed += 1
+
+    def removed(self, code: str, redeemed: bool) -> None:
+        prefix = code_prefix(code)
+        counts = self.by_prefix[prefix]
+        counts[0] -= 1
+        self.total -= 1
+        if redeemed:
+            counts[1] -= 1
+            self.redeemed -= 1
+        if counts[0] == 0:
+            del self.by_prefix[prefix]
+
+    def redeemed_one(self, code: str) -> None:
+        self.by_prefix[code_prefix(code)][1] += 1
+        self.redeemed += 1
+
+
+class Campaign:
+    """One giveaway: the codes sharing a prefix, with their own winners.
+
+    Unredeemed codes are also kept in two insertion-ordered dicts (without
+    and with a prize), so listing, counting and paging never touch redeemed
+    codes. Each of them has a FIFO queue for claims: codes are appended as
+    they become available and skipped once they no longer are, so the next
+    code to hand out is found in amortized constant time. For paging, each
+    also gets a sorted list of its codes when first listed; codes added later
+    are merged in at the next listing and codes gone since are skipped the
+    same way. Each campaign is saved to its own file; `seq` is the journal
+    sequence number that file reflects, so replay skips the campaign's part
+    of older records.
+    """
+
+    def __init__(self, prefix: str, seq: int = 0):
+        self.prefix = prefix
+        self.seq = seq
+        self.changed_seq = seq  # last journal record applied to it
+        self.codes: Dict[str, Dict] = {}
+        self.winners = IntSet()
+        self.available: Tuple[Dict[str, None], Dict[str, None]] = ({}, {})
+        self.queues: Tuple[deque, deque] = (deque(), deque())  # may hold stale codes
+        self.sorted: List[Optional[List[str]]] = [None, None]  # may hold stale and repeated codes
+        self.unsorted: Tuple[List[str], List[str]] = ([], [])  # added since the sorted list was last merged
+        self.redeemed = 0
+
+    @classmethod
+    def from_json(cls, doc: Dict) -> "Campaign":
+        campaign = cls(doc["prefix"], doc.get("seq", 0))
+        campaign.winners = IntSet.from_json(doc.get("winners", []))
+        for code, details in doc.get("codes", {}).items():
+            campaign.put(code, details)
+        return campaign
+
+    def to_json(self, seq: int) -> Dict:
+        """A copy as of journal sequence number `seq`, safe to write from a worker thread."""
+        self.seq = seq
+        return {"prefix": self.prefix, "seq": seq, "codes": self.codes.copy(), "winners": self.winners.copy()}
+
+    @property
+    def total(self) -> int:
+        return len(self.codes)
+
+    def summary(self) -> Dict:
+        return {"total": self.total, "redeemed": self.redeemed, "winners": len(self.winners)}
+
+    def put(self, code: str, details: Dict) -> None:
+        """Insert or replace a code's details. Details are replaced, never mutated in place."""
+        old = self.codes.get(code)
+        if old is not None:
+            self._unindex(code, old)
+        self.codes[code] = details
+        if details.get("redeemed_by"):
+            self.redeemed += 1
+            return
+        tier = bool(details.get("prize"))
+        self.available[tier][code] = None
+        if self.sorted[tier] is not None:
+            self.unsorted[tier].append(code)
+        queue = self.queues[tier]
+        queue.append(code)
+        if len(queue) > 2 * len(self.available[tier]) + CLAIM_QUEUE_SLACK:
+            queue.clear()
+            queue.extend(self.available[tier])
+
+    def next_available(self, prize: Optional[bool] = None) -> Optional[str]:
+        """The oldest unredeemed code, with a prize first unless `prize` picks the tier."""
+        for tier in (True, False) if prize is None else (prize,):
+            queue, available = self.queues[tier], self.available[tier]
+            while queue:
+                if queue[0] in available:
+                    return queue[0]
+                queue.popleft()
+        return None
+
+    def available_in_order(self, tier: bool, cursor: Optional[str] = None, backwards: bool = False) -> Iterator[str]:
+        """Unredeemed codes of a tier after `cursor` in code order (or before it, from the nearest back)."""
+        index, available = self.sorted[tier], self.available[tier]
+        if index is None:
+            index = self.sorted[tier] = sorted(available)
+        elif self.unsorted[tier]:
+            index += self.unsorted[tier]
+            self.unsorted[tier].clear()
+            index.sort()  # one sorted run and a short tail: merged in linear time
+        if len(index) > 2 * len(available) + CLAIM_QUEUE_SLACK:
+            index = self.sorted[tier] = list(dict.fromkeys(code for code in index if code in available))
+        if backwards:
+            positions = range((bisect.bisect_left(index, cursor) if cursor is not None else len(index)) - 1, -1, -1)
+        else:
+            positions = range(bisect.bisect_right(index, cursor) if cursor is not None else 0, len(index))
+
+        def codes() -> Iterator[str]:
+            last = None
+            for i in positions:
+                code = index[i]
+                if code != last and code in available:  # a code put again is in the list twice, side by side
+                    last = code
+                    yield code
+
+        return codes()
+
+    def pop(self, code: str) -> Optional[Dict]:
+        details = self.codes.pop(code, None)
+        if details is not None:
+            self._unindex(code, details)
+        return details
+
+    def _unindex(self, code: str, details: Dict) -> None:
+        if details.get("redeemed_by"):
+            self.redeemed -= 1
+        else:
+            self.available[bool(details.get("prize"))].pop(code, None)
+
+
+class RateWindow:
+    """Events in the last `seconds` seconds, counted in one-second buckets."""
+
+    def __init__(self, seconds: int = 60):
+        self.seconds = seconds
+        self._buckets = [0] * seconds
+        self._stamps = [0] * seconds
+
+    def hit(self) -> None:
+        now = int(time.monotonic())
+        i = now % self.seconds
+        if self._stamps[i] != now:
+            self._stamps[i] = now
+            self._buckets[i] = 0
+        self._buckets[i] += 1
+
+    def count(self) -> int:
+        oldest = int(time.monotonic()) - self.seconds
+        return sum(n for n, stamp in zip(self._buckets, self._stamps) if stamp > oldest)
+
+
+class LeaderboardTop:
+    """The top `size` leaderboard entries, maintained incrementally.
+
+    Relies on scores only ever increasing: an entry can only enter the top
+    through its own update, so each update is O(size) regardless of how
+    many entries exist. Ties rank in order of first win, as before.
+    `version` changes whenever the visible top changes.
+    """
+
+    def __init__(self, size: int = LEADERBOARD_SIZE):
+        self.size = size
+        self.version = 0
+        self._top: List[Tuple[int, int, str, str]] = []  # (-score, first_win_order, user_id, username)
+
+    def seed(self, entries) -> None:
+        """Rebuild from (first_win_order, user_id, username, score) tuples."""
+        ranked = sorted((-score, order, str(uid), username or "User") for order, uid, username, score in entries)
+        self._top = ranked[:self.size]
+        self.version += 1
+
+    def update(self, order: int, user_id, username: str, score: int) -> None:
+        uid = str(user_id)
+        entry = (-score, order, uid, username or "User")
+        for i, (_, _, top_uid, _) in enumerate(self._top):
+            if top_uid == uid:
+                self._top[i] = entry
+                break
+        else:
+            if len(self._top) >= self.size:
+                if entry >= self._top[-1]:
+                    return
+                self._top.pop()
+            self._top.append(entry)
+        self._top.sort()
+        self.version += 1
+
+    def entries(self) -> List[Tuple[str, int]]:
+        """(username, score) pairs, best first."""
+        return [(username, -neg_score) for neg_score, _, _, username in self._top]
+
+
+class GiveawayStore:
+    """Process-resident giveaway state backed by snapshots plus a journal.
+
+    The snapshot is the main data file (users, bans, leaderboard, ...) and
+    one file per campaign (its codes and winners). It is loaded once at
+    startup and the journal of later mutations is replayed on top of it.
+    Handlers read and mutate memory through the methods below; each
+    mutation is applied immediately and appended to the journal by a
+    background writer that fsyncs records in batches. ``await
+    store.commit()`` returns once everything mutated so far is durable, so
+    a handler that awaits it before replying never acknowledges a change a
+    crash could lose.
+
+    Every COMPACT_EVERY records the journal is rotated and the state is
+    compacted into the snapshot from a worker thread: only campaigns
+    changed since the last compaction are rewritten, then the main file.
+    Nested records (code details, leaderboard entries) are always replaced,
+    never mutated in place, so a shallow copy of the containers is
+    consistent. Archived campaigns stay in their files and out of memory.
+    """
+
+    def __init__(self, compact_every: int = COMPACT_EVERY):
+        self.compact_every = compact_every
+        self.data: Dict = default_data()
+        self.campaigns: Dict[str, Campaign] = {}
+        self.archived: Dict[str, Dict] = {}  # prefix -> Campaign.summary() at archive time
+        self._dirty: set = set()  # campaigns changed since their file was written
+        self._unarchived: Dict[str, Dict] = {}  # campaign files read by unarchive_campaign()
+        self._seq = 0  # last journal sequence number applied to memory
+        self._durable_seq = 0  # last sequence number fsynced to the journal
+        self._snapshot_seq = 0  # last sequence number contained in the snapshot
+        self._pending: List[bytes] = []
+        self._journal = None
+        self._journal_end = 0  # journal size before a batch that failed part-way
+        self._wakeup: Optional[asyncio.Event] = None
+        self._durable: Optional[asyncio.Condition] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._compact_task: Optional[asyncio.Task] = None
+        # Held while campaign files are written, so compaction and archiving never race on one.
+        self._campaign_files = asyncio.Lock()
+        self._closing = False
+        self.leaderboard = LeaderboardTop()
+        self._first_win_order: Dict[str, int] = {}
+        self.redemption_rate = RateWindow()
+        self._removed_schedules: List[Tuple[int, str]] = []  # (seq, id) whose codes files are still on disk
+
+    # --- lifecycle ---
+
+    def load(self) -> None:
+        self.data = load_data()
+        self._snapshot_seq = self._seq = self.data.pop("journal_seq", 0)
+        self.archived = self.data.pop("archived")
+        self.campaigns = {}
+        for prefix in self.data.pop("campaigns"):
+            doc = load_campaign(prefix)
+            if doc is None:
+                logger.error("Campaign file %s is missing - starting it empty", campaign_file(prefix))
+                doc = {"prefix": prefix}
+            self.campaigns[prefix] = Campaign.from_json(doc)
+        legacy_codes = self.data.pop("codes", None)
+        legacy_winners = self.data.pop("past_winners", IntSet())
+        if legacy_codes:
+            self._split_legacy(legacy_codes, legacy_winners)
+        self._first_win_order = {uid: order for order, uid in enumerate(self.data["leaderboard"])}
+        self.leaderboard.seed(
+            (self._first_win_order[uid], uid, e.get("username"), e.get("score", 0))
+            for uid, e in self.data["leaderboard"].items()
+        )
+        replayed = 0
+        for path in [path for _, path in journal_segments()] + [JOURNAL_FILE]:
+            for record in read_journal(path, repair=path == JOURNAL_FILE):
+                if record["seq"] <= self._seq:
+                    continue
+                self._apply(record)
+                self._seq = record["seq"]
+                replayed += 1
+        self._durable_seq = self._seq
+        self._delete_orphan_schedule_files()
+        logger.info(
+            "Loaded %d codes in %d campaigns (%d archived) and %d users from %s (%d journal records replayed)",
+            sum(c.total for c in self.campaigns.values()), len(self.campaigns), len(self.archived),
+            len(self.data["users"]), DATA_FILE, replayed,
+        )
+
+    def _split_legacy(self, codes: Dict[str, Dict], past_winners: IntSet) -> None:
+        """Split a data file from before campaigns. Past winners stay winners of the campaigns they won in."""
+        for code, details in codes.items():
+            prefix = code_prefix(code)
+            campaign = self.campaigns.get(prefix)
+            if campaign is None:
+                campaign = self.campaigns[prefix] = Campaign(prefix, self._seq)
+            campaign.put(code, details)
+            winner = details.get("redeemed_by")
+            if winner and winner in past_winners:
+                campaign.winners.add(winner)
+        self._dirty.update(self.campaigns)
+        logger.info("Split %d codes into %d campaigns", len(codes), len(self.campaigns))
+
+    def start(self) -> None:
+        """Start the journal writer. Must be called from the running event loop."""
+        self._journal = open(JOURNAL_FILE, "ab")
+        self._wakeup = asyncio.Event()
+        self._durable = asyncio.Condition()
+        if self._pending:
+            self._wakeup.set()
+        self._writer_task = asyncio.create_task(self._writer_loop(), name="store-journal")
+
+    async def close(self) -> None:
+        """Drain the journal, stop the writer and compact into the snapshot."""
+        if self._writer_task:
+            self._closing = True
+            self._wakeup.set()
+            await self._writer_task
+            self._writer_task = None
+        if self._compact_task:
+            await self._compact_task
+        if self._journal is not None:
+            await self._compact()
+            if self._snapshot_seq == self._seq:
+                self._journal.truncate(0)
+            self._journal.close()
+            self._journal = None
+
+    async def commit(self) -> None:
+        """Wait until every mutation made so far has been fsynced to the journal."""
+        target = self._seq
+        if self._durable is None or self._durable_seq >= target:
+            return
+        async with self._durable:
+            await self._durable.wait_for(lambda: self._durable_seq >= target)
+
+    def snapshot(self) -> Dict:
+        """Return a consistent copy of the main data file, cheap enough to take on the event loop."""
+        data = {key: value.copy() if isinstance(value, (dict, list, IntSet)) else value for key, value in self.data.items()}
+        data["campaigns"] = sorted(self.campaigns)
+        data["archived"] = dict(self.archived)
+        data["journal_seq"] = self._seq
+        return data
+
+    # --- journal ---
+
+    def _log(self, op: str, **fields) -> None:
+        """Apply a mutation to memory and queue it for the journal."""
+        self._seq += 1
+        record = {"seq": self._seq, "op": op, **fields}
+        self._apply(record)
+        self._pending.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _apply(self, record: Dict) -> None:
+        getattr(self, "_apply_" + record["op"])(record)
+
+    def _campaign_for(self, prefix: str, record: Dict, create: bool = False) -> Optional[Campaign]:
+        """The campaign a record changes, or None if it is not in memory or its file already has the record."""
+        campaign = self.campaigns.get(prefix)
+        if campaign is None:
+            if not create or prefix in self.archived:
+                return None
+            campaign = self.campaigns[prefix] = Campaign(prefix)
+        elif record["seq"] <= campaign.seq:
+            return None
+        campaign.changed_seq = record["seq"]
+        self._dirty.add(prefix)
+        return campaign
+
+    def _write_batch(self, payload: bytes) -> None:
+        if self._journal.closed:
+            self._reopen_journal()
+        end = self._journal.tell()
+        try:
+            self._journal.write(payload)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        except OSError:
+            # Part of the batch may be on disk already. Left there, the retry
+            # would append after a torn record and replay would stop at it.
+            try:
+                self._journal.close()
+            except OSError:
+                pass
+            self._journal_end = end
+            self._reopen_journal()
+            raise
+
+    def _reopen_journal(self) -> None:
+        """Cut the journal back to `_journal_end`, dropping a partly written batch, and reopen it."""
+        with open(JOURNAL_FILE, "r+b") as f:
+            f.truncate(self._journal_end)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal = open(JOURNAL_FILE, "ab")
+
+    async def _write_pending(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        target = self._seq
+        payload = b"".join(batch)
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._write_batch, payload)
+        except OSError:
+            self._pending[:0] = batch
+            raise
+        metrics.observe("giveaway_store_flush_seconds", time.perf_counter() - start, kind="journal")
+        metrics.inc("giveaway_store_flush_bytes_total", len(payload), kind="journal")
+        async with self._durable:
+            self._durable_seq = target
+            self._durable.notify_all()
+
+    async def _writer_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._closing:
+                # Give concurrent handlers a moment to join the same fsync.
+                await asyncio.sleep(JOURNAL_BATCH_DELAY)
+            try:
+                await self._write_pending()
+            except OSError as e:
+                logger.error("Failed to append to journal: %s - will retry", e)
+                await asyncio.sleep(1)
+                self._wakeup.set()
+                continue
+            if self._closing and not self._pending:
+                return
+            if self._seq - self._snapshot_seq >= self.compact_every and (self._compact_task is None or self._compact_task.done()):
+                self._rotate_journal()
+                self._compact_task = asyncio.create_task(self._compact(), name="store-compact")
+
+    def _rotate_journal(self) -> None:
+        """Close the current journal as a segment ending at the durable sequence number."""
+        self._journal.close()
+        os.replace(JOURNAL_FILE, f"{JOURNAL_FILE}.{self._durable_seq}")
+        self._journal = open(JOURNAL_FILE, "ab")
+
+    async def _compact(self) -> None:
+        async with self._campaign_files:
+            await self._compact_locked()
+
+    async def _compact_locked(self) -> None:
+        snapshot = self.snapshot()
+        seq = snapshot["journal_seq"]
+        if seq == self._snapshot_seq:
+            return
+        dirty = [self.campaigns[prefix].to_json(seq) for prefix in sorted(self._dirty) if prefix in self.campaigns]
+        self._dirty = set()
+
+        def write() -> int:
+            # Campaigns first: a campaign file newer than the main file is fine,
+            # replay skips the records it already has.
+            size = sum(save_campaign(doc) for doc in dirty)
+            size += save_data(snapshot)
+            for last_seq, path in journal_segments():
+                if last_seq <= seq:
+                    os.remove(path)
+            return size
+
+        start = time.perf_counter()
+        try:
+            size = await asyncio.to_thread(write)
+        except OSError as e:
+            logger.error("Failed to compact journal into %s: %s", DATA_FILE, e)
+            self._dirty.update(doc["prefix"] for doc in dirty)
+            return
+        metrics.observe("giveaway_store_flush_seconds", time.perf_counter() - start, kind="snapshot")
+        metrics.inc("giveaway_store_flush_bytes_total", size, kind="snapshot")
+        self._snapshot_seq = seq
+        self._delete_schedule_files(seq)
+
+    # --- users ---
+
+    def user_ids(self) -> List[int]:
+        return list(self.data["users"])
+
+    def add_user(self, user_id: int) -> bool:
+        if user_id in self.data["users"]:
+            return False
+        self._log("add_user", user_id=user_id)
+        return True
+
+    def _apply_add_user(self, r: Dict) -> None:
+        self.data["users"].add(r["user_id"])
+
+    def remove_user(self, user_id: int) -> bool:
+        if user_id not in self.data["users"]:
+            return False
+        self._log("remove_user", user_id=user_id)
+        return True
+
+    def _apply_remove_user(self, r: Dict) -> None:
+        self.data["users"].discard(r["user_id"])
+
+    def is_banned(self, user_id: int) -> bool:
+        return user_id in self.data["banned_users"]
+
+    def ban(self, user_id: int) -> bool:
+        if user_id in self.data["banned_users"]:
+            return False
+        self._log("ban", user_id=user_id)
+        return True
+
+    def _apply_ban(self, r: Dict) -> None:
+        self.data["banned_users"].add(r["user_id"])
+
+    def unban(self, user_id: int) -> bool:
+        if user_id not in self.data["banned_users"]:
+            return False
+        self._log("unban", user_id=user_id)
+        return True
+
+    def _apply_unban(self, r: Dict) -> None:
+        self.data["banned_users"].discard(r["user_id"])
+
+    def is_awaiting_screenshot(self, user_id: int) -> bool:
+        return user_id in self.data["awaiting_screenshot"]
+
+    def screenshot_received(self, user_id: int) -> bool:
+        """Take the user off the awaiting list. Returns False if they were not on it."""
+        if user_id not in self.data["awaiting_screenshot"]:
+            return False
+        self._log("screenshot", user_id=user_id)
+        return True
+
+    def _apply_screenshot(self, r: Dict) -> None:
+        self.data["awaiting_screenshot"].discard(r["user_id"])
+
+    # --- codes ---
+
+    def get_code(self, code: str) -> Optional[Dict]:
+        campaign = self.campaigns.get(code_prefix(code))
+        return campaign.codes.get(code) if campaign is not None else None
+
+    def has_code(self, code: str) -> bool:
+        return self.get_code(code) is not None
+
+    def is_archived(self, prefix: str) -> bool:
+        return prefix in self.archived
+
+    def add_code(self, code: str) -> bool:
+        """Add an unredeemed code. Returns False if it exists or its campaign is archived."""
+        if self.has_code(code) or self.is_archived(code_prefix(code)):
+            return False
+        self._log("add_code", code=code, created_at=datetime.now(timezone.utc).isoformat())
+        return True
+
+    def _apply_add_code(self, r: Dict) -> None:
+        campaign = self._campaign_for(code_prefix(r["code"]), r, create=True)
+        if campaign is None or r["code"] in campaign.codes:
+            return
+        details = initialize_code_details(r["created_at"])
+        if r.get("prize"):
+            details["prize"] = r["prize"]
+        campaign.put(r["code"], details)
+
+    def add_codes(self, codes: List[str], prizes: Optional[Dict[str, str]] = None) -> List[str]:
+        """Add many codes as one journal record, optionally with their prizes.
+
+        Returns the codes that were new; existing codes keep their details,
+        and codes of archived campaigns are skipped.
+        """
+        added = [
+            code for code in dict.fromkeys(codes)
+            if not self.has_code(code) and not self.is_archived(code_prefix(code))
+        ]
+        if added:
+            fields = {"codes": added, "created_at": datetime.now(timezone.utc).isoformat()}
+            if prizes:
+                fields["prizes"] = {code: prizes[code] for code in added if prizes.get(code)}
+            self._log("add_codes", **fields)
+        return added
+
+    def _apply_add_codes(self, r: Dict) -> None:
+        prizes = r.get("prizes", {})
+        for code in r["codes"]:
+            self._apply_add_code({"seq": r["seq"], "code": code, "created_at": r["created_at"], "prize": prizes.get(code)})
+
+    def delete_code(self, code: str) -> bool:
+        if not self.has_code(code):
+            return False
+        self._log("delete_code", code=code)
+        return True
+
+    def _apply_delete_code(self, r: Dict) -> None:
+        campaign = self._campaign_for(code_prefix(r["code"]), r)
+        if campaign is not None:
+            campaign.pop(r["code"])
+
+    def set_prize(self, code: str, prize: str) -> bool:
+        if not self.has_code(code):
+            return False
+        self._log("set_prize", code=code, prize=prize)
+        return True
+
+    def _apply_set_prize(self, r: Dict) -> None:
+        campaign = self._campaign_for(code_prefix(r["code"]), r)
+        details = campaign.codes.get(r["code"]) if campaign is not None else None
+        if details is not None:
+            campaign.put(r["code"], {**details, "prize": r["prize"]})
+
+    def last_generated_codes(self) -> List[str]:
+        if self.data["last_generated_codes"] or not self.data["last_generated_count"]:
+            return list(self.data["last_generated_codes"])
+        return load_last_generated()
+
+    async def set_last_generated(self, codes: List[str]) -> None:
+        """Remember the codes of the last /gencode. They go to LAST_GENERATED_FILE, so compactions never rewrite them."""
+        codes = list(codes)
+        await asyncio.to_thread(lambda: write_file_atomic(LAST_GENERATED_FILE, encode_code_list(codes)))
+        self._log("set_last_generated", count=len(codes))
+
+    def _apply_set_last_generated(self, r: Dict) -> None:
+        # Records from before LAST_GENERATED_FILE carry the codes themselves.
+        self.data["last_generated_codes"] = r.get("codes", [])
+        self.data["last_generated_count"] = r.get("count", 0)
+
+    def redeem_code(self, code: str, user_id: int, username: str) -> Tuple[str, Optional[Dict]]:
+        """Check and redeem a code in one step. Returns (outcome, code details).
+
+        Each user can win once per campaign. The checks and the mutation run
+        without yielding to the event loop, so concurrent handlers can never
+        award the same code twice or give one user two codes of a campaign.
+        """
+        prefix = code_prefix(code)
+        campaign = self.campaigns.get(prefix)
+        if campaign is None:
+            return (REDEEM_CAMPAIGN_ARCHIVED if prefix in self.archived else REDEEM_UNKNOWN_CODE), None
+        if user_id in campaign.winners:
+            return REDEEM_ALREADY_WON, None
+        details = campaign.codes.get(code)
+        if details is None:
+            return REDEEM_UNKNOWN_CODE, None
+        if details.get("redeemed_by"):
+            return REDEEM_ALREADY_REDEEMED, details
+        self._log("redeem", code=code, user_id=user_id, username=username, at=datetime.now(timezone.utc).isoformat())
+        self.redemption_rate.hit()
+        return REDEEM_OK, campaign.codes[code]
+
+    def claim_code(self, user_id: int, username: str, prefix: Optional[str] = None,
+                   prize: Optional[bool] = None) -> Tuple[str, Optional[str], Optional[Dict]]:
+        """Redeem the next available code for a user. Returns (outcome, code, code details).
+
+        Looks in campaign `prefix`, or in every campaign the user has not won
+        yet (in prefix order), optionally only codes with (True) or without
+        (False) a prize. Atomic like redeem_code().
+        """
+        if prefix:
+            if prefix not in self.campaigns:
+                return (REDEEM_CAMPAIGN_ARCHIVED if prefix in self.archived else REDEEM_NONE_AVAILABLE), None, None
+            campaigns = [self.campaigns[prefix]]
+        else:
+            campaigns = [self.campaigns[p] for p in sorted(self.campaigns)]
+        outcome = REDEEM_NONE_AVAILABLE
+        for campaign in campaigns:
+            if campaign.total == campaign.redeemed:
+                continue
+            if user_id in campaign.winners:
+                outcome = REDEEM_ALREADY_WON
+                continue
+            code = campaign.next_available(prize)
+            if code is None:
+                continue
+            self._log("redeem", code=code, user_id=user_id, username=username, at=datetime.now(timezone.utc).isoformat())
+            self.redemption_rate.hit()
+            return REDEEM_OK, code, campaign.codes[code]
+        return outcome, None, None
+
+    def _apply_redeem(self, r: Dict) -> None:
+        user_id, username = r["user_id"], r["username"]
+        campaign = self._campaign_for(code_prefix(r["code"]), r)
+        if campaign is not None:
+            details = campaign.codes.get(r["code"])
+            if details is None or details.get("redeemed_by"):
+                return
+            campaign.put(r["code"], {
+                **details,
+                "redeemed_by": user_id,
+                "redeemed_by_username": username,
+                "redeemed_at": r["at"],
+            })
+            campaign.winners.add(user_id)
+        # The rest lives in the main data file; records after its snapshot always apply.
+        uid_str = str(user_id)
+        entry = self.data["leaderboard"].get(uid_str) or {"username": username, "score": 0}
+        entry = self.data["leaderboard"][uid_str] = {**entry, "score": entry["score"] + 1}
+        order = self._first_win_order.setdefault(uid_str, len(self._first_win_order))
+        self.leaderboard.update(order, uid_str, entry["username"], entry["score"])
+        self.data["awaiting_screenshot"].add(user_id)
+
+    def reset_winners(self, prefix: Optional[str] = None) -> None:
+        """Let past winners win again, in one campaign or in all of them."""
+        self._log("reset", **({"prefix": prefix} if prefix else {}))
+
+    def _apply_reset(self, r: Dict) -> None:
+        prefixes = [r["prefix"]] if r.get("prefix") else list(self.campaigns)
+        for prefix in prefixes:
+            campaign = self._campaign_for(prefix, r)
+            if campaign is not None:
+                campaign.winners = IntSet()
+
+    # --- campaigns ---
+
+    async def archive_campaign(self, prefix: str) -> bool:
+        """Write a campaign to its file and drop it from memory. Returns False if it is not active.
+
+        Its codes can no longer be redeemed or added to until
+        unarchive_campaign(); /stats keeps showing its final counts.
+        """
+        async with self._campaign_files:
+            campaign = self.campaigns.get(prefix)
+            if campaign is None:
+                return False
+            while True:
+                seq = self._seq
+                await asyncio.to_thread(save_campaign, campaign.to_json(seq))
+                if self.campaigns.get(prefix) is not campaign:
+                    return False
+                # Redemptions may have landed while the file was written; write it again if so.
+                if campaign.changed_seq <= seq:
+                    break
+            self._log("archive", prefix=prefix)
+        return True
+
+    def _apply_archive(self, r: Dict) -> None:
+        campaign = self.campaigns.pop(r["prefix"], None)
+        if campaign is not None:
+            self.archived[r["prefix"]] = campaign.summary()
+            self._dirty.discard(r["prefix"])
+
+    async def unarchive_campaign(self, prefix: str) -> bool:
+        """Load an archived campaign back into memory. Returns False if it is not archived."""
+        if prefix not in self.archived:
+            return False
+        doc = await asyncio.to_thread(load_campaign, prefix)
+        if doc is None:
+            logger.error("Campaign file %s is missing", campaign_file(prefix))
+            return False
+        if prefix not in self.archived:
+            return False
+        self._unarchived[prefix] = doc
+        self._log("unarchive", prefix=prefix)
+        return True
+
+    def _apply_unarchive(self, r: Dict) -> None:
+        prefix = r["prefix"]
+        if self.archived.pop(prefix, None) is None:
+            return
+        doc = self._unarchived.pop(prefix, None) or load_campaign(prefix) or {"prefix": prefix}
+        self.campaigns[prefix] = Campaign.from_json(doc)
+
+    def expire_codes(self, codes: Optional[List[str]] = None, prefix: Optional[str] = None) -> List[str]:
+        """Delete the unredeemed codes among `codes`, or all of campaign `prefix`, as one record.
+
+        Returns the codes deleted. Redeemed codes are kept.
+        """
+        if prefix:
+            campaign = self.campaigns.get(prefix)
+            expired = [*campaign.available[False], *campaign.available[True]] if campaign else []
+        else:
+            expired = []
+            for code in dict.fromkeys(codes or ()):
+                details = self.get_code(code)
+                if details is not None and not details.get("redeemed_by"):
+                    expired.append(code)
+        if expired:
+            self._log("delete_codes", codes=expired)
+        return expired
+
+    def _apply_delete_codes(self, r: Dict) -> None:
+        for code in r["codes"]:
+            self._apply_delete_code({"seq": r["seq"], "code": code})
+
+    # --- schedules ---
+
+    def schedules(self) -> List[Dict]:
+        return list(self.data["schedules"].values())
+
+    def count_schedules(self) -> int:
+        return len(self.data["schedules"])
+
+    def get_schedule(self, schedule_id: str) -> Optional[Dict]:
+        return self.data["schedules"].get(schedule_id)
+
+    def schedule_codes(self, schedule_id: str) -> Tuple[List[str], Dict[str, str]]:
+        """The codes (and their prizes) a schedule releases or expires."""
+        schedule = self.data["schedules"].get(schedule_id) or {}
+        if "codes" in schedule:  # journaled before code lists moved to SCHEDULE_DIR
+            return schedule["codes"], schedule.get("prizes") or {}
+        doc = load_schedule_codes(schedule_id)
+        if doc is None:
+            if schedule.get("count"):
+                logger.error("Schedule file %s is missing - treating it as empty", schedule_codes_file(schedule_id))
+            return [], {}
+        return doc["codes"], doc.get("prizes") or {}
+
+    async def add_schedule(self, schedule: Dict, codes: Optional[List[str]] = None, prizes: Optional[Dict[str, str]] = None) -> None:
+        """Persist a schedule. Its codes go to a file of their own (written in a worker thread), so compactions never rewrite them."""
+        if codes is not None:
+            await asyncio.to_thread(save_schedule_codes, schedule["id"], codes, prizes or {})
+            schedule = {**schedule, "count": len(codes)}
+        self._log("add_schedule", schedule=schedule)
+
+    def _apply_add_schedule(self, r: Dict) -> None:
+        self.data["schedules"][r["schedule"]["id"]] = r["schedule"]
+
+    def remove_schedule(self, schedule_id: str) -> bool:
+        if schedule_id not in self.data["schedules"]:
+            return False
+        self._log("remove_schedule", id=schedule_id)
+        return True
+
+    def _apply_remove_schedule(self, r: Dict) -> None:
+        if self.data["schedules"].pop(r["id"], None) is not None:
+            # The codes file goes once a snapshot without the schedule is on disk.
+            self._removed_schedules.append((r["seq"], r["id"]))
+
+    def _delete_schedule_files(self, seq: int) -> None:
+        """Delete the codes files of schedules removed up to journal record `seq`."""
+        keep = []
+        for removed_seq, schedule_id in self._removed_schedules:
+            if removed_seq > seq:
+                keep.append((removed_seq, schedule_id))
+                continue
+            try:
+                os.remove(schedule_codes_file(schedule_id))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("Failed to delete %s: %s", schedule_codes_file(schedule_id), e)
+        self._removed_schedules = keep
+
+    def _delete_orphan_schedule_files(self) -> None:
+        """Delete codes files no live schedule references, e.g. left behind by a crash before compaction."""
+        try:
+            names = os.listdir(SCHEDULE_DIR)
+        except FileNotFoundError:
+            return
+        for name in names:
+            # "<id>.json", or a "<id>.json.*.tmp" a crashed write left behind
+            if name.endswith(".tmp") or (name.endswith(".json") and name[:-len(".json")] not in self.data["schedules"]):
+                path = os.path.join(SCHEDULE_DIR, name)
+                try:
+                    os.remove(path)
+                    logger.info("Deleted orphaned schedule file %s", path)
+                except OSError as e:
+                    logger.error("Failed to delete %s: %s", path, e)
+
+    # --- broadcast ---
+
+    def broadcast_state(self) -> Optional[Dict]:
+        return self.data.get("broadcast")
+
+    def set_broadcast_state(self, state: Optional[Dict]) -> None:
+        self._log("broadcast", state=state)
+
+    def _apply_broadcast(self, r: Dict) -> None:
+        self.data["broadcast"] = r["state"]
+
+    # --- reporting ---
+
+    def stats(self) -> Dict:
+        """Current counters; constant time in the number of codes and users."""
+        total = sum(c.total for c in self.campaigns.values())
+        redeemed = sum(c.redeemed for c in self.campaigns.values())
+        return {
+            "total_codes": total,
+            "redeemed": redeemed,
+            "available": total - redeemed,
+            "users": len(self.data["users"]),
+            "banned": len(self.data["banned_users"]),
+            "awaiting": len(self.data["awaiting_screenshot"]),
+            "redemptions_last_minute": self.redemption_rate.count(),
+            "prefixes": {prefix: (c.total, c.redeemed) for prefix, c in self.campaigns.items() if c.total},
+            "archived": {prefix: (s["total"], s["redeemed"]) for prefix, s in self.archived.items()},
+        }
+
+    def campaign_stats(self, prefix: str) -> Optional[Dict]:
+        """Counts for one campaign (archived ones included), or None if there is no such campaign."""
+        if prefix in self.archived:
+            s = self.archived[prefix]
+            return {**s, "available": s["total"] - s["redeemed"], "with_prize": None, "archived": True}
+        campaign = self.campaigns.get(prefix)
+        if campaign is None:
+            return None
+        return {
+            **campaign.summary(),
+            "available": campaign.total - campaign.redeemed,
+            "with_prize": len(campaign.available[True]),
+            "archived": False,
+        }
+
+    def _available_parts(self, prefix: Optional[str], prize: Optional[bool]) -> List[Dict[str, None]]:
+        if prefix:
+            campaigns = [self.campaigns[prefix]] if prefix in self.campaigns else []
+        else:
+            campaigns = [self.campaigns[p] for p in sorted(self.campaigns)]
+        wanted = (False, True) if prize is None else (prize,)
+        return [c.available[w] for c in campaigns for w in wanted]
+
+    def count_available(self, prefix: Optional[str] = None, prize: Optional[bool] = None) -> int:
+        """Unredeemed codes, optionally only one prefix and only with (True) or without (False) a prize."""
+        return sum(len(part) for part in self._available_parts(prefix, prize))
+
+    def available_codes(
+        self, prefix: Optional[str] = None, prize: Optional[bool] = None, cursor: Optional[str] = None, limit: int = 50, backwards: bool = False
+    ) -> List[Tuple[str, Optional[str]]]:
+        """Up to `limit` unredeemed codes in (prefix, code) order following `cursor`, or the ones just before it if `backwards`."""
+        if prefix:
+            campaigns = [self.campaigns[prefix]] if prefix in self.campaigns else []
+        else:
+            campaigns = [self.campaigns[p] for p in sorted(self.campaigns, reverse=backwards)]
+        wanted = (False, True) if prize is None else (prize,)
+        codes: List[str] = []
+        for campaign in campaigns:
+            start = cursor
+            if cursor is not None and campaign.prefix != code_prefix(cursor):
+                if (campaign.prefix < code_prefix(cursor)) != backwards:
+                    continue  # wholly on the far side of the cursor
+                start = None
+            tiers = [campaign.available_in_order(tier, start, backwards) for tier in wanted]
+            codes.extend(itertools.islice(heapq.merge(*tiers, reverse=backwards), limit - len(codes)))
+            if len(codes) >= limit:
+                break
+        if backwards:
+            codes.reverse()
+        return [(code, self.get_code(code).get("prize")) for code in codes]
+
+    def export_available(self, prefix: Optional[str] = None, prize: Optional[bool] = None) -> Iterator[Tuple[str, Optional[str]]]:
+        """Iterator of (code, prize) that may be consumed from a worker thread."""
+        parts = self._available_parts(prefix, prize)
+
+        def rows():
+            for part in parts:
+                # One C call, so the loop cannot change the dict while it is copied.
+                for code in list(part):
+                    yield code, (self.get_code(code) or {}).get("prize")
+
+        return rows()
+
+    def export_data(self) -> Dict:
+        """Everything, archived campaigns included, as one document for SqliteStore.import_data()."""
+        data = self.snapshot()
+        data["codes"], data["winners"] = {}, {}
+        data["last_generated_codes"] = self.last_generated_codes()
+        for schedule_id, schedule in data["schedules"].items():
+            if "count" in schedule:
+                codes, prizes = self.schedule_codes(schedule_id)
+                data["schedules"][schedule_id] = {**schedule, "codes": codes, "prizes": prizes}
+        for prefix in sorted(self.campaigns) + sorted(self.archived):
+            campaign = self.campaigns.get(prefix) or Campaign.from_json(load_campaign(prefix) or {"prefix": prefix})
+            data["codes"].update(campaign.codes)
+            data["winners"][prefix] = campaign.winners
+        return data
 
 
-def save_data(data: Dict) -> None:
-    tmp = DATA_FILE + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-    os.replace(tmp, DATA_FILE)
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS codes (
+    code TEXT PRIMARY KEY,
+    prefix TEXT NOT NULL,
+    redeemed INTEGER NOT NULL DEFAULT 0,
+    redeemed_by INTEGER,
+    redeemed_by_username TEXT,
+    redeemed_at TEXT,
+    prize TEXT,
+    created_at TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS codes_available ON codes (redeemed, prefix, code);
+CREATE INDEX IF NOT EXISTS codes_claim ON codes (redeemed, prefix, prize IS NULL, code);
+CREATE TABLE IF NOT EXISTS archived_codes (
+    code TEXT PRIMARY KEY,
+    prefix TEXT NOT NULL,
+    redeemed INTEGER NOT NULL DEFAULT 0,
+    redeemed_by INTEGER,
+    redeemed_by_username TEXT,
+    redeemed_at TEXT,
+    prize TEXT,
+    created_at TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS archived_codes_prefix ON archived_codes (prefix);
+CREATE TABLE IF NOT EXISTS archived_campaigns (
+    prefix TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    redeemed INTEGER NOT NULL,
+    winners INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS campaign_winners (prefix TEXT NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (prefix, user_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS bans (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS awaiting_screenshot (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS leaderboard (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL UNIQUE,
+    username TEXT,
+    score INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS leaderboard_score ON leaderboard (score DESC, id);
+CREATE TABLE IF NOT EXISTS last_generated (pos INTEGER PRIMARY KEY, code TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS schedules (id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS schedule_codes (
+    schedule_id TEXT NOT NULL,
+    code TEXT NOT NULL,
+    prize TEXT,
+    PRIMARY KEY (schedule_id, code)
+) WITHOUT ROWID;
+"""
+
+CODE_COLUMNS = ("redeemed_by", "redeemed_by_username", "redeemed_at", "prize", "created_at")
+ALL_CODE_COLUMNS = "code, prefix, redeemed, redeemed_by, redeemed_by_username, redeemed_at, prize, created_at"
+# Host parameters per statement (SQLite's historic default limit)
+SQLITE_MAX_PARAMS = 999
+# Codes moved per transaction when archiving or unarchiving a campaign
+SQLITE_MOVE_CHUNK = 5000
+
+
+class SqliteStore:
+    """Giveaway state in an indexed SQLite database (WAL mode).
+
+    Exposes the same operations as GiveawayStore without holding the data
+    in memory. Statements run on the event loop thread inside an implicit
+    transaction that commit() (or the background committer) closes, so
+    bursts of mutations share one commit. Campaigns partition the codes
+    table by its prefix column; archived campaigns are moved to
+    archived_codes so they no longer weigh on the hot table and its index.
+    """
+
+    def __init__(self, path: str = SQLITE_FILE, commit_interval: float = 1.0):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.conn: Optional[sqlite3.Connection] = None
+        self._commit_task: Optional[asyncio.Task] = None
+        self.leaderboard = LeaderboardTop()
+        self.counters = CodeCounters()
+        self.redemption_rate = RateWindow()
+        self.archived: Dict[str, Dict] = {}
+        self.archiving: Set[str] = set()  # prefixes archive_campaign() is moving, closed like archived ones
+        self._counts = {"users": 0, "bans": 0, "awaiting_screenshot": 0}
+
+    # --- lifecycle ---
+
+    def load(self) -> None:
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Random code keys touch pages all over the B-trees; keep plenty of them cached.
+        self.conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+        self.conn.executescript(SQLITE_SCHEMA)
+        if self._exists("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'winners'"):
+            # Winners used to be global: keep each one a winner of the campaigns they won in.
+            self.conn.execute(
+                "INSERT OR IGNORE INTO campaign_winners (prefix, user_id)"
+                " SELECT prefix, redeemed_by FROM codes WHERE redeemed = 1 AND redeemed_by IN (SELECT user_id FROM winners)"
+            )
+            self.conn.execute("DROP TABLE winners")
+        self.conn.commit()
+        self._seed_leaderboard()
+        self._seed_counters()
+        logger.info("Opened SQLite store %s", self.path)
+
+    def start(self) -> None:
+        self._commit_task = asyncio.create_task(self._commit_loop(), name="store-commit")
+
+    async def close(self) -> None:
+        if self._commit_task:
+            self._commit_task.cancel()
+            try:
+                await self._commit_task
+            except asyncio.CancelledError:
+                pass
+            self._commit_task = None
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    async def commit(self) -> None:
+        if self.conn.in_transaction:
+            start = time.perf_counter()
+            self.conn.commit()
+            metrics.observe("giveaway_store_flush_seconds", time.perf_counter() - start, kind="sqlite")
+
+    async def _commit_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.commit_interval)
+            await self.commit()
+
+    def _seed_leaderboard(self) -> None:
+        self.leaderboard.seed(self.conn.execute(
+            "SELECT id, user_id, username, score FROM leaderboard ORDER BY score DESC, id LIMIT ?", (self.leaderboard.size,)
+        ))
+
+    def _seed_counters(self) -> None:
+        """Count everything once; afterwards the counters are kept current by the mutations."""
+        self.counters = CodeCounters()
+        for prefix, total, redeemed in self.conn.execute("SELECT prefix, COUNT(*), SUM(redeemed) FROM codes GROUP BY prefix"):
+            self.counters.by_prefix[prefix] = [total, redeemed]
+            self.counters.total += total
+            self.counters.redeemed += redeemed
+        for table in self._counts:
+            self._counts[table] = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        self.archived = {
+            prefix: {"total": total, "redeemed": redeemed, "winners": winners}
+            for prefix, total, redeemed, winners in self.conn.execute("SELECT prefix, total, redeemed, winners FROM archived_campaigns")
+        }
+
+    def _count_change(self, table: str, delta: int, sql: str, *params) -> bool:
+        changed = self._changed(sql, *params)
+        if changed:
+            self._counts[table] += delta
+        return changed
+
+    def _exists(self, sql: str, *params) -> bool:
+        return self.conn.execute(sql, params).fetchone() is not None
+
+    def _changed(self, sql: str, *params) -> bool:
+        return self.conn.execute(sql, params).rowcount > 0
+
+    def import_data(self, data: Dict) -> None:
+        """Bulk-load a GiveawayStore.export_data() document (used by the migrate command).
+
+        A document from before campaigns, with all winners in "past_winners",
+        is accepted too.
+        """
+        c = self.conn
+        c.executemany(
+            "INSERT OR REPLACE INTO codes (code, prefix, redeemed, redeemed_by, redeemed_by_username, redeemed_at, prize, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (code, code_prefix(code), 1 if d.get("redeemed_by") else 0, *(d.get(col) for col in CODE_COLUMNS))
+                for code, d in data["codes"].items()
+            ),
+        )
+        c.executemany("INSERT OR IGNORE INTO users (user_id) VALUES (?)", ((uid,) for uid in data["users"]))
+        winners = data.get("winners")
+        if winners is None:
+            past, winners = data.get("past_winners", ()), {}
+            for code, d in data["codes"].items():
+                if d.get("redeemed_by") and d["redeemed_by"] in past:
+                    winners.setdefault(code_prefix(code), []).append(d["redeemed_by"])
+        c.executemany(
+            "INSERT OR IGNORE INTO campaign_winners (prefix, user_id) VALUES (?, ?)",
+            ((prefix, uid) for prefix, uids in winners.items() for uid in uids),
+        )
+        c.executemany("INSERT OR IGNORE INTO bans (user_id) VALUES (?)", ((uid,) for uid in data["banned_users"]))
+        c.executemany("INSERT OR IGNORE INTO awaiting_screenshot (user_id) VALUES (?)", ((uid,) for uid in data["awaiting_screenshot"]))
+        c.executemany(
+            "INSERT OR REPLACE INTO leaderboard (user_id, username, score) VALUES (?, ?, ?)",
+            ((int(uid), e.get("username"), e.get("score", 0)) for uid, e in data["leaderboard"].items()),
+        )
+        self._set_last_generated(data.get("last_generated_codes", []))
+        self._set_setting("broadcast", data.get("broadcast"))
+        for schedule in data.get("schedules", {}).values():
+            schedule = dict(schedule)
+            codes, prizes = schedule.pop("codes", None), schedule.pop("prizes", None)
+            if codes is not None:
+                self._insert_schedule_codes(schedule["id"], codes, prizes)
+                schedule["count"] = len(codes)
+            self._put_schedule(schedule)
+        for prefix in data.get("archived", {}):
+            while self._move_chunk(prefix, "codes", "archived_codes"):
+                pass
+            self._record_archived(prefix)
+        c.commit()
+        self._seed_leaderboard()
+        self._seed_counters()
+
+    # --- users ---
+
+    def user_ids(self) -> List[int]:
+        return [row[0] for row in self.conn.execute("SELECT user_id FROM users")]
+
+    def add_user(self, user_id: int) -> bool:
+        return self._count_change("users", 1, "INSERT OR IGNORE INTO users (user_id) VALUES (?)", user_id)
+
+    def remove_user(self, user_id: int) -> bool:
+        return self._count_change("users", -1, "DELETE FROM users WHERE user_id = ?", user_id)
+
+    def is_banned(self, user_id: int) -> bool:
+        return self._exists("SELECT 1 FROM bans WHERE user_id = ?", user_id)
+
+    def ban(self, user_id: int) -> bool:
+        return self._count_change("bans", 1, "INSERT OR IGNORE INTO bans (user_id) VALUES (?)", user_id)
+
+    def unban(self, user_id: int) -> bool:
+        return self._count_change("bans", -1, "DELETE FROM bans WHERE user_id = ?", user_id)
+
+    def is_awaiting_screenshot(self, user_id: int) -> bool:
+        return self._exists("SELECT 1 FROM awaiting_screenshot WHERE user_id = ?", user_id)
+
+    def screenshot_received(self, user_id: int) -> bool:
+        """Take the user off the awaiting list. Returns False if they were not on it."""
+        return self._count_change("awaiting_screenshot", -1, "DELETE FROM awaiting_screenshot WHERE user_id = ?", user_id)
+
+    # --- codes ---
+
+    def get_code(self, code: str) -> Optional[Dict]:
+        row = self.conn.execute(f"SELECT {', '.join(CODE_COLUMNS)} FROM codes WHERE code = ?", (code,)).fetchone()
+        return dict(zip(CODE_COLUMNS, row)) if row else None
+
+    def has_code(self, code: str) -> bool:
+        return self._exists("SELECT 1 FROM codes WHERE code = ?", code)
+
+    def is_archived(self, prefix: str) -> bool:
+        return prefix in self.archived or prefix in self.archiving
+
+    def add_code(self, code: str) -> bool:
+        """Add an unredeemed code. Returns False if it exists or its campaign is archived."""
+        if self.is_archived(code_prefix(code)):
+            return False
+        if not self._changed(
+            "INSERT OR IGNORE INTO codes (code, prefix, created_at) VALUES (?, ?, ?)",
+            code, code_prefix(code), datetime.now(timezone.utc).isoformat(),
+        ):
+            return False
+        self.counters.added(code)
+        return True
+
+    def add_codes(self, codes: List[str], prizes: Optional[Dict[str, str]] = None) -> List[str]:
+        """Insert many codes at once, optionally with their prizes.
+
+        Returns the codes that were new; codes of archived campaigns are skipped.
+        """
+        candidates = [code for code in dict.fromkeys(codes) if not self.is_archived(code_prefix(code))]
+        existing = set()
+        for i in range(0, len(candidates), SQLITE_MAX_PARAMS):
+            chunk = candidates[i:i + SQLITE_MAX_PARAMS]
+            existing.update(row[0] for row in self.conn.execute(
+                f"SELECT code FROM codes WHERE code IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        added = [code for code in candidates if code not in existing]
+        now_iso = datetime.now(timezone.utc).isoformat()
+        # Inserting in key order keeps B-tree page splits local.
+        self.conn.executemany(
+            "INSERT INTO codes (code, prefix, prize, created_at) VALUES (?, ?, ?, ?)",
+            ((code, code_prefix(code), (prizes or {}).get(code) or None, now_iso) for code in sorted(added)),
+        )
+        for code in added:
+            self.counters.added(code)
+        return added
+
+    def delete_code(self, code: str) -> bool:
+        row = self.conn.execute("SELECT redeemed FROM codes WHERE code = ?", (code,)).fetchone()
+        if row is None:
+            return False
+        self.conn.execute("DELETE FROM codes WHERE code = ?", (code,))
+        self.counters.removed(code, redeemed=bool(row[0]))
+        return True
+
+    def set_prize(self, code: str, prize: str) -> bool:
+        return self._changed("UPDATE codes SET prize = ? WHERE code = ?", prize, code)
+
+    def expire_codes(self, codes: Optional[List[str]] = None, prefix: Optional[str] = None) -> List[str]:
+        """Delete the unredeemed codes among `codes`, or all of campaign `prefix`. Returns the codes deleted."""
+        if prefix:
+            expired = [row[0] for row in self.conn.execute("SELECT code FROM codes WHERE redeemed = 0 AND prefix = ?", (prefix,))]
+        else:
+            candidates, expired = list(dict.fromkeys(codes or ())), []
+            for i in range(0, len(candidates), SQLITE_MAX_PARAMS):
+                chunk = candidates[i:i + SQLITE_MAX_PARAMS]
+                expired.extend(row[0] for row in self.conn.execute(
+                    f"SELECT code FROM codes WHERE redeemed = 0 AND code IN ({','.join('?' * len(chunk))})", chunk
+                ))
+        for i in range(0, len(expired), SQLITE_MAX_PARAMS):
+            chunk = expired[i:i + SQLITE_MAX_PARAMS]
+            self.conn.execute(f"DELETE FROM codes WHERE code IN ({','.join('?' * len(chunk))})", chunk)
+        for code in expired:
+            self.counters.removed(code, redeemed=False)
+        return expired
+
+    def last_generated_codes(self) -> List[str]:
+        return [row[0] for row in self.conn.execute("SELECT code FROM last_generated ORDER BY pos")]
+
+    async def set_last_generated(self, codes: List[str]) -> None:
+        """Replace the last_generated rows, a chunk per transaction so other updates keep running."""
+        self.conn.execute("DELETE FROM last_generated")
+        for start in range(0, len(codes), GENCODE_CHUNK):
+            self._insert_last_generated(codes[start:start + GENCODE_CHUNK], start)
+            await self.commit()
+            await asyncio.sleep(0)
+
+    def _set_last_generated(self, codes: List[str]) -> None:
+        self.conn.execute("DELETE FROM last_generated")
+        self._insert_last_generated(codes, 0)
+
+    def _insert_last_generated(self, codes: List[str], first_pos: int) -> None:
+        self.conn.executemany("INSERT INTO last_generated (pos, code) VALUES (?, ?)", enumerate(codes, first_pos))
+
+    def redeem_code(self, code: str, user_id: int, username: str) -> Tuple[str, Optional[Dict]]:
+        """Check and redeem a code in one step. Returns (outcome, code details).
+
+        Each user can win once per campaign. Both the user and the code are
+        claimed with compare-and-set statements inside a savepoint, so the
+        redemption stays atomic even if several processes share the database.
+        """
+        prefix = code_prefix(code)
+        if self.is_archived(prefix):
+            return REDEEM_CAMPAIGN_ARCHIVED, None
+        outcome, _ = self._redeem(prefix, user_id, username, "code = ?", code)
+        if outcome == REDEEM_UNKNOWN_CODE:
+            details = self.get_code(code)
+            return (REDEEM_ALREADY_REDEEMED, details) if details else (REDEEM_UNKNOWN_CODE, None)
+        return outcome, self.get_code(code) if outcome == REDEEM_OK else None
+
+    def claim_code(self, user_id: int, username: str, prefix: Optional[str] = None,
+                   prize: Optional[bool] = None) -> Tuple[str, Optional[str], Optional[Dict]]:
+        """Redeem the next available code for a user. Returns (outcome, code, code details).
+
+        Looks in campaign `prefix`, or in every campaign the user has not won
+        yet (in prefix order), optionally only codes with (True) or without
+        (False) a prize. The code is picked and updated by one statement,
+        an index seek on codes_claim, so concurrent claims never share one.
+        """
+        if prefix and self.is_archived(prefix):
+            return REDEEM_CAMPAIGN_ARCHIVED, None, None
+        pick = "SELECT code FROM codes WHERE redeemed = 0 AND prefix = ?"
+        if prize is None:
+            pick += " ORDER BY prize IS NULL, code LIMIT 1"
+        else:
+            pick += f" AND (prize IS NULL) = {int(not prize)} ORDER BY code LIMIT 1"
+        outcome = REDEEM_NONE_AVAILABLE
+        for p in [prefix] if prefix else sorted(self.counters.by_prefix):
+            total, redeemed = self.counters.by_prefix.get(p, (0, 0))
+            if total == redeemed or p in self.archiving:
+                continue
+            result, code = self._redeem(p, user_id, username, f"code = ({pick})", p)
+            if result == REDEEM_OK:
+                return REDEEM_OK, code, self.get_code(code)
+            if result == REDEEM_ALREADY_WON:
+                outcome = REDEEM_ALREADY_WON
+        return outcome, None, None
+
+    def _redeem(self, prefix: str, user_id: int, username: str, where: str, *params) -> Tuple[str, Optional[str]]:
+        """Redeem the unredeemed code of campaign `prefix` matching `where` for a user.
+
+        Returns (REDEEM_OK, code), (REDEEM_ALREADY_WON, None), or
+        (REDEEM_UNKNOWN_CODE, None) if no unredeemed code matched.
+        """
+        c = self.conn
+        if not c.in_transaction:
+            c.execute("BEGIN")
+        c.execute("SAVEPOINT redeem")
+        # Claim the user first: a second concurrent redemption finds the row.
+        if not self._changed("INSERT OR IGNORE INTO campaign_winners (prefix, user_id) VALUES (?, ?)", prefix, user_id):
+            c.execute("RELEASE redeem")
+            return REDEEM_ALREADY_WON, None
+        now_iso = datetime.now(timezone.utc).isoformat()
+        # Then the code: only an unredeemed row is updated.
+        row = c.execute(
+            "UPDATE codes SET redeemed = 1, redeemed_by = ?, redeemed_by_username = ?, redeemed_at = ?"
+            f" WHERE {where} AND redeemed = 0 RETURNING code",
+            (user_id, username, now_iso, *params),
+        ).fetchall()
+        if not row:
+            c.execute("ROLLBACK TO redeem")
+            c.execute("RELEASE redeem")
+            return REDEEM_UNKNOWN_CODE, None
+        code = row[0][0]
+        c.execute(
+            "INSERT INTO leaderboard (user_id, username, score) VALUES (?, ?, 1)"
+            " ON CONFLICT (user_id) DO UPDATE SET score = score + 1",
+            (user_id, username),
+        )
+        self.leaderboard.update(*c.execute("SELECT id, user_id, username, score FROM leaderboard WHERE user_id = ?", (user_id,)).fetchone())
+        self._count_change("awaiting_screenshot", 1, "INSERT OR IGNORE INTO awaiting_screenshot (user_id) VALUES (?)", user_id)
+        c.execute("RELEASE redeem")
+        self.counters.redeemed_one(code)
+        self.redemption_rate.hit()
+        return REDEEM_OK, code
+
+    def reset_winners(self, prefix: Optional[str] = None) -> None:
+        """Let past winners win again, in one campaign or in all of them."""
+        if prefix:
+            self.conn.execute("DELETE FROM campaign_winners WHERE prefix = ?", (prefix,))
+        else:
+            self.conn.execute("DELETE FROM campaign_winners")
+
+    # --- campaigns ---
+
+    def _move_chunk(self, prefix: str, source: str, target: str) -> int:
+        """Move up to SQLITE_MOVE_CHUNK codes of a campaign between codes and archived_codes."""
+        keys = [row[0] for row in self.conn.execute(
+            # "redeemed IN (0, 1)" lets the codes table use its (redeemed, prefix, code) index.
+            f"SELECT code FROM {source} WHERE redeemed IN (0, 1) AND prefix = ? LIMIT ?", (prefix, SQLITE_MOVE_CHUNK)
+        )]
+        for i in range(0, len(keys), SQLITE_MAX_PARAMS):
+            chunk = keys[i:i + SQLITE_MAX_PARAMS]
+            marks = ",".join("?" * len(chunk))
+            self.conn.execute(f"INSERT OR REPLACE INTO {target} SELECT {ALL_CODE_COLUMNS} FROM {source} WHERE code IN ({marks})", chunk)
+            self.conn.execute(f"DELETE FROM {source} WHERE code IN ({marks})", chunk)
+        return len(keys)
+
+    def _record_archived(self, prefix: str) -> None:
+        total, redeemed = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(redeemed), 0) FROM archived_codes WHERE prefix = ?", (prefix,)
+        ).fetchone()
+        winners = self.conn.execute("SELECT COUNT(*) FROM campaign_winners WHERE prefix = ?", (prefix,)).fetchone()[0]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO archived_campaigns (prefix, total, redeemed, winners) VALUES (?, ?, ?, ?)",
+            (prefix, total, redeemed, winners),
+        )
+        self.archived[prefix] = {"total": total, "redeemed": redeemed, "winners": winners}
+        self.counters.by_prefix.pop(prefix, None)
+        self.counters.total -= total
+        self.counters.redeemed -= redeemed
+
+    async def archive_campaign(self, prefix: str) -> bool:
+        """Move a campaign's codes to archived_codes. Returns False if it has none.
+
+        Its codes can no longer be redeemed or added to until
+        unarchive_campaign(); /stats keeps showing its final counts. Codes
+        move in chunks, one transaction each, so other updates keep running.
+        """
+        if self.is_archived(prefix) or prefix not in self.counters.by_prefix:
+            return False
+        # Closed before the first chunk moves, so redeeming a moved code reports
+        # the archived campaign rather than an unknown code (and a guess strike).
+        self.archiving.add(prefix)
+        try:
+            while self._move_chunk(prefix, "codes", "archived_codes"):
+                await self.commit()
+                await asyncio.sleep(0)
+            # Nothing is left in codes, and nothing can be added once it is marked archived.
+            self._record_archived(prefix)
+        finally:
+            self.archiving.discard(prefix)
+        await self.commit()
+        return True
+
+    async def unarchive_campaign(self, prefix: str) -> bool:
+        """Move an archived campaign's codes back. Returns False if it is not archived."""
+        if prefix not in self.archived:
+            return False
+        while self._move_chunk(prefix, "archived_codes", "codes"):
+            await self.commit()
+            await asyncio.sleep(0)
+        self.conn.execute("DELETE FROM archived_campaigns WHERE prefix = ?", (prefix,))
+        del self.archived[prefix]
+        total, redeemed = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(redeemed), 0) FROM codes WHERE redeemed IN (0, 1) AND prefix = ?", (prefix,)
+        ).fetchone()
+        if total:
+            self.counters.by_prefix[prefix] = [total, redeemed]
+            self.counters.total += total
+            self.counters.redeemed += redeemed
+        await self.commit()
+        return True
+
+    # --- settings ---
+
+    def _get_setting(self, key: str):
+        row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_setting(self, key: str, value) -> None:
+        if value is None:
+            self.conn.execute("DELETE FROM settings WHERE key = ?", (key,))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def broadcast_state(self) -> Optional[Dict]:
+        return self._get_setting("broadcast")
+
+    # --- schedules ---
+
+    def schedules(self) -> List[Dict]:
+        return [json.loads(row[0]) for row in self.conn.execute("SELECT doc FROM schedules")]
+
+    def count_schedules(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM schedules").fetchone()[0]
+
+    def get_schedule(self, schedule_id: str) -> Optional[Dict]:
+        row = self.conn.execute("SELECT doc FROM schedules WHERE id = ?", (schedule_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def schedule_codes(self, schedule_id: str) -> Tuple[List[str], Dict[str, str]]:
+        """The codes (and their prizes) a schedule releases or expires."""
+        schedule = self.get_schedule(schedule_id) or {}
+        if "codes" in schedule:  # stored before code lists moved to schedule_codes
+            return schedule["codes"], schedule.get("prizes") or {}
+        rows = self.conn.execute("SELECT code, prize FROM schedule_codes WHERE schedule_id = ?", (schedule_id,)).fetchall()
+        return [code for code, _ in rows], {code: prize for code, prize in rows if prize}
+
+    async def add_schedule(self, schedule: Dict, codes: Optional[List[str]] = None, prizes: Optional[Dict[str, str]] = None) -> None:
+        """Persist a schedule. Its codes go to schedule_codes, one row each, a chunk per transaction."""
+        if codes is not None:
+            # Sorted as a whole, each chunk appends to the end of the index
+            # instead of touching pages all over it. One sorted() call would
+            # hold the GIL throughout, so chunks are sorted and then merged.
+            ordered = await asyncio.to_thread(lambda: list(heapq.merge(
+                *(sorted(codes[start:start + SQLITE_MOVE_CHUNK]) for start in range(0, len(codes), SQLITE_MOVE_CHUNK))
+            )))
+            for start in range(0, len(ordered), SQLITE_MOVE_CHUNK):
+                self._insert_schedule_codes(schedule["id"], ordered[start:start + SQLITE_MOVE_CHUNK], prizes)
+                await self.commit()
+                await asyncio.sleep(0)
+            schedule = {**schedule, "count": len(codes)}
+        self._put_schedule(schedule)
+
+    def _put_schedule(self, schedule: Dict) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO schedules (id, doc) VALUES (?, ?)", (schedule["id"], json.dumps(schedule)))
+
+    def _insert_schedule_codes(self, schedule_id: str, codes: List[str], prizes: Optional[Dict[str, str]]) -> None:
+        prizes = prizes or {}
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO schedule_codes (schedule_id, code, prize) VALUES (?, ?, ?)",
+            # In key order, which keeps large inserts into the index cheap.
+            ((schedule_id, code, prizes.get(code)) for code in sorted(codes)),
+        )
+
+    def remove_schedule(self, schedule_id: str) -> bool:
+        self.conn.execute("DELETE FROM schedule_codes WHERE schedule_id = ?", (schedule_id,))
+        return self._changed("DELETE FROM schedules WHERE id = ?", schedule_id)
+
+    def set_broadcast_state(self, state: Optional[Dict]) -> None:
+        self._set_setting("broadcast", state)
+
+    # --- reporting ---
+
+    def stats(self) -> Dict:
+        """Current counters; constant time in the number of codes and users."""
+        return {
+            "total_codes": self.counters.total,
+            "redeemed": self.counters.redeemed,
+            "available": self.counters.total - self.counters.redeemed,
+            "users": self._counts["users"],
+            "banned": self._counts["bans"],
+            "awaiting": self._counts["awaiting_screenshot"],
+            "redemptions_last_minute": self.redemption_rate.count(),
+            "prefixes": {prefix: tuple(counts) for prefix, counts in self.counters.by_prefix.items()},
+            "archived": {prefix: (s["total"], s["redeemed"]) for prefix, s in self.archived.items()},
+        }
+
+    def campaign_stats(self, prefix: str) -> Optional[Dict]:
+        """Counts for one campaign (archived ones included), or None if there is no such campaign."""
+        if prefix in self.archived:
+            s = self.archived[prefix]
+            return {**s, "available": s["total"] - s["redeemed"], "with_prize": None, "archived": True}
+        if prefix not in self.counters.by_prefix:
+            return None
+        total, redeemed = self.counters.by_prefix[prefix]
+        return {
+            "total": total,
+            "redeemed": redeemed,
+            "winners": self.conn.execute("SELECT COUNT(*) FROM campaign_winners WHERE prefix = ?", (prefix,)).fetchone()[0],
+            "available": total - redeemed,
+            "with_prize": self.count_available(prefix, True),
+            "archived": False,
+        }
+
+    @staticmethod
+    def _available_query(prefix: Optional[str], prize: Optional[bool]) -> Tuple[str, list]:
+        sql, params = " FROM codes WHERE redeemed = 0", []
+        if prefix:
+            sql += " AND prefix = ?"
+            params.append(prefix)
+        if prize is not None:
+            sql += " AND prize IS NOT NULL" if prize else " AND prize IS NULL"
+        return sql, params
+
+    def count_available(self, prefix: Optional[str] = None, prize: Optional[bool] = None) -> int:
+        """Unredeemed codes, optionally only one prefix and only with (True) or without (False) a prize."""
+        if prize is None:
+            total, redeemed = self.counters.by_prefix.get(prefix, (0, 0)) if prefix else (self.counters.total, self.counters.redeemed)
+            return total - redeemed
+        sql, params = self._available_query(prefix, prize)
+        return self.conn.execute("SELECT COUNT(*)" + sql, params).fetchone()[0]
+
+    def available_codes(
+        self, prefix: Optional[str] = None, prize: Optional[bool] = None, cursor: Optional[str] = None, limit: int = 50, backwards: bool = False
+    ) -> List[Tuple[str, Optional[str]]]:
+        """Up to `limit` unredeemed codes in (prefix, code) order following `cursor`, or the ones just before it if `backwards`.
+
+        The cursor is a seek on codes_available, so any page costs the same.
+        """
+        sql, params = self._available_query(prefix, prize)
+        if cursor is not None:
+            if prefix:
+                sql += " AND code < ?" if backwards else " AND code > ?"
+                params.append(cursor)
+            else:
+                sql += " AND (prefix, code) < (?, ?)" if backwards else " AND (prefix, code) > (?, ?)"
+                params += [code_prefix(cursor), cursor]
+        order = " ORDER BY prefix DESC, code DESC" if backwards else " ORDER BY prefix, code"
+        rows = self.conn.execute("SELECT code, prize" + sql + order + " LIMIT ?", (*params, limit)).fetchall()
+        return rows[::-1] if backwards else rows
+
+    def export_available(self, prefix: Optional[str] = None, prize: Optional[bool] = None) -> Iterator[Tuple[str, Optional[str]]]:
+        """Iterator of (code, prize) that may be consumed from a worker thread (uses its own connection)."""
+        sql, params = self._available_query(prefix, prize)
+
+        def rows():
+            conn = sqlite3.connect(self.path)
+            try:
+                yield from conn.execute("SELECT code, prize" + sql + " ORDER BY prefix, code", params)
+            finally:
+                conn.close()
+
+        return rows()
+
+
+Store = Union[GiveawayStore, SqliteStore]
+
+
+def create_store() -> Store:
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore()
+    return GiveawayStore()
+
+
+def get_store(context: ContextTypes.DEFAULT_TYPE) -> Store:
+    return context.bot_data["store"]
+
+
+def get_store_from_app(app: Application) -> Store:
+    return app.bot_data["store"]
 
 
 # ---------------------------
@@ -102,16 +2245,28 @@ def validate_code_format(code: str) -> bool:
     return bool(CODE_REGEX.match(code))
 
 
-def initialize_code_details() -> Dict:
+def initialize_code_details(created_at: Optional[str] = None) -> Dict:
     return {
         "redeemed_by": None,
         "redeemed_by_username": None,
         "redeemed_at": None,
         "prize": None,
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": created_at or datetime.now(timezone.utc).isoformat(),
     }
 
 
+def spawn_background(coro, name: str) -> asyncio.Task:
+    """Run a long-lived coroutine in the background, logging it if it crashes."""
+
+    def log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Background task %s failed", name, exc_info=task.exception())
+
+    task = asyncio.create_task(coro, name=name)
+    task.add_done_callback(log_failure)
+    return task
+
+
 def user_handle(user) -> str:
     if getattr(user, "username", None):
         return f"@{user.username}"
@@ -126,33 +2281,164 @@ def user_handle(user) -> str:
 def admin_only(func):
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user = update.effective_user
-        if not user:
+        user_ctx = get_user_context(update, context)
+        if not user_ctx:
             return
-        if user.id not in ADMIN_IDS:
+        if not user_ctx.admin:
             if update.message:
                 await update.message.reply_text("❌ Sorry, this is an admin-only command.")
+            elif update.callback_query:
+                # Otherwise the button keeps spinning until Telegram times it out.
+                await update.callback_query.answer("❌ Sorry, this is for admins only.")
             return
         return await func(update, context, *args, **kwargs)
 
     return wrapper
 
 
-def check_banned(func):
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+# ---------------------------
+# Per-update gate
+# ---------------------------
+
+
+class UserContext:
+    """What the bot knows about the sender of one update.
+
+    Built once per update by resolve_user_context(). Membership is looked up
+    lazily, at most once, and only by handlers that require it.
+    """
+
+    __slots__ = ("user_id", "admin", "banned", "_member")
+
+    def __init__(self, user_id: int, admin: bool, banned: bool):
+        self.user_id = user_id
+        self.admin = admin
+        self.banned = banned
+        self._member: Optional[bool] = None
+
+    async def is_member(self, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        if self._member is None:
+            self._member = await is_member(self.user_id, context)
+        return self._member
+
+
+def get_user_context(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[UserContext]:
+    """Return the gate's UserContext for this update, building it if the gate did not run."""
+    user_ctx = getattr(context, "user_context", None)
+    if user_ctx is None or user_ctx.user_id != getattr(update.effective_user, "id", None):
         user = update.effective_user
         if not user:
-            return
-        data = load_data()
-        if user.id in data.get("banned_users", []):
-            # reply using message if available else silent
-            if update.message:
-                await update.message.reply_text("🚫 You are banned from using this bot.")
-            return
-        return await func(update, context, *args, **kwargs)
+            return None
+        user_ctx = UserContext(user.id, admin=user.id in ADMIN_IDS, banned=get_store(context).is_banned(user.id))
+        context.user_context = user_ctx
+    return user_ctx
+
+
+async def resolve_user_context(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Group -1 gate: drop spam, resolve the sender once and stop banned users before any handler runs."""
+    user = update.effective_user
+    # Silently: replying would spend API quota on the spammer.
+    if user and update.effective_message and user.id not in ADMIN_IDS and not get_spam_guard(context).allow(user.id):
+        raise ApplicationHandlerStop
+    user_ctx = get_user_context(update, context)
+    # chat_member updates carry no message and must still reach the membership tracker.
+    if not user_ctx or not update.effective_message:
+        return
+    if user_ctx.banned and not user_ctx.admin:
+        if update.message:
+            await update.message.reply_text("🚫 You are banned from using this bot.")
+        raise ApplicationHandlerStop
+
+
+# ---------------------------
+# Spam guard
+# ---------------------------
+
+
+class RateLimiter:
+    """Per-key sliding-window rate limit over a bounded LRU of keys.
+
+    Uses the sliding window counter approximation: each key keeps only the
+    start of its current fixed window, that window's count and the previous
+    window's count, which is weighted by how much of it still overlaps the
+    sliding window. The least recently seen key is evicted first; an evicted
+    key simply starts over.
+    """
+
+    def __init__(self, limit: int, window: float, max_keys: int = SPAM_TRACKED_USERS):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._entries: "OrderedDict[int, List[float]]" = OrderedDict()
+
+    def hit(self, key: int, now: Optional[float] = None) -> bool:
+        """Count one event for `key`; returns False (and counts nothing) if over the limit."""
+        now = time.monotonic() if now is None else now
+        start = now - now % self.window
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [start, 0, 0]
+            if len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+            if entry[0] != start:
+                entry[2] = entry[1] if start - entry[0] == self.window else 0
+                entry[0], entry[1] = start, 0
+        if entry[2] * (1 - (now - start) / self.window) + entry[1] >= self.limit:
+            return False
+        entry[1] += 1
+        return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SpamGuard:
+    """Message flood limit and temporary bans for users who keep guessing codes.
+
+    Everything is in memory, so the gate can drop spam before any storage
+    or Bot API access. Temporary bans are not persisted.
+    """
+
+    def __init__(self):
+        self.messages = RateLimiter(RATE_LIMIT_MESSAGES, RATE_LIMIT_WINDOW)
+        self.guesses = RateLimiter(GUESS_LIMIT, GUESS_WINDOW)
+        self._banned_until: "OrderedDict[int, float]" = OrderedDict()
+
+    def allow(self, user_id: int) -> bool:
+        """Whether to process a message from `user_id` at all."""
+        until = self._banned_until.get(user_id)
+        if until is not None:
+            if until > time.monotonic():
+                metrics.inc("giveaway_spam_rejected_total", reason="banned")
+                return False
+            del self._banned_until[user_id]
+        if not self.messages.hit(user_id):
+            metrics.inc("giveaway_spam_rejected_total", reason="flood")
+            return False
+        return True
+
+    def failed_guess(self, user_id: int) -> bool:
+        """Record a guess of a code that does not exist. Returns True if it got the user banned."""
+        if self.guesses.hit(user_id):
+            return False
+        # Bans all have the same length, so the oldest one expires first.
+        self._banned_until[user_id] = time.monotonic() + GUESS_BAN_SECONDS
+        self._banned_until.move_to_end(user_id)
+        if len(self._banned_until) > SPAM_TRACKED_USERS:
+            self._banned_until.popitem(last=False)
+        metrics.inc("giveaway_temp_bans_total")
+        return True
+
+    def active_bans(self) -> int:
+        now = time.monotonic()
+        return sum(1 for until in self._banned_until.values() if until > now)
+
+
+def get_spam_guard(context: ContextTypes.DEFAULT_TYPE) -> SpamGuard:
+    return context.bot_data["spam_guard"]
 
-    return wrapper
 
 # ---------------------------
 # Channel join decorator fix
@@ -160,60 +2446,319 @@ def check_banned(func):
 
 CHANNEL_INVITE_URL = "https://t.me/+0D7P8f5MVdkzMGY1"  # your channel invite link
 
+NON_MEMBER_STATUSES = ("left", "kicked")
+
+
+class MembershipCache:
+    """Bounded LRU cache of channel membership results.
+
+    Members are cached for positive_ttl seconds and non-members for the
+    (shorter) negative_ttl, so a user who just joined is not kept waiting.
+    """
+
+    def __init__(self, max_size: int = MEMBERSHIP_CACHE_SIZE, positive_ttl: float = MEMBER_TTL, negative_ttl: float = NON_MEMBER_TTL):
+        self.max_size = max_size
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.inflight: Dict[int, asyncio.Future] = {}
+        self._entries: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[bool]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id: int, is_member: bool) -> None:
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self._entries.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+
 def channel_required(func):
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user_id = update.effective_user.id
-        if not await is_member(user_id, context):
+        user_ctx = get_user_context(update, context)
+        if not user_ctx:
+            return
+        if not await user_ctx.is_member(context):
             keyboard = InlineKeyboardMarkup([[
                 InlineKeyboardButton("🎵 Join Channel", url=CHANNEL_INVITE_URL)
             ]])
-            await update.message.reply_text(
-                "❌ You must join our channel first!\nAfter joining, press /start again.",
-                reply_markup=keyboard
-            )
+            if update.message:
+                await update.message.reply_text(
+                    "❌ You must join our channel first!\nAfter joining, press /start again.",
+                    reply_markup=keyboard
+                )
             return
         return await func(update, context, *args, **kwargs)  # forward args/kwargs
     return wrapper
 
 
-def check_banned(func):
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user = update.effective_user
-        if not user:
+# ---------------------------
+# Admin notifications
+# ---------------------------
+
+
+class AdminNotifier:
+    """Queue of admin notifications drained by a background worker.
+
+    Handlers enqueue and return immediately; the worker delivers each
+    notification to all admins concurrently. With a digest window, the
+    redemptions that arrive within the window are collapsed into one
+    summary message per admin.
+    """
+
+    def __init__(self, bot, digest_window: float = ADMIN_DIGEST_WINDOW):
+        self.bot = bot
+        self.digest_window = digest_window
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._digest: List[Dict] = []
+        self._digest_deadline = 0.0
+        self._sending = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        self._deliveries: set = set()
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._worker = spawn_background(self._run(), "admin-notifier")
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Deliver what is still queued (bounded by `timeout`) and stop the worker."""
+        if self._worker is None:
             return
-        data = load_data()
-        if user.id in data.get("banned_users", []):
-            if update.message:
-                await update.message.reply_text("🚫 You are banned from using this bot.")
+        self.queue.put_nowait(None)  # sentinel
+        try:
+            await asyncio.wait_for(asyncio.shield(self._worker), timeout)
+            if self._deliveries:
+                await asyncio.wait(self._deliveries, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d undelivered admin notifications", self.queue.qsize() + len(self._digest))
+            self._worker.cancel()
+        self._worker = None
+
+    def _enqueue(self, item: Dict) -> None:
+        if self.queue.qsize() >= NOTIFY_QUEUE_SIZE:
+            logger.warning("Admin notification queue full, dropping %s notification", item["kind"])
             return
-        return await func(update, context, *args, **kwargs)  # forward args/kwargs
-    return wrapper
-   
+        self.queue.put_nowait(item)
+
+    def redeemed(self, user_name: str, code: str, prize_text: str, at: str) -> None:
+        self._enqueue({"kind": "redeemed", "user": user_name, "code": code, "prize": prize_text, "at": at})
+
+    def forward(self, from_chat_id: int, message_id: int, text: str) -> None:
+        """Forward a user's message to the admins, followed by an explanatory text."""
+        self._enqueue({"kind": "forward", "from_chat_id": from_chat_id, "message_id": message_id, "text": text})
+
+    def notice(self, text: str) -> None:
+        self._enqueue({"kind": "notice", "text": text})
+
+    async def _run(self) -> None:
+        bulk_priority()
+        while True:
+            timeout = None
+            if self._digest:
+                timeout = max(0.0, self._digest_deadline - time.monotonic())
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                self._dispatch(self._digest_text())
+                continue
+            if item is None:
+                if self._digest:
+                    self._dispatch(self._digest_text())
+                return
+            if item["kind"] == "redeemed" and self.digest_window > 0:
+                if not self._digest:
+                    self._digest_deadline = time.monotonic() + self.digest_window
+                self._digest.append(item)
+            elif item["kind"] == "redeemed":
+                self._dispatch(redemption_notification(item))
+            else:
+                self._dispatch(item["text"], forward=item if item["kind"] == "forward" else None)
+
+    def _digest_text(self) -> str:
+        items, self._digest = self._digest, []
+        if len(items) == 1:
+            return redemption_notification(items[0])
+        lines = [f"🔥 {len(items)} prizes redeemed in the last {self.digest_window:g}s 🔥\n"]
+        for item in items[:DIGEST_MAX_LINES]:
+            lines.append(f"• {item['user']} — {item['code']} — {item['prize']}")
+        if len(items) > DIGEST_MAX_LINES:
+            lines.append(f"…and {len(items) - DIGEST_MAX_LINES} more")
+        return "\n".join(lines)
+
+    def _dispatch(self, text: str, forward: Optional[Dict] = None) -> None:
+        task = asyncio.create_task(self._deliver(text, forward))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, text: str, forward: Optional[Dict]) -> None:
+        async with self._sending:
+            await asyncio.gather(*(self._deliver_to(admin_id, text, forward) for admin_id in ADMIN_IDS))
+
+    async def _deliver_to(self, admin_id: int, text: str, forward: Optional[Dict]) -> None:
+        try:
+            if forward:
+                await self.bot.forward_message(chat_id=admin_id, from_chat_id=forward["from_chat_id"], message_id=forward["message_id"])
+            await self.bot.send_message(chat_id=admin_id, text=text)
+        except Exception as e:
+            logger.warning("Failed to notify admin %s: %s", admin_id, e)
+
+
+def redemption_notification(item: Dict) -> str:
+    return (
+        f"🔥 Prize Redeemed! 🔥\n\n"
+        f"User: {item['user']}\n"
+        f"Code: {item['code']}\n"
+        f"Prize: {item['prize']}\n"
+        f"Time(UTC): {item['at']}\n"
+    )
+
+
+def get_notifier(context: ContextTypes.DEFAULT_TYPE) -> AdminNotifier:
+    return context.bot_data["notifier"]
+
+
+# ---------------------------
+# Redemption admission queue
+# ---------------------------
+
+
+class RedemptionQueue:
+    """Bounded FIFO of redemptions served by a fixed number of workers.
+
+    Handlers only validate the code and enqueue it, so a flash drop cannot
+    pile thousands of concurrent store commits and replies onto the loop.
+    Codes start in arrival order; one queued far enough back gets a short
+    acknowledgement, and when the queue is full new codes are turned
+    away instead of waiting without bound. Each user may have one code
+    queued at a time.
+    """
+
+    def __init__(self, workers: int = REDEMPTION_WORKERS, max_size: int = REDEMPTION_QUEUE_SIZE,
+                 ack_position: int = REDEMPTION_ACK_POSITION):
+        self.workers = workers
+        self.ack_position = ack_position
+        self.queue: asyncio.Queue = asyncio.Queue(max_size)
+        self.busy = 0
+        self._pending: set = set()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [spawn_background(self._run(), f"redemption-worker-{n}") for n in range(self.workers)]
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Finish the queued redemptions (bounded by `timeout`) and stop the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d queued redemptions", self.queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, user_id: int, job: Callable[[], Awaitable[None]]) -> Optional[str]:
+        """Queue a redemption (or claim) of `user_id`. Returns None if accepted, else why not ("pending" or "full")."""
+        if user_id in self._pending:
+            reason = "pending"
+        elif self.queue.full():
+            reason = "full"
+        else:
+            self._pending.add(user_id)
+            self.queue.put_nowait((time.monotonic(), user_id, job))
+            return None
+        metrics.inc("giveaway_redemptions_shed_total", reason=reason)
+        return reason
+
+    def position(self) -> int:
+        """How many queued redemptions are ahead of a worker picking up the newest one."""
+        return max(0, self.queue.qsize() - (self.workers - self.busy))
+
+    async def _run(self) -> None:
+        while True:
+            queued_at, user_id, job = await self.queue.get()
+            self.busy += 1
+            metrics.observe("giveaway_redemption_wait_seconds", time.monotonic() - queued_at)
+            try:
+                await job()
+            except Exception:
+                logger.exception("Redemption for user %s failed", user_id)
+            finally:
+                metrics.observe("giveaway_redemption_seconds", time.monotonic() - queued_at)
+                self.busy -= 1
+                self._pending.discard(user_id)
+                self.queue.task_done()
+
+
+def get_redemption_queue(context: ContextTypes.DEFAULT_TYPE) -> RedemptionQueue:
+    return context.bot_data["redemption_queue"]
+
+
 # ---------------------------
 # Core Handlers
 # ---------------------------
 
 
 async def is_member(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    cache: MembershipCache = context.bot_data["membership_cache"]
+    cached = cache.get(user_id)
+    if cached is not None:
+        return cached
+    # Concurrent updates from the same user share one API call.
+    pending = cache.inflight.get(user_id)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    pending = cache.inflight[user_id] = asyncio.get_running_loop().create_future()
+    result = False
     try:
         member = await context.bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
-        return member.status not in ["left", "kicked"]
+        result = member.status not in NON_MEMBER_STATUSES
+        cache.set(user_id, result)
     except Exception:
-        return False
+        # Not cached: a transient API failure should not lock the user out for long.
+        pass
+    finally:
+        del cache.inflight[user_id]
+        pending.set_result(result)
+    return result
+
+
+async def track_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keep the membership cache current from chat_member updates of REQUIRED_CHANNEL."""
+    change = update.chat_member
+    if change is None:
+        return
+    context.bot_data["membership_cache"].set(
+        change.new_chat_member.user.id,
+        change.new_chat_member.status not in NON_MEMBER_STATUSES,
+    )
 
-@check_banned
 @channel_required
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user:
         return
 
-    data = load_data()
-    if user.id not in data["users"]:
-        data["users"].append(user.id)
-        save_data(data)
+    get_store(context).add_user(user.id)
 
     welcome_message = (
         "☁️ *WELCOME TO FIESTA VAULT GIVEWAY BOT* ☁️\n\n"
@@ -231,11 +2776,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_markdown(welcome_message, reply_markup=reply_markup)
 
 
-@check_banned
 @channel_required
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-
     # ---------------- USER HELP ----------------
     user_help = (
         "*Available Commands*\n\n"
@@ -243,29 +2785,38 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/start - Show welcome menu\n"
         "/help - Show this message\n"
         "/redeem <CODE> - Redeem a giveaway code\n"
+        "/claim [PREFIX] - Get the next available code\n"
         "/leaderboard - Show top winners\n"
     )
 
     # ---------------- ADMIN HELP ----------------
     admin_help = (
         "\n*Admin Commands* (admins only)\n"
-        "/stats - Show basic stats\n"
-        "/listcodes - List all codes and status\n"
+        "/stats [PREFIX] - Show basic stats, or one campaign's\n"
+        "/listcodes [PREFIX] [prize|noprize] [export [gz]] - Browse or export available codes\n"
         "/addcode <CODE1> [CODE2]... - Add codes\n"
         "/addprize <CODE> <prize text> - Assign prize to a code\n"
         "/delcode <CODE1> [CODE2]... - Delete codes\n"
         "/gencode <amount> <prefix> - Generate codes\n"
-        "/resetgiveaway - Reset past winners\n"
+        "/resetgiveaway [PREFIX] - Reset past winners (of one campaign)\n"
+        "/archive <PREFIX> - End a campaign and archive its codes\n"
+        "/unarchive <PREFIX> - Reactivate an archived campaign\n"
+        "/drop <amount> <prefix> <when> [lifetime] - Generate codes that go live later\n"
+        "/expire <PREFIX or CODE...> <when> - Expire unredeemed codes later\n"
+        "/schedules - List scheduled drops and expiries\n"
+        "/unschedule <id> - Cancel a scheduled drop or expiry\n"
         "/broadcast <message> - Broadcast to all users\n"
         "/ban <user_id> - Ban a user\n"
         "/unban <user_id> - Unban a user\n"
         "/stopbot - Stop the bot\n\n"
         "Admins can upload a .txt file with prizes to assign to the last generated codes, "
-        "or send prize lines directly in chat."
+        "or send prize lines directly in chat.\n"
+        "To import codes, upload a .csv file (CODE or CODE,PRIZE per line, .gz allowed), "
+        "or a .txt file with the caption `import`."
     )
 
     # If admin → show both menus
-    if user_id in ADMIN_IDS:
+    if get_user_context(update, context).admin:
         await update.message.reply_markdown(user_help + admin_help)
 
     # If normal user → only user commands
@@ -273,7 +2824,6 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_markdown(user_help)
 
 
-@check_banned
 @channel_required
 async def redeem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
@@ -284,24 +2834,52 @@ async def redeem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await process_redemption(update, context, code)
 
 
-@check_banned
+# /claim tiers: only codes with or without a prize
+CLAIM_TIERS = {"prize": True, "noprize": False}
+
+
 @channel_required
-async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = load_data()
-    lb = data.get("leaderboard", {})
-    if not lb:
-        await update.message.reply_text("🏆 Leaderboard is empty.")
+async def claim(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/claim [PREFIX] [prize|noprize] - get the next available code."""
+    prefix, prize = None, None
+    for arg in context.args or []:
+        if arg.lower() in CLAIM_TIERS:
+            prize = CLAIM_TIERS[arg.lower()]
+        elif re.fullmatch(r"[A-Za-z0-9]+", arg):
+            prefix = arg.upper()
+        else:
+            await update.message.reply_text("❌ Usage: /claim [PREFIX] [prize|noprize]")
+            return
+    if not update.effective_user:
         return
-    sorted_lb = sorted(lb.items(), key=lambda kv: kv[1]["score"], reverse=True)
+    await enqueue_redemption(update, context, partial(complete_claim, update, context, prefix, prize))
+
+
+def render_leaderboard(board: LeaderboardTop) -> Optional[str]:
+    top = board.entries()
+    if not top:
+        return None
     text_lines = ["🏆 *Giveaway Leaderboard* 🏆\n"]
-    for i, (uid, info) in enumerate(sorted_lb[:20], start=1):
+    for i, (username, score) in enumerate(top, start=1):
         medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else ""
-        text_lines.append(f"{medal} {info.get('username','User')} — {info.get('score',0)}")
-    await update.message.reply_markdown("\n".join(text_lines))
+        text_lines.append(f"{medal} {username} — {score}")
+    return "\n".join(text_lines)
 
 
-@check_banned
 @channel_required
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    board = get_store(context).leaderboard
+    # Re-rendered only when the visible top changes.
+    cached = context.bot_data.get("leaderboard_text")
+    if cached is None or cached[0] != board.version:
+        cached = context.bot_data["leaderboard_text"] = (board.version, render_leaderboard(board))
+    text = cached[1]
+    if text is None:
+        await update.message.reply_text("🏆 Leaderboard is empty.")
+        return
+    await update.message.reply_markdown(text)
+
+
 async def process_redemption(update: Update, context: ContextTypes.DEFAULT_TYPE, code: Optional[str] = None):
     if not code:
         if not update.message or not update.message.text:
@@ -312,47 +2890,81 @@ async def process_redemption(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await update.message.reply_text("❌ Invalid code format. Expected: NETFLIX-XXXX-XXXX-XXXX")
         return
 
-    user = update.effective_user
-    if not user:
+    if not update.effective_user:
         return
+    await enqueue_redemption(update, context, partial(complete_redemption, update, context, code))
+
 
-    data = load_data()
+async def enqueue_redemption(update: Update, context: ContextTypes.DEFAULT_TYPE, job: Callable[[], Awaitable[None]]) -> None:
+    """Hand a redemption job to the RedemptionQueue and tell the user if it is turned away or has to wait."""
+    queue = get_redemption_queue(context)
+    # Workers run outside the handler's timing, so each job is timed as a "redemption" call of its own.
+    rejected = queue.submit(update.effective_user.id, partial(run_instrumented, "redemption", update, job))
+    if rejected == "pending":
+        await update.message.reply_text("⏳ Your previous code is still being checked. Please wait for the result.")
+    elif rejected == "full":
+        await update.message.reply_text("🚦 Too many codes are being redeemed right now. Please try again in a minute.")
+    elif queue.position() >= queue.ack_position:
+        await update.message.reply_text(f"⏳ You're in the queue (position {queue.position()}). Your result will follow shortly.")
 
-    # --- NEW: Limit one code per user ---
-    if user.id in data.get("past_winners", []):
-        await update.message.reply_text("⚠️ You have already redeemed a code. Wait for the next giveaway or admin reset.")
+
+async def complete_redemption(update: Update, context: ContextTypes.DEFAULT_TYPE, code: str) -> None:
+    """Redeem a validated code for the sender and reply; run by the RedemptionQueue workers."""
+    user = update.effective_user
+    user_name = user_handle(user)
+    store = get_store(context)
+    outcome, details = store.redeem_code(code, user.id, user_name)
+
+    # --- NEW: Limit one code per user and campaign ---
+    if outcome == REDEEM_ALREADY_WON:
+        await update.message.reply_text("⚠️ You have already redeemed a code in this giveaway. Wait for the next giveaway or admin reset.")
         return
 
-    if code not in data["codes"]:
-        await update.message.reply_text("🤔 That code does not exist.")
+    if outcome == REDEEM_CAMPAIGN_ARCHIVED:
+        await update.message.reply_text("⌛ This giveaway has ended.")
         return
 
-    details = data["codes"][code]
+    if outcome == REDEEM_UNKNOWN_CODE:
+        if get_spam_guard(context).failed_guess(user.id):
+            await update.message.reply_text(
+                f"🚫 Too many invalid codes. Try again in {int(GUESS_BAN_SECONDS // 60)} minutes."
+            )
+            return
+        await update.message.reply_text("🤔 That code does not exist.")
+        return
 
-    if details.get("redeemed_by"):
+    if outcome == REDEEM_ALREADY_REDEEMED:
         await update.message.reply_text("⚠️ This code has already been redeemed.")
         return
 
-    # Redeem code
-    user_name = user_handle(user)
-    now_iso = datetime.now(timezone.utc).isoformat()
-    details["redeemed_by"] = user.id
-    details["redeemed_by_username"] = user_name
-    details["redeemed_at"] = now_iso
+    await confirm_redemption(update, context, user_name, code, details)
 
-    prize_text = details.get("prize") or "Prize details not set. Please contact the admin."
 
-    # Update past winners & leaderboard
-    data["past_winners"].append(user.id)
-    uid_str = str(user.id)
-    if uid_str not in data["leaderboard"]:
-        data["leaderboard"][uid_str] = {"username": user_name, "score": 0}
-    data["leaderboard"][uid_str]["score"] += 1
+async def complete_claim(update: Update, context: ContextTypes.DEFAULT_TYPE, prefix: Optional[str], prize: Optional[bool]) -> None:
+    """Hand the sender the next available code and reply; run by the RedemptionQueue workers."""
+    user_name = user_handle(update.effective_user)
+    outcome, code, details = get_store(context).claim_code(update.effective_user.id, user_name, prefix, prize)
 
-    if user.id not in data.get("awaiting_screenshot", []):
-        data["awaiting_screenshot"].append(user.id)
+    if outcome == REDEEM_ALREADY_WON:
+        await update.message.reply_text("⚠️ You have already redeemed a code in this giveaway. Wait for the next giveaway or admin reset.")
+        return
 
-    save_data(data)
+    if outcome == REDEEM_CAMPAIGN_ARCHIVED:
+        await update.message.reply_text("⌛ This giveaway has ended.")
+        return
+
+    if outcome == REDEEM_NONE_AVAILABLE:
+        await update.message.reply_text("😔 All codes have been claimed. Watch the channel for the next drop.")
+        return
+
+    await confirm_redemption(update, context, user_name, code, details)
+
+
+async def confirm_redemption(update: Update, context: ContextTypes.DEFAULT_TYPE, user_name: str, code: str, details: Dict) -> None:
+    now_iso = details["redeemed_at"]
+    prize_text = details.get("prize") or "Prize details not set. Please contact the admin."
+    # Only confirm once the redemption is durable.
+    await get_store(context).commit()
 
     success_message = (
         "🎉 Congratulations! 🎉\n\n"
@@ -362,18 +2974,7 @@ async def process_redemption(update: Update, context: ContextTypes.DEFAULT_TYPE,
     )
     await update.message.reply_text(success_message)
 
-    notification = (
-        f"🔥 Prize Redeemed! 🔥\n\n"
-        f"User: {user_name}\n"
-        f"Code: {code}\n"
-        f"Prize: {prize_text}\n"
-        f"Time(UTC): {now_iso}\n"
-    )
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=notification)
-        except Exception as e:
-            logger.warning("Failed to notify admin %s: %s", admin_id, e)
+    get_notifier(context).redeemed(user_name, code, prize_text, now_iso)
 
 
 # ---------------------------
@@ -381,52 +2982,199 @@ async def process_redemption(update: Update, context: ContextTypes.DEFAULT_TYPE,
 # ---------------------------
 
 
+def campaign_stats_text(prefix: str, s: Dict) -> str:
+    lines = [
+        f"📊 Campaign {prefix}" + (" (archived)" if s["archived"] else "") + "\n",
+        f"Codes: {s['total']} total",
+        f"Redeemed: {s['redeemed']}",
+        f"Available: {s['available']}" + (f" ({s['with_prize']} with a prize)" if s["with_prize"] is not None else ""),
+        f"Winners: {s['winners']}",
+    ]
+    return "\n".join(lines)
+
+
 @admin_only
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = load_data()
-    total_codes = len(data["codes"])
-    redeemed = sum(1 for c in data["codes"].values() if c.get("redeemed_by"))
-    available = total_codes - redeemed
-    users = len(data.get("users", []))
-    banned = len(data.get("banned_users", []))
-    awaiting = len(data.get("awaiting_screenshot", []))
+    """/stats [PREFIX]"""
+    if context.args:
+        prefix = context.args[0].upper()
+        campaign = get_store(context).campaign_stats(prefix)
+        if campaign is None:
+            await update.message.reply_text(f"No campaign {prefix}.")
+            return
+        await update.message.reply_text(campaign_stats_text(prefix, campaign))
+        return
+    s = get_store(context).stats()
+    cache = context.bot_data["membership_cache"]
     msg = (
         f"📊 Stats\n\n"
-        f"Codes: {total_codes} total\n"
-        f"Redeemed: {redeemed}\n"
-        f"Available: {available}\n\n"
-        f"Users: {users}\n"
-        f"Banned users: {banned}\n"
-        f"Awaiting screenshots: {awaiting}\n"
+        f"Codes: {s['total_codes']} total\n"
+        f"Redeemed: {s['redeemed']}\n"
+        f"Available: {s['available']}\n\n"
+        f"Users: {s['users']}\n"
+        f"Banned users: {s['banned']}\n"
+        f"Awaiting screenshots: {s['awaiting']}\n"
+        f"Redemptions (last minute): {s['redemptions_last_minute']}\n\n"
+        f"Membership cache: {cache.hits} hits / {cache.misses} misses ({len(cache)} cached)\n"
+        f"Temporary bans for guessing: {get_spam_guard(context).active_bans()}\n"
+        f"Scheduled drops and expiries: {get_store(context).count_schedules()}\n"
     )
+    if len(s["prefixes"]) > 1:
+        lines = ["\nBy prefix (available / total):"]
+        biggest = sorted(s["prefixes"].items(), key=lambda kv: kv[1][0], reverse=True)
+        for prefix, (total, redeemed) in biggest[:STATS_MAX_PREFIXES]:
+            lines.append(f"• {prefix}: {total - redeemed} / {total}")
+        if len(biggest) > STATS_MAX_PREFIXES:
+            lines.append(f"…and {len(biggest) - STATS_MAX_PREFIXES} more")
+        msg += "\n".join(lines)
+    if s["archived"]:
+        msg += f"\n\nArchived campaigns: {', '.join(sorted(s['archived'])[:STATS_MAX_PREFIXES])}"
+        if len(s["archived"]) > STATS_MAX_PREFIXES:
+            msg += f" …and {len(s['archived']) - STATS_MAX_PREFIXES} more"
     await update.message.reply_text(msg)
 
 
+# /listcodes filter keyword -> prize argument of Store.available_codes()
+LISTCODES_FILTERS = {"all": None, "prize": True, "noprize": False}
+# Page buttons name the filter by its initial, leaving room for their cursor code
+LISTCODES_FILTER_KEYS = {flt[0]: flt for flt in LISTCODES_FILTERS}
+# Page button cursor: "<page>>CODE" (codes after CODE) or "<page><CODE" (codes before it)
+LISTCODES_CURSOR_REGEX = re.compile(r"^(\d+)([<>])([A-Z0-9-]+)$")
+CALLBACK_DATA_MAX_BYTES = 64
+
+
+def listcodes_page(
+    store: Store, prefix: Optional[str], flt: str, page: int, cursor: Optional[str] = None, backwards: bool = False
+) -> Tuple[str, InlineKeyboardMarkup]:
+    """Page `page` of /listcodes: the codes after `cursor` (before it if `backwards`), or the first ones."""
+    prize = LISTCODES_FILTERS[flt]
+    total = store.count_available(prefix, prize)
+    pages = max(1, -(-total // LISTCODES_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    rows = store.available_codes(prefix, prize, cursor, LISTCODES_PAGE_SIZE, backwards)
+    # Codes redeemed since the previous page was shown can leave the cursor near an end.
+    if backwards and len(rows) < LISTCODES_PAGE_SIZE:
+        page, rows = 0, store.available_codes(prefix, prize, None, LISTCODES_PAGE_SIZE)
+    elif cursor is not None and not rows:
+        page, rows = pages - 1, store.available_codes(prefix, prize, None, LISTCODES_PAGE_SIZE, backwards=True)
+    title = "📋 Available Codes" + (f" {prefix}" if prefix else "") + ("" if flt == "all" else f" ({flt})")
+    lines = [f"{title}\n{total} code(s) — page {page + 1}/{pages}\n"]
+    for code, code_prize in rows:
+        prize_text = code_prize or "Not set"
+        if len(prize_text) > 80:
+            prize_text = prize_text[:79] + "…"
+        lines.append(f"• {code} — Prize: {prize_text}")
+
+    def page_button(label: str, to_page: int, direction: str, code: str) -> Optional[InlineKeyboardButton]:
+        if prefix:
+            code = code[len(prefix) + 1:]  # the prefix is in the data already
+        data = f"lc|{prefix or '*'}|{flt[0]}|{to_page}{direction}{code}"
+        # Only codes imported with a very long prefix can overflow the limit.
+        if len(data.encode()) > CALLBACK_DATA_MAX_BYTES:
+            return None
+        return InlineKeyboardButton(label, callback_data=data)
+
+    nav = []
+    if rows and page > 0:
+        nav.append(page_button("◀️ Prev", page - 1, "<", rows[0][0]))
+    if rows and page < pages - 1:
+        nav.append(page_button("Next ▶️", page + 1, ">", rows[-1][0]))
+    nav = [button for button in nav if button is not None]
+    key = f"{prefix or '*'}|{flt}"
+    export = [
+        InlineKeyboardButton("📥 Export .txt", callback_data=f"lcx|{key}|txt"),
+        InlineKeyboardButton("📥 Export .gz", callback_data=f"lcx|{key}|gz"),
+    ]
+    return "\n".join(lines), InlineKeyboardMarkup([nav, export] if nav else [export])
+
+
+def build_codes_export(rows: Iterator[Tuple[str, Optional[str]]], compress: bool) -> io.BytesIO:
+    """Write "CODE — Prize: ..." lines into an in-memory file (gzipped if asked). Runs in a worker thread."""
+    buf = io.BytesIO()
+    out = gzip.GzipFile(fileobj=buf, mode="wb") if compress else buf
+    batch = []
+    for code, prize in rows:
+        batch.append(f"{code} — Prize: {prize or 'Not set'}\n")
+        if len(batch) >= 10000:
+            out.write("".join(batch).encode("utf-8"))
+            batch = []
+    out.write("".join(batch).encode("utf-8"))
+    if compress:
+        out.close()
+    buf.seek(0)
+    return buf
+
+
+async def send_codes_export(context: ContextTypes.DEFAULT_TYPE, chat_id: int, prefix: Optional[str], flt: str, compress: bool) -> None:
+    store = get_store(context)
+    # The export may read through a separate connection: make our writes visible.
+    await store.commit()
+    rows = store.export_available(prefix, LISTCODES_FILTERS[flt])
+    buf = await asyncio.to_thread(build_codes_export, rows, compress)
+    filename = f"available_codes{'_' + prefix if prefix else ''}.txt" + (".gz" if compress else "")
+    await context.bot.send_document(chat_id=chat_id, document=InputFile(buf, filename=filename))
+
+
 @admin_only
 async def list_codes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = load_data()
-    # Only include unredeemed codes
-    available_codes = {code: details for code, details in data["codes"].items() if not details.get("redeemed_by")}
-
-    if not available_codes:
+    """/listcodes [PREFIX] [all|prize|noprize] [export [gz]]"""
+    prefix, flt, export, compress = None, "all", False, False
+    for arg in context.args or []:
+        word = arg.lower()
+        if word in LISTCODES_FILTERS:
+            flt = word
+        elif word == "export":
+            export = True
+        elif word == "gz":
+            compress = True
+        else:
+            prefix = arg.upper()
+            if not PREFIX_REGEX.match(prefix):
+                await update.message.reply_text(
+                    f"❌ Invalid prefix: use up to {PREFIX_MAX_LENGTH} letters and digits.\n"
+                    "Usage: /listcodes [PREFIX] [all|prize|noprize] [export [gz]]"
+                )
+                return
+
+    store = get_store(context)
+    if store.count_available(prefix, LISTCODES_FILTERS[flt]) == 0:
         await update.message.reply_text("No available codes found.")
         return
+    if export:
+        await send_codes_export(context, update.effective_chat.id, prefix, flt, compress)
+        return
+    text, keyboard = listcodes_page(store, prefix, flt, 0)
+    await update.message.reply_text(text, reply_markup=keyboard)
 
-    lines = ["📋 Available Codes\n"]
-    for code, details in available_codes.items():
-        prize = details.get("prize") or "Not set"
-        lines.append(f"• {code} — Prize: {prize}")
 
-    text = "\n".join(lines)
-    # If too long, send as file
-    if len(text) > 4000:
-        fname = "available_codes.txt"
-        with open(fname, "w", encoding="utf-8") as f:
-            f.write(text)
-        await update.message.reply_document(document=open(fname, "rb"))
-        os.remove(fname)
-    else:
-        await update.message.reply_text(text)
+@admin_only
+async def list_codes_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Page buttons ("lc|PREFIX|F|PAGE>CODE", see listcodes_page()) and export buttons ("lcx|PREFIX|FILTER|txt/gz") of /listcodes."""
+    query = update.callback_query
+    await query.answer()
+    parts = query.data.split("|")
+    if len(parts) != 4:
+        return
+    action, prefix, flt, arg = parts
+    if action == "lc":
+        flt = LISTCODES_FILTER_KEYS.get(flt)
+    if not (prefix == "*" or PREFIX_REGEX.match(prefix)) or flt not in LISTCODES_FILTERS:
+        return
+    prefix = None if prefix == "*" else prefix
+    if action == "lcx":
+        await send_codes_export(context, query.message.chat.id, prefix, flt, arg == "gz")
+        return
+    match = LISTCODES_CURSOR_REGEX.match(arg)
+    if not match:
+        return
+    page, direction, cursor = match.groups()
+    if prefix:
+        cursor = f"{prefix}-{cursor}"
+    text, keyboard = listcodes_page(get_store(context), prefix, flt, int(page), cursor, direction == "<")
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest:
+        pass  # "message is not modified" when the page did not change
 
 
 @admin_only
@@ -434,7 +3182,7 @@ async def add_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
         await update.message.reply_text("Usage: /addcode CODE1 [CODE2] ...")
         return
-    data = load_data()
+    store = get_store(context)
     added = []
     skipped_invalid = []
     for raw in context.args:
@@ -442,11 +3190,9 @@ async def add_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if not validate_code_format(code):
             skipped_invalid.append(code)
             continue
-        if code in data["codes"]:
-            continue
-        data["codes"][code] = initialize_code_details()
-        added.append(code)
-    save_data(data)
+        if store.add_code(code):
+            added.append(code)
+    await store.commit()
     resp = []
     if added:
         resp.append(f"✅ Added {len(added)} code(s).")
@@ -467,12 +3213,11 @@ async def add_prize(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not validate_code_format(code):
         await update.message.reply_text("❌ Invalid code format.")
         return
-    data = load_data()
-    if code not in data["codes"]:
+    store = get_store(context)
+    if not store.set_prize(code, prize):
         await update.message.reply_text("❌ Code not found.")
         return
-    data["codes"][code]["prize"] = prize
-    save_data(data)
+    await store.commit()
     await update.message.reply_text(f"✅ Prize set for {code}.")
 
 
@@ -481,14 +3226,13 @@ async def del_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
         await update.message.reply_text("Usage: /delcode CODE1 [CODE2] ...")
         return
-    data = load_data()
+    store = get_store(context)
     deleted = []
     for raw in context.args:
         code = raw.strip().upper()
-        if code in data["codes"]:
-            del data["codes"][code]
+        if store.delete_code(code):
             deleted.append(code)
-    save_data(data)
+    await store.commit()
     if deleted:
         await update.message.reply_text(f"🗑️ Deleted {len(deleted)} code(s).")
     else:
@@ -497,10 +3241,99 @@ async def del_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 @admin_only
 async def reset_giveaway(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = load_data()
-    data["past_winners"] = []
-    save_data(data)
-    await update.message.reply_text("🧹 Giveaway reset: past winners list cleared.")
+    """/resetgiveaway [PREFIX]: clear the winners of one campaign, or of all of them."""
+    store = get_store(context)
+    if context.args:
+        prefix = context.args[0].upper()
+        campaign = store.campaign_stats(prefix)
+        if campaign is None or campaign["archived"]:
+            await update.message.reply_text(f"No active campaign {prefix}.")
+            return
+        store.reset_winners(prefix)
+        await store.commit()
+        await update.message.reply_text(f"🧹 Campaign {prefix} reset: its past winners list cleared.")
+        return
+    store.reset_winners()
+    await store.commit()
+    await update.message.reply_text("🧹 Giveaway reset: past winners of every campaign cleared.")
+
+
+@admin_only
+async def archive_campaign(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/archive PREFIX: end a campaign and move its codes out of memory."""
+    if len(context.args) != 1:
+        await update.message.reply_text("Usage: /archive <PREFIX>")
+        return
+    prefix = context.args[0].upper()
+    store = get_store(context)
+    if not await store.archive_campaign(prefix):
+        await update.message.reply_text(f"No active campaign {prefix}.")
+        return
+    await store.commit()
+    await update.message.reply_text(f"📦 Campaign {prefix} archived. Its codes can no longer be redeemed.")
+
+
+@admin_only
+async def unarchive_campaign(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/unarchive PREFIX: bring an archived campaign back."""
+    if len(context.args) != 1:
+        await update.message.reply_text("Usage: /unarchive <PREFIX>")
+        return
+    prefix = context.args[0].upper()
+    store = get_store(context)
+    if not await store.unarchive_campaign(prefix):
+        await update.message.reply_text(f"No archived campaign {prefix}.")
+        return
+    await store.commit()
+    await update.message.reply_text(f"📤 Campaign {prefix} is active again.")
+
+
+# 36 symbols; byte values >= 252 are dropped so that `byte % 36` stays uniform.
+CODE_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+_CODE_BYTE_TABLE = bytes(CODE_ALPHABET[b % 36] for b in range(252)) + bytes(4)
+_CODE_BYTE_REJECT = bytes(range(252, 256))
+
+
+def random_code_bodies(count: int) -> List[str]:
+    """`count` random XXXX-XXXX-XXXX bodies from the OS CSPRNG, mapped to the alphabet in C."""
+    needed = count * 12
+    symbols = b""
+    while len(symbols) < needed:
+        # ~1.6% of bytes are rejected; ask for a little extra.
+        raw = secrets.token_bytes((needed - len(symbols)) * 66 // 64 + 16)
+        symbols += raw.translate(_CODE_BYTE_TABLE, _CODE_BYTE_REJECT)
+    text = symbols[:needed].decode("ascii")
+    return [f"{text[i:i + 4]}-{text[i + 4:i + 8]}-{text[i + 8:i + 12]}" for i in range(0, needed, 12)]
+
+
+async def generate_codes(store: Store, prefix: str, amount: int) -> List[str]:
+    """Create `amount` new unique codes with `prefix`, committed in chunks.
+
+    Candidates that collide with an existing code (or each other) are
+    dropped by the store and replaced in the next round, so an existing,
+    possibly redeemed, code is never overwritten.
+    """
+    generated: List[str] = []
+    while len(generated) < amount:
+        want = min(GENCODE_CHUNK, amount - len(generated))
+        generated.extend(store.add_codes([f"{prefix}-{body}" for body in random_code_bodies(want)]))
+        # Persist the chunk and let other updates run before the next one.
+        await store.commit()
+    await store.set_last_generated(generated)
+    await store.commit()
+    return generated
+
+
+async def reply_code_list(update: Update, codes: List[str], title: str, filename: str) -> None:
+    """Send codes inline when there are few, otherwise as a .txt document."""
+    if len(codes) <= GENCODE_INLINE_MAX:
+        # Build HTML formatted message
+        codes_text = "\n".join(f"<code>{c}</code>" for c in codes)
+        await update.message.reply_html(f"<b>{title}:</b>\n\n{codes_text}")
+    else:
+        # Joining millions of codes takes long enough to run in a worker thread.
+        buf = await asyncio.to_thread(lambda: io.BytesIO("".join(f"{c}\n" for c in codes).encode("ascii")))
+        await update.message.reply_document(document=InputFile(buf, filename=filename), caption=f"{title}.")
 
 
 @admin_only
@@ -514,50 +3347,433 @@ async def gencode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Invalid amount.")
         return
 
-    data = load_data()
-    generated = []
-
-    def gen_segment():
-        chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
-        return "".join(random.choices(chars, k=4))
-
-    for _ in range(amount):
-        new_code = f"{prefix}-{gen_segment()}-{gen_segment()}-{gen_segment()}"
-        data["codes"][new_code] = initialize_code_details()
-        generated.append(new_code)
+    if not 0 < amount <= GENCODE_MAX:
+        await update.message.reply_text(f"Amount must be between 1 and {GENCODE_MAX}.")
+        return
+    if not validate_code_format(f"{prefix}-AAAA-AAAA-AAAA"):
+        await update.message.reply_text("❌ Invalid prefix: use letters and digits only.")
+        return
+    if get_store(context).is_archived(prefix):
+        await update.message.reply_text(f"❌ Campaign {prefix} is archived. /unarchive it first.")
+        return
 
-    data["last_generated_codes"] = generated
-    save_data(data)
+    if amount > GENCODE_CHUNK:
+        await update.message.reply_text(f"⏳ Generating {amount} codes...")
+    generated = await generate_codes(get_store(context), prefix, amount)
 
-    # Build HTML formatted message
-    codes_text = "\n".join(f"<code>{c}</code>" for c in generated)
-    await update.message.reply_html(f"<b>✅ Generated {len(generated)} codes:</b>\n\n{codes_text}")
+    await reply_code_list(update, generated, f"✅ Generated {len(generated)} codes", f"codes_{prefix}_{len(generated)}.txt")
 
     await update.message.reply_text(
         "You can now assign prizes via .txt file or message."
     )
 
 
+# ---------------------------
+# Scheduled drops and expiry
+# ---------------------------
+
+SCHEDULE_RELEASE = "release"
+SCHEDULE_EXPIRE = "expire"
+WHEN_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_when(text: str, now: Optional[float] = None) -> Optional[float]:
+    """Epoch seconds for an offset like "+30m" / "2h" (s, m, h, d) or an ISO time (UTC unless it has an offset)."""
+    now = time.time() if now is None else now
+    match = re.fullmatch(r"\+?(\d+(?:\.\d+)?)([smhd])", text.strip().lower())
+    if match:
+        return now + float(match.group(1)) * WHEN_UNITS[match.group(2)]
+    try:
+        at = datetime.fromisoformat(text.strip())
+    except ValueError:
+        return None
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    return at.timestamp()
+
+
+def format_when(at: float) -> str:
+    return datetime.fromtimestamp(at, timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+class CodeScheduler:
+    """Timed code releases (drops) and expiries, persisted in the store.
+
+    Pending schedules sit in a min-heap by due time, so each tick pops only
+    the due ones and applies each as one bulk store operation: a tick costs
+    O(due * log n) however many schedules or codes are waiting. Cancelled
+    schedules stay in the heap and are skipped when they come due. Ticks
+    come from the Application's JobQueue, or from a plain asyncio loop when
+    python-telegram-bot is installed without the job-queue extra.
+    """
+
+    def __init__(self, app: Application, tick: float = SCHEDULE_TICK):
+        self.app = app
+        self.tick = tick
+        self._heap: List[Tuple[float, str]] = []
+        self._adding: Set[str] = set()  # ids of schedules add() is still persisting
+        self._job = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._heap = [(schedule["at"], schedule["id"]) for schedule in get_store_from_app(self.app).schedules()]
+        heapq.heapify(self._heap)
+        with warnings.catch_warnings():
+            # PTB warns when the job-queue extra is missing; the asyncio loop covers that case.
+            warnings.simplefilter("ignore", PTBUserWarning)
+            job_queue = self.app.job_queue
+        if job_queue is not None:
+            self._job = job_queue.run_repeating(self._on_job, interval=self.tick, first=0, name="code-scheduler")
+        else:
+            self._task = spawn_background(self._run(), "code-scheduler")
+
+    async def close(self) -> None:
+        if self._job is not None:
+            # Application.stop() has usually stopped the JobQueue, and its jobs with it.
+            if self.app.job_queue.scheduler.running:
+                self._job.schedule_removal()
+            self._job = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def add(self, kind: str, at: float, codes: Optional[List[str]] = None, prefix: Optional[str] = None,
+                  prizes: Optional[Dict[str, str]] = None, expire_at: Optional[float] = None) -> Dict:
+        """Persist a schedule: release `codes` (with `prizes`, expiring at `expire_at`), or expire `codes` / campaign `prefix`."""
+        store = get_store_from_app(self.app)
+        schedule_id = secrets.token_hex(SCHEDULE_ID_BYTES).upper()
+        # Ids being persisted are not in the store yet, so they are reserved here.
+        while schedule_id in self._adding or store.get_schedule(schedule_id) is not None:
+            schedule_id = secrets.token_hex(SCHEDULE_ID_BYTES).upper()
+        schedule = {"id": schedule_id, "kind": kind, "at": at}
+        if prefix:
+            schedule["prefix"] = prefix
+        if expire_at:
+            schedule["expire_at"] = expire_at
+        self._adding.add(schedule_id)
+        try:
+            await store.add_schedule(schedule, codes, prizes)
+        finally:
+            self._adding.discard(schedule_id)
+        heapq.heappush(self._heap, (at, schedule["id"]))
+        return schedule
+
+    def cancel(self, schedule_id: str) -> bool:
+        return get_store_from_app(self.app).remove_schedule(schedule_id)
+
+    @property
+    def next_due(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    async def _on_job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await self.run_due()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.run_due()
+            except Exception:
+                logger.exception("Scheduled code job failed")
+
+    async def run_due(self, now: Optional[float] = None) -> int:
+        """Apply every schedule due by `now`. Returns how many ran."""
+        now = time.time() if now is None else now
+        store = get_store_from_app(self.app)
+        ran = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, schedule_id = heapq.heappop(self._heap)
+            schedule = store.get_schedule(schedule_id)
+            if schedule is None:
+                continue  # cancelled
+            # Applying a schedule and removing it are journaled together, so a
+            # restart never runs it twice.
+            if schedule["kind"] == SCHEDULE_RELEASE:
+                codes, prizes = store.schedule_codes(schedule_id)
+                released = store.add_codes(codes, prizes or None)
+                if schedule.get("expire_at") and released:
+                    await self.add(SCHEDULE_EXPIRE, schedule["expire_at"], codes=released)
+                text = f"🚀 Drop {schedule_id} released: {len(released)} code(s) are live."
+                if len(released) < len(codes):
+                    text += f" {len(codes) - len(released)} skipped (already exist or campaign archived)."
+            else:
+                codes = None if schedule.get("prefix") else store.schedule_codes(schedule_id)[0]
+                expired = store.expire_codes(codes, schedule.get("prefix"))
+                text = f"⌛ Schedule {schedule_id}: {len(expired)} unredeemed code(s) expired" + (
+                    f" in {schedule['prefix']}." if schedule.get("prefix") else "."
+                )
+            store.remove_schedule(schedule_id)
+            logger.info(text)
+            self.app.bot_data["notifier"].notice(text)
+            ran += 1
+        if ran:
+            await store.commit()
+        return ran
+
+
+def get_scheduler(context: ContextTypes.DEFAULT_TYPE) -> CodeScheduler:
+    return context.bot_data["scheduler"]
+
+
+@admin_only
+async def drop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/drop <amount> <PREFIX> <when> [lifetime]: generate codes now, make them redeemable at `when`."""
+    if len(context.args) not in (3, 4):
+        await update.message.reply_text("Usage: /drop <amount> <PREFIX> <when> [lifetime], e.g. /drop 100 NETFLIX +2h 30m")
+        return
+    try:
+        amount, prefix = int(context.args[0]), context.args[1].upper()
+    except ValueError:
+        await update.message.reply_text("Invalid amount.")
+        return
+    if not 0 < amount <= GENCODE_MAX:
+        await update.message.reply_text(f"Amount must be between 1 and {GENCODE_MAX}.")
+        return
+    if not validate_code_format(f"{prefix}-AAAA-AAAA-AAAA"):
+        await update.message.reply_text("❌ Invalid prefix: use letters and digits only.")
+        return
+    at = parse_when(context.args[2])
+    if at is None:
+        await update.message.reply_text("❌ Invalid time: use an offset like +30m, 2h, 1d or an ISO time like 2025-12-24T18:00.")
+        return
+    expire_at = None
+    if len(context.args) == 4:
+        lifetime = parse_when(context.args[3], now=0)
+        if lifetime is None or lifetime <= 0:
+            await update.message.reply_text("❌ Invalid lifetime: use an offset like 30m or 2h.")
+            return
+        expire_at = at + lifetime
+    store = get_store(context)
+    if store.is_archived(prefix):
+        await update.message.reply_text(f"❌ Campaign {prefix} is archived. /unarchive it first.")
+        return
+
+    # Generating up to GENCODE_MAX codes takes a while, so it runs in a worker
+    # thread; the store is checked on the loop an IMPORT_BATCH at a time.
+    candidates = await asyncio.to_thread(lambda: list(dict.fromkeys(f"{prefix}-{body}" for body in random_code_bodies(amount))))
+    codes: List[str] = []
+    for start in range(0, len(candidates), IMPORT_BATCH):
+        codes.extend(code for code in candidates[start:start + IMPORT_BATCH] if not store.has_code(code))
+        await asyncio.sleep(0)
+    schedule = await get_scheduler(context).add(SCHEDULE_RELEASE, at, codes=codes, expire_at=expire_at)
+    await store.commit()
+    title = f"🗓 Drop {schedule['id']}: {len(codes)} codes, redeemable from {format_when(at)}"
+    if expire_at:
+        title += f" until {format_when(expire_at)}"
+    await reply_code_list(update, codes, title, f"drop_{prefix}_{schedule['id']}.txt")
+
+
+@admin_only
+async def expire(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/expire <PREFIX | CODE...> <when>: delete the still unredeemed codes at `when`."""
+    if len(context.args) < 2:
+        await update.message.reply_text("Usage: /expire <PREFIX or CODE1 [CODE2]...> <when>, e.g. /expire NETFLIX +1d")
+        return
+    at = parse_when(context.args[-1])
+    if at is None:
+        await update.message.reply_text("❌ Invalid time: use an offset like +30m, 2h, 1d or an ISO time like 2025-12-24T18:00.")
+        return
+    targets = [arg.upper() for arg in context.args[:-1]]
+    store = get_store(context)
+    if len(targets) == 1 and not validate_code_format(targets[0]):
+        stats = store.campaign_stats(targets[0])
+        if stats is None or stats["archived"]:
+            await update.message.reply_text(f"No active campaign {targets[0]}.")
+            return
+        schedule = await get_scheduler(context).add(SCHEDULE_EXPIRE, at, prefix=targets[0])
+        what = f"unredeemed codes of {targets[0]}"
+    else:
+        codes = [code for code in targets if store.has_code(code)]
+        if not codes:
+            await update.message.reply_text("No matching codes found.")
+            return
+        schedule = await get_scheduler(context).add(SCHEDULE_EXPIRE, at, codes=codes)
+        what = f"{len(codes)} code(s) if still unredeemed"
+    await store.commit()
+    await update.message.reply_text(f"⌛ Schedule {schedule['id']}: {what} expire at {format_when(at)}.")
+
+
+@admin_only
+async def list_schedules(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    pending = sorted(get_store(context).schedules(), key=operator.itemgetter("at"))
+    if not pending:
+        await update.message.reply_text("No scheduled drops or expiries.")
+        return
+    lines = [f"🗓 {len(pending)} scheduled\n"]
+    for schedule in pending[:SCHEDULES_LIST_MAX]:
+        target = schedule.get("prefix") or f"{schedule.get('count', len(schedule.get('codes', ())))} code(s)"
+        lines.append(f"• {schedule['id']} — {schedule['kind']} {target} at {format_when(schedule['at'])}")
+    if len(pending) > SCHEDULES_LIST_MAX:
+        lines.append(f"…and {len(pending) - SCHEDULES_LIST_MAX} more")
+    await update.message.reply_text("\n".join(lines))
+
+
+@admin_only
+async def unschedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if len(context.args) != 1:
+        await update.message.reply_text("Usage: /unschedule <id>")
+        return
+    store = get_store(context)
+    if not get_scheduler(context).cancel(context.args[0].upper()):
+        await update.message.reply_text("No such schedule.")
+        return
+    await store.commit()
+    await update.message.reply_text("🗑️ Schedule cancelled.")
+
+
+# ---------------------------
+# Broadcast engine
+# ---------------------------
+
+
+class TokenBucket:
+    """Async token bucket: at most `rate` acquisitions per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # The lock queues waiters so tokens are handed out first come, first served.
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Hand out nothing for `seconds` (after a RetryAfter from Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+
+def broadcast_progress_text(state: Dict, finished: bool = False) -> str:
+    done = state["sent"] + state["failed"] + state["pruned"]
+    title = "Broadcast finished!" if finished else f"📢 Broadcasting... {done}/{state['total']}"
+    return (
+        f"{title}\n"
+        f"✅ Success: {state['sent']}\n"
+        f"❌ Failed: {state['failed']}\n"
+        f"🧹 Removed (blocked the bot): {state['pruned']}"
+    )
+
+
+async def send_broadcast_message(app: Application, bucket: TokenBucket, user_id: int, text: str) -> str:
+    """Deliver one broadcast message. Returns "sent", "failed" or "pruned"."""
+    for _ in range(BROADCAST_MAX_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            await app.bot.send_message(chat_id=user_id, text=text)
+            return "sent"
+        except RetryAfter as e:
+            bucket.pause(retry_after_seconds(e))
+        except Forbidden:
+            # Blocked the bot or deleted their account: stop messaging them.
+            get_store_from_app(app).remove_user(user_id)
+            return "pruned"
+        except TelegramError as e:
+            logger.debug("Broadcast to %s failed: %s", user_id, e)
+            return "failed"
+    return "failed"
+
+
+async def run_broadcast(app: Application) -> None:
+    """Send the checkpointed broadcast to every user after its cursor.
+
+    Users are processed in ascending id order, in chunks sent concurrently
+    under a global token bucket. After each chunk the cursor advances, and
+    it is checkpointed regularly, so an interrupted broadcast resumes where
+    it stopped (re-sending at most one chunk).
+    """
+    bulk_priority()
+    store = get_store_from_app(app)
+    state = dict(store.broadcast_state())
+    bucket = TokenBucket(BROADCAST_RATE)
+    cursor = state["cursor"]
+    pending = sorted(uid for uid in store.user_ids() if cursor is None or uid > cursor)
+    last_report = last_checkpoint = time.monotonic()
+    try:
+        for start in range(0, len(pending), BROADCAST_CONCURRENCY):
+            chunk = pending[start:start + BROADCAST_CONCURRENCY]
+            results = await asyncio.gather(*(send_broadcast_message(app, bucket, uid, state["text"]) for uid in chunk))
+            for result in results:
+                state[result] += 1
+            state["cursor"] = chunk[-1]
+
+            now = time.monotonic()
+            if now - last_checkpoint >= BROADCAST_CHECKPOINT_INTERVAL:
+                store.set_broadcast_state(state)
+                last_checkpoint = now
+            if now - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = now
+                try:
+                    await app.bot.edit_message_text(
+                        chat_id=state["admin_chat_id"], message_id=state["progress_message_id"], text=broadcast_progress_text(state)
+                    )
+                except TelegramError as e:
+                    logger.debug("Could not update broadcast progress: %s", e)
+    except asyncio.CancelledError:
+        store.set_broadcast_state(state)
+        raise
+
+    store.set_broadcast_state(None)
+    await store.commit()
+    try:
+        await app.bot.send_message(chat_id=state["admin_chat_id"], text=broadcast_progress_text(state, finished=True))
+    except TelegramError as e:
+        logger.warning("Failed to report broadcast result: %s", e)
+
+
+def start_broadcast_task(app: Application) -> None:
+    # Not app.create_task(): Application.stop() would wait for the whole broadcast.
+    app.bot_data["broadcast_task"] = spawn_background(run_broadcast(app), "broadcast")
+
+
 @admin_only
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
         await update.message.reply_text("Usage: /broadcast <message>")
         return
-    data = load_data()
+    store = get_store(context)
+    task = context.bot_data.get("broadcast_task")
+    if task is not None and not task.done():
+        await update.message.reply_text("⚠️ A broadcast is already running.")
+        return
     message = " ".join(context.args)
-    user_ids = list(data.get("users", []))
-    await update.message.reply_text(f"📢 Starting broadcast to {len(user_ids)} users...")
-    success = 0
-    fail = 0
-    for uid in user_ids:
-        try:
-            await context.bot.send_message(chat_id=uid, text=message)
-            success += 1
-            # be polite
-            await asyncio.sleep(0.05)
-        except Exception:
-            fail += 1
-    await update.message.reply_text(f"Broadcast finished!\n✅ Success: {success}\n❌ Failed: {fail}")
+    total = len(store.user_ids())
+    progress = await update.message.reply_text(f"📢 Starting broadcast to {total} users...")
+    store.set_broadcast_state({
+        "text": message,
+        "admin_chat_id": update.effective_chat.id,
+        "progress_message_id": progress.message_id,
+        "cursor": None,
+        "total": total,
+        "sent": 0,
+        "failed": 0,
+        "pruned": 0,
+    })
+    await store.commit()
+    start_broadcast_task(context.application)
 
 
 @admin_only
@@ -570,10 +3786,9 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     except ValueError:
         await update.message.reply_text("Invalid user id.")
         return
-    data = load_data()
-    if uid not in data["banned_users"]:
-        data["banned_users"].append(uid)
-        save_data(data)
+    store = get_store(context)
+    if store.ban(uid):
+        await store.commit()
         await update.message.reply_text(f"🚫 User {uid} banned.")
     else:
         await update.message.reply_text("User already banned.")
@@ -589,10 +3804,9 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     except ValueError:
         await update.message.reply_text("Invalid user id.")
         return
-    data = load_data()
-    if uid in data["banned_users"]:
-        data["banned_users"].remove(uid)
-        save_data(data)
+    store = get_store(context)
+    if store.unban(uid):
+        await store.commit()
         await update.message.reply_text(f"✅ User {uid} unbanned.")
     else:
         await update.message.reply_text("User not in ban list.")
@@ -610,36 +3824,135 @@ async def stop_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 # ---------------------------
 
 
-async def process_prize_data(data: Dict, prizes: List[str], codes: Optional[List[str]] = None) -> Tuple[int, Optional[str]]:
+async def process_prize_data(store: Store, prizes: List[str], codes: Optional[List[str]] = None) -> Tuple[int, Optional[str]]:
     """Assign prizes list to codes list. Returns (assigned_count, error_msg)."""
     if codes is None:
-        codes = data.get("last_generated_codes", [])
+        codes = store.last_generated_codes()
     if not codes:
         return 0, "No generated codes available (use /gencode first)."
     assigned = 0
-    for i, code in enumerate(codes):
-        if i < len(prizes):
-            # only assign if code exists
-            if code in data["codes"]:
-                data["codes"][code]["prize"] = prizes[i]
-                assigned += 1
-        else:
-            break
-    save_data(data)
+    for code, prize in zip(codes, prizes):
+        # only assign if code exists
+        if store.set_prize(code, prize):
+            assigned += 1
+    await store.commit()
     return assigned, None
 
 
+class CodeFileReader:
+    """Reads CODE or CODE,PRIZE rows from an uploaded code file, one batch at a time.
+
+    Call it from a worker thread so decompression and parsing stay off the
+    event loop. Only the current batch is held in memory.
+    """
+
+    def __init__(self, path: str, compressed: bool):
+        self._fh = (gzip.open if compressed else open)(path, "rt", encoding="utf-8-sig", newline="")
+        self._rows = csv.reader(self._fh)
+        self.lines = 0
+        self.valid = 0
+        self.invalid = 0
+
+    def read_batch(self, size: int) -> Dict[str, Optional[str]]:
+        """Return up to `size` codes mapped to their prize (or None); empty at end of file."""
+        batch: Dict[str, Optional[str]] = {}
+        for row in self._rows:
+            self.lines += 1
+            if not row or not row[0].strip():
+                continue
+            code = row[0].strip().upper()
+            if not validate_code_format(code):
+                # Allow a "code,prize" header line.
+                if not (self.lines == 1 and code == "CODE"):
+                    self.invalid += 1
+                continue
+            self.valid += 1
+            # Unquoted prizes may contain commas of their own.
+            batch.setdefault(code, ",".join(row[1:]).strip() or None)
+            if len(batch) >= size:
+                break
+        return batch
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+def import_progress_text(header: str, reader: Optional[CodeFileReader], added: int) -> str:
+    lines = reader.lines if reader else 0
+    valid = reader.valid if reader else 0
+    invalid = reader.invalid if reader else 0
+    return (
+        f"{header}\n"
+        f"Lines read: {lines}\n"
+        f"Added: {added}\n"
+        f"Already present or repeated: {valid - added}\n"
+        f"Invalid format: {invalid}"
+    )
+
+
+async def import_codes_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stream codes from an uploaded .txt/.csv (optionally .gz) file into the store.
+
+    Each batch is committed before the next is read, so a failure part-way
+    keeps everything imported up to that point.
+    """
+    store = get_store(context)
+    doc = update.message.document
+    name = doc.file_name or "upload"
+    progress = await update.message.reply_text(f"⏳ Importing codes from {name}...")
+    reader: Optional[CodeFileReader] = None
+    added = 0
+    last_report = time.monotonic()
+
+    async def report(header: str) -> None:
+        try:
+            await progress.edit_text(import_progress_text(header, reader, added))
+        except TelegramError as e:
+            logger.warning("Could not update import progress: %s", e)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "codes")
+        await (await doc.get_file()).download_to_drive(path)
+        try:
+            reader = await asyncio.to_thread(CodeFileReader, path, name.lower().endswith(".gz"))
+            while True:
+                batch = await asyncio.to_thread(reader.read_batch, IMPORT_BATCH)
+                if not batch:
+                    break
+                added += len(store.add_codes(list(batch), batch))
+                await store.commit()
+                if time.monotonic() - last_report >= IMPORT_PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    await report(f"⏳ Importing {name}...")
+        except (OSError, EOFError, UnicodeDecodeError, csv.Error) as e:
+            logger.warning("Code import from %s failed: %s", name, e)
+            await report(f"⚠️ Import of {name} stopped: {e}")
+            return
+        finally:
+            if reader is not None:
+                await asyncio.to_thread(reader.close)
+    await report(f"✅ Imported {name}")
+
+
 @admin_only
 async def handle_admin_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Admin uploads a .txt file: each line becomes a prize assigned to last_generated_codes."""
+    """Admin uploads a file: a code list to import, or a .txt of prizes for last_generated_codes."""
     if not update.message or not update.message.document:
         await update.message.reply_text("Please upload a .txt file.")
         return
     doc = update.message.document
-    if not doc.file_name.lower().endswith(".txt"):
-        await update.message.reply_text("Please upload a .txt file.")
+    name = (doc.file_name or "").lower()
+    caption = (update.message.caption or "").strip().lower()
+    if name.endswith((".csv", ".csv.gz")) or (
+        caption.startswith("import") and name.endswith((".txt", ".txt.gz"))
+    ):
+        await import_codes_file(update, context)
+        return
+    if not name.endswith(".txt"):
+        await update.message.reply_text(
+            "Please upload a .txt file of prizes, or a .csv/.txt code list with the caption 'import'."
+        )
         return
-    data = load_data()
     f = await doc.get_file()
     tmp_path = f"tmp_prizes_{doc.file_unique_id}.txt"
     await f.download_to_drive(tmp_path)
@@ -649,7 +3962,7 @@ async def handle_admin_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if not prizes:
             await update.message.reply_text("No prizes found in the file.")
             return
-        assigned, err = await process_prize_data(data, prizes)
+        assigned, err = await process_prize_data(get_store(context), prizes)
         if err:
             await update.message.reply_text(f"⚠️ {err}")
             return
@@ -667,12 +3980,11 @@ async def handle_admin_prizes(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not update.message or not update.message.text:
         await update.message.reply_text("Please send prize lines as text (one per line).")
         return
-    data = load_data()
     prizes = [line.strip() for line in update.message.text.splitlines() if line.strip()]
     if not prizes:
         await update.message.reply_text("No prize lines found in the message.")
         return
-    assigned, err = await process_prize_data(data, prizes)
+    assigned, err = await process_prize_data(get_store(context), prizes)
     if err:
         await update.message.reply_text(f"⚠️ {err}")
         return
@@ -684,7 +3996,6 @@ async def handle_admin_prizes(update: Update, context: ContextTypes.DEFAULT_TYPE
 # ---------------------------
 
 @channel_required
-@check_banned
 async def handle_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     If user is in awaiting_screenshot, forward the photo to admins and notify them.
@@ -693,26 +4004,14 @@ async def handle_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = update.effective_user
     if not user or not update.message:
         return
-    data = load_data()
-    if user.id not in data.get("awaiting_screenshot", []):
+    # remove user from awaiting list; only the first of concurrent photos gets through
+    if not get_store(context).screenshot_received(user.id):
         # Not expecting screenshot; ignore or optionally forward to owner
         await update.message.reply_text("I'm not currently expecting a screenshot from you, but thanks!")
         return
 
     # forward the sent photo(s) to admins
-    for admin_id in ADMIN_IDS:
-        try:
-            # forward original message
-            await context.bot.forward_message(chat_id=admin_id, from_chat_id=user.id, message_id=update.message.message_id)
-            await context.bot.send_message(chat_id=admin_id, text=f"📸 Screenshot forwarded from {user_handle(user)}")
-        except Exception as e:
-            logger.error("Failed forward screenshot to admin %s: %s", admin_id, e)
-    # remove user from awaiting list
-    try:
-        data["awaiting_screenshot"].remove(user.id)
-    except ValueError:
-        pass
-    save_data(data)
+    get_notifier(context).forward(user.id, update.message.message_id, f"📸 Screenshot forwarded from {user_handle(user)}")
     await update.message.reply_text("✅ Thanks for the screenshot! Admins have been notified.")
 
 
@@ -721,7 +4020,6 @@ async def handle_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ---------------------------
 
 @channel_required
-@check_banned
 async def handle_direct_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.text:
         return
@@ -744,40 +4042,547 @@ async def forward_to_owner(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if not user:
         return
     # don't forward admin messages (they have their own handlers)
-    if user.id in ADMIN_IDS:
+    if get_user_context(update, context).admin:
         return
     info = f"👆 Message from {user_handle(user)}\nType: {update.message.content_type}"
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.forward_message(chat_id=admin_id, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
-            await context.bot.send_message(chat_id=admin_id, text=info)
-        except Exception as e:
-            logger.error("Failed forwarding to admin %s: %s", admin_id, e)
+    get_notifier(context).forward(update.message.chat_id, update.message.message_id, info)
     # optionally notify user
     await update.message.reply_text("Message forwarded to the owner. Thank you.")
 
 
+# ---------------------------
+# Outbound request scheduling
+# ---------------------------
+
+# Lower runs first. Requests are user replies unless the calling task says
+# otherwise (see bulk_priority()); getChatMember is a membership check.
+PRIORITY_USER = 0
+PRIORITY_MEMBERSHIP = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = {PRIORITY_USER: "user", PRIORITY_MEMBERSHIP: "membership", PRIORITY_BULK: "bulk"}
+
+request_priority: ContextVar[Optional[int]] = ContextVar("request_priority", default=None)
+
+
+def bulk_priority() -> None:
+    """Mark Bot API calls from the current task (and tasks it creates) as bulk traffic."""
+    request_priority.set(PRIORITY_BULK)
+
+
+class PrioritySlots:
+    """At most `size` holders at once; waiters are served by priority, then in arrival order."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.in_use = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    def waiting(self, priority: Optional[int] = None) -> int:
+        return sum(1 for p, _, fut in self._waiters if not fut.done() and (priority is None or p == priority))
+
+    async def acquire(self, priority: int) -> None:
+        if self.in_use < self.size and not self._waiters:
+            self.in_use += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Cancelled after release() handed us the slot: pass it on.
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                # The slot goes straight to the waiter; in_use stays the same.
+                fut.set_result(None)
+                return
+        self.in_use -= 1
+
+
+class PrioritySendRequest(BaseRequest):
+    """Schedules Bot API calls by priority over separate connection pools.
+
+    User replies and membership checks share the `interactive` pool and wait
+    for a free connection in priority order, so they queue here rather than
+    inside the HTTP client. Broadcasts and admin notifications use the `bulk`
+    pool, so they never hold a connection a reply needs. A 429 on any call
+    pauses bulk traffic for its retry_after, leaving the rate budget to users.
+    """
+
+    def __init__(self, interactive: BaseRequest, bulk: Optional[BaseRequest] = None,
+                 interactive_size: int = SEND_POOL_SIZE, bulk_size: int = BULK_POOL_SIZE):
+        self.interactive = interactive
+        self.bulk = bulk or interactive
+        self.slots = PrioritySlots(interactive_size)
+        self.bulk_slots = PrioritySlots(bulk_size)
+        self.bulk_paused_until = 0.0
+
+    @classmethod
+    def with_pools(cls) -> "PrioritySendRequest":
+        """The production client: one HTTPX pool per traffic class, sized from the config."""
+        return cls(
+            HTTPXRequest(connection_pool_size=SEND_POOL_SIZE),
+            HTTPXRequest(connection_pool_size=BULK_POOL_SIZE),
+        )
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.interactive.read_timeout
+
+    async def initialize(self) -> None:
+        await self.interactive.initialize()
+        if self.bulk is not self.interactive:
+            await self.bulk.initialize()
+
+    async def shutdown(self) -> None:
+        await self.interactive.shutdown()
+        if self.bulk is not self.interactive:
+            await self.bulk.shutdown()
+
+    def waiting(self) -> int:
+        return self.slots.waiting() + self.bulk_slots.waiting()
+
+    async def do_request(self, url: str, method: str, request_data=None, **timeouts) -> Tuple[int, bytes]:
+        priority = request_priority.get()
+        if priority is None:
+            priority = PRIORITY_MEMBERSHIP if url.endswith("/getChatMember") else PRIORITY_USER
+        if priority == PRIORITY_BULK:
+            inner, slots = self.bulk, self.bulk_slots
+            while (delay := self.bulk_paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+        else:
+            inner, slots = self.interactive, self.slots
+        start = time.perf_counter()
+        await slots.acquire(priority)
+        metrics.observe("giveaway_bot_api_wait_seconds", time.perf_counter() - start, priority=PRIORITY_NAMES[priority])
+        try:
+            code, payload = await inner.do_request(url, method, request_data, **timeouts)
+        finally:
+            slots.release()
+        if code == 429:
+            self._pause_bulk(payload)
+        return code, payload
+
+    def _pause_bulk(self, payload: bytes) -> None:
+        try:
+            retry_after = float(json.loads(payload)["parameters"]["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            retry_after = 1.0
+        self.bulk_paused_until = max(self.bulk_paused_until, time.monotonic() + retry_after)
+        logger.warning("Bot API rate limit hit, pausing bulk sends for %.0fs", retry_after)
+
+
+# ---------------------------
+# Monitoring
+# ---------------------------
+
+
+class InstrumentedRequest(BaseRequest):
+    """Wraps the bot's BaseRequest to record Bot API latency and errors by method."""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, **timeouts) -> Tuple[int, bytes]:
+        api_method = "file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data, **timeouts)
+        except Exception as e:
+            metrics.inc("giveaway_bot_api_errors_total", method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("giveaway_bot_api_seconds", elapsed, method=api_method)
+            timing = current_timing.get()
+            if timing is not None:
+                timing.api += elapsed
+                timing.api_calls += 1
+        if code >= 300:
+            metrics.inc("giveaway_bot_api_errors_total", method=api_method, error=str(code))
+        return code, payload
+
+
+class UpdateTiming:
+    """Time a handler call spent waiting on storage and on the Bot API."""
+
+    __slots__ = ("storage", "api", "storage_calls", "api_calls")
+
+    def __init__(self):
+        self.storage = 0.0
+        self.api = 0.0
+        self.storage_calls = 0
+        self.api_calls = 0
+
+
+# Set by instrumented() for the duration of a handler call; each update runs
+# in its own task, so concurrent updates never share one.
+current_timing: ContextVar[Optional[UpdateTiming]] = ContextVar("current_timing", default=None)
+
+
+class TimedStore:
+    """Forwards to a store, charging time spent in its methods to the current handler call."""
+
+    def __init__(self, store: "Store"):
+        self._store = store
+
+    def __getattr__(self, name: str):
+        value = getattr(self._store, name)
+        if name.startswith("_") or not callable(value):
+            return value
+        wrapped = self._timed_async(value) if asyncio.iscoroutinefunction(value) else self._timed(value)
+        # Cache the wrapper so later lookups skip __getattr__.
+        setattr(self, name, wrapped)
+        return wrapped
+
+    @staticmethod
+    def _timed(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            timing = current_timing.get()
+            if timing is None:
+                return method(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timing.storage += time.perf_counter() - start
+                timing.storage_calls += 1
+
+        return wrapper
+
+    @staticmethod
+    def _timed_async(method):
+        @wraps(method)
+        async def wrapper(*args, **kwargs):
+            timing = current_timing.get()
+            if timing is None:
+                return await method(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                timing.storage += time.perf_counter() - start
+                timing.storage_calls += 1
+
+        return wrapper
+
+
+class SlowUpdateProfiler:
+    """Runs a sample of handler calls under cProfile and keeps the slowest as .prof files.
+
+    Only one call is profiled at a time. Other updates interleaved with it
+    on the event loop show up in its profile too.
+    """
+
+    def __init__(self, rate: float = PROFILE_SAMPLE_RATE, keep: int = PROFILE_KEEP, directory: str = PROFILE_DIR):
+        self.rate = rate
+        self.keep = keep
+        self.directory = directory
+        self.active = False
+        self._kept: List[Tuple[float, str]] = []  # min-heap of (seconds, path)
+
+    def begin(self) -> Optional[cProfile.Profile]:
+        if self.rate <= 0 or self.active or random.random() >= self.rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (e.g. a debugger) is active.
+            return None
+        self.active = True
+        return profile
+
+    def end(self, profile: cProfile.Profile, seconds: float, label: str) -> Optional[str]:
+        """Stop profiling; returns the saved file if the call was slow enough to keep."""
+        profile.disable()
+        self.active = False
+        if seconds < SLOW_UPDATE_SECONDS or (len(self._kept) >= self.keep and seconds <= self._kept[0][0]):
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{label}-{int(seconds * 1000)}ms-{time.time_ns()}.prof")
+        profile.dump_stats(path)
+        heapq.heappush(self._kept, (seconds, path))
+        if len(self._kept) > self.keep:
+            _, dropped = heapq.heappop(self._kept)
+            try:
+                os.remove(dropped)
+            except OSError:
+                pass
+        return path
+
+
+profiler = SlowUpdateProfiler()
+
+
+def record_handler_call(name: str, update: object, wall: float, timing: UpdateTiming, outcome: str, profile_path: Optional[str]) -> None:
+    # "own" is everything but storage and the Bot API: the handler's CPU time,
+    # plus time other updates ran on the loop while this one was waiting.
+    own = max(0.0, wall - timing.storage - timing.api)
+    metrics.observe("giveaway_handler_seconds", wall, handler=name)
+    metrics.inc("giveaway_handler_calls_total", handler=name, outcome=outcome)
+    metrics.inc("giveaway_handler_time_seconds_total", timing.storage, handler=name, part="storage")
+    metrics.inc("giveaway_handler_time_seconds_total", timing.api, handler=name, part="api")
+    metrics.inc("giveaway_handler_time_seconds_total", own, handler=name, part="own")
+    if wall < SLOW_UPDATE_SECONDS:
+        return
+    user = getattr(update, "effective_user", None)
+    logger.warning("Slow update: %s", json.dumps({
+        "handler": name,
+        "update_id": getattr(update, "update_id", None),
+        "user_id": user.id if user else None,
+        "outcome": outcome,
+        "wall_s": round(wall, 4),
+        "storage_s": round(timing.storage, 4),
+        "api_s": round(timing.api, 4),
+        "own_s": round(own, 4),
+        "storage_calls": timing.storage_calls,
+        "api_calls": timing.api_calls,
+        "profile": profile_path,
+    }))
+
+
+async def run_instrumented(name: str, update: object, call: Callable[[], Awaitable]):
+    """Await `call()` as handler `name`, timed and split by storage, Bot API and the rest."""
+    timing = UpdateTiming()
+    token = current_timing.set(timing)
+    profile = profiler.begin()
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await call()
+        outcome = "ok"
+        return result
+    except ApplicationHandlerStop:
+        outcome = "stopped"
+        raise
+    finally:
+        wall = time.perf_counter() - start
+        profile_path = profiler.end(profile, wall, name) if profile is not None else None
+        current_timing.reset(token)
+        record_handler_call(name, update, wall, timing, outcome, profile_path)
+
+
+def instrumented(callback):
+    """Wrap a handler callback to time it, split by storage, Bot API and the rest."""
+    name = getattr(callback, "__name__", repr(callback))
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        return await run_instrumented(name, update, partial(callback, update, context))
+
+    return wrapper
+
+
+def instrument_handlers(app: Application) -> None:
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = instrumented(handler.callback)
+
+
+class LoopLagMonitor:
+    """Periodically measures how late the event loop runs a scheduled wakeup."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = 0.0
+        self.heartbeat = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = spawn_background(self._run(), "loop-lag-monitor")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            self.lag = max(0.0, self.heartbeat - before - self.interval)
+            metrics.observe("giveaway_event_loop_lag_seconds", self.lag)
+
+
+def register_gauges(app: Application) -> None:
+    monitor: LoopLagMonitor = app.bot_data["loop_monitor"]
+    cache: MembershipCache = app.bot_data["membership_cache"]
+    metrics.gauge("giveaway_update_queue_size", "Updates received but not yet picked up.", app.update_queue.qsize)
+    metrics.gauge(
+        "giveaway_updates_in_progress", "Updates being processed right now.",
+        lambda: app.update_processor.current_concurrent_updates,
+    )
+    metrics.gauge("giveaway_event_loop_lag_last_seconds", "Most recent event loop lag probe.", lambda: monitor.lag)
+    scheduler: PrioritySendRequest = app.bot.request.inner
+    metrics.gauge("giveaway_bot_api_waiting", "Bot API requests waiting for a connection.", scheduler.waiting)
+    metrics.gauge("giveaway_redemption_queue_size", "Redemptions waiting for a worker.", app.bot_data["redemption_queue"].queue.qsize)
+    metrics.gauge("giveaway_admin_notify_queue_size", "Admin notifications waiting to be sent.", lambda: app.bot_data["notifier"].queue.qsize())
+    metrics.gauge("giveaway_membership_cache_hits_total", "Membership checks answered from cache.", lambda: cache.hits, kind="counter")
+    metrics.gauge("giveaway_membership_cache_misses_total", "Membership checks that needed the API.", lambda: cache.misses, kind="counter")
+
+
+def health_status(app: Application) -> Tuple[bool, str]:
+    """Whether the bot is running and its event loop is responsive. Safe to call from any thread."""
+    if not app.running:
+        return False, "application not running"
+    monitor: Optional[LoopLagMonitor] = app.bot_data.get("loop_monitor")
+    if monitor is None:
+        return False, "starting"
+    stalled = time.monotonic() - monitor.heartbeat
+    if stalled > HEALTH_MAX_STALL:
+        return False, f"event loop stalled for {stalled:.1f}s"
+    return True, "ok"
+
+
+async def serve_monitoring(app: Application, host: str = METRICS_HOST, port: int = METRICS_PORT) -> asyncio.AbstractServer:
+    """Serve GET /metrics and /healthz over plain HTTP on the bot's own loop (polling mode)."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, content_type, body = "200 OK", METRICS_CONTENT_TYPE, metrics.render()
+            elif path == "/healthz":
+                ok, detail = health_status(app)
+                status, content_type, body = ("200 OK" if ok else "503 Service Unavailable"), "text/plain", detail + "\n"
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+            data = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Serving /metrics and /healthz on %s:%d", host, port)
+    return server
+
+
 # ---------------------------
 # Bot setup and main
 # ---------------------------
 
 
-def build_application() -> Application:
-    app = Application.builder().token(BOT_TOKEN).build()
+async def on_startup(app: Application) -> None:
+    store = get_store_from_app(app)
+    store.start()
+    app.bot_data["notifier"] = AdminNotifier(app.bot)
+    app.bot_data["notifier"].start()
+    app.bot_data["loop_monitor"] = LoopLagMonitor()
+    app.bot_data["loop_monitor"].start()
+    app.bot_data["scheduler"].start()
+    app.bot_data["redemption_queue"].start()
+    register_gauges(app)
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await serve_monitoring(app)
+    if store.broadcast_state():
+        logger.info("Resuming interrupted broadcast")
+        start_broadcast_task(app)
+
+
+async def on_shutdown(app: Application) -> None:
+    task = app.bot_data.get("broadcast_task")
+    if task is not None and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    server = app.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+    await app.bot_data["loop_monitor"].close()
+    await app.bot_data["scheduler"].close()
+    await app.bot_data["redemption_queue"].close()
+    await app.bot_data["notifier"].close()
+    await get_store_from_app(app).close()
+
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    """Build the bot. `request` replaces the HTTP client for Bot API calls (e.g. a stub in benchmarks)."""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(InstrumentedRequest(PrioritySendRequest(request) if request else PrioritySendRequest.with_pools()))
+        .get_updates_request(HTTPXRequest(connection_pool_size=GET_UPDATES_POOL_SIZE))
+        # Safe because store operations are atomic; see redeem_code().
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        # post_stop, not post_shutdown: the bot's HTTP client is already closed
+        # by then, and the notifier still needs it to drain its queue.
+        .post_stop(on_shutdown)
+    )
+    if BOT_API_URL:
+        builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    app = builder.build()
+
+    store = create_store()
+    store.load()
+    app.bot_data["store"] = TimedStore(store)
+    app.bot_data["membership_cache"] = MembershipCache()
+    app.bot_data["spam_guard"] = SpamGuard()
+    app.bot_data["scheduler"] = CodeScheduler(app)
+    app.bot_data["redemption_queue"] = RedemptionQueue()
+
+    # --- Gate: resolve ban / admin status once per update, before any handler ---
+    app.add_handler(TypeHandler(Update, resolve_user_context), group=-1)
+
+    # --- Channel membership tracking (bot must be a channel admin) ---
+    app.add_handler(ChatMemberHandler(track_channel_membership, ChatMemberHandler.CHAT_MEMBER, chat_id=REQUIRED_CHANNEL))
 
     # --- User commands ---
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("redeem", redeem))
+    app.add_handler(CommandHandler("claim", claim))
     app.add_handler(CommandHandler("leaderboard", leaderboard))
 
     # --- Admin commands ---
     app.add_handler(CommandHandler("stats", stats))
     app.add_handler(CommandHandler("listcodes", list_codes))
+    app.add_handler(CallbackQueryHandler(list_codes_callback, pattern=r"^lcx?\|"))
     app.add_handler(CommandHandler("addcode", add_code))
     app.add_handler(CommandHandler("addprize", add_prize))
     app.add_handler(CommandHandler("delcode", del_code))
     app.add_handler(CommandHandler("resetgiveaway", reset_giveaway))
+    app.add_handler(CommandHandler("archive", archive_campaign))
+    app.add_handler(CommandHandler("unarchive", unarchive_campaign))
+    app.add_handler(CommandHandler("drop", drop))
+    app.add_handler(CommandHandler("expire", expire))
+    app.add_handler(CommandHandler("schedules", list_schedules))
+    app.add_handler(CommandHandler("unschedule", unschedule))
     app.add_handler(CommandHandler("gencode", gencode))
     app.add_handler(CommandHandler("broadcast", broadcast))
     app.add_handler(CommandHandler("ban", ban_user))
@@ -807,12 +4612,98 @@ def build_application() -> Application:
         MessageHandler(filters.ALL & (~filters.COMMAND) & (~filters.User(user_id=ADMIN_IDS)), forward_to_owner)
     )
 
+    instrument_handlers(app)
     return app
  
 
-import asyncio
+# ---------------------------
+# Webhook mode
+# ---------------------------
+
+
+class WebhookRunner:
+    """Runs the bot on its own event loop thread and feeds it webhook updates.
+
+    A web app (see app.py) calls submit() from its request threads. The
+    update is decoded there and put on the Application's update_queue on
+    the bot's loop, the same way PTB's built-in webhook server does it.
+    """
+
+    def __init__(self, app: Optional[Application] = None):
+        self.app = app or build_application()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="giveaway-bot", daemon=True)
+
+    def check_secret(self, token: Optional[str]) -> bool:
+        return hmac.compare_digest((token or "").encode(), WEBHOOK_SECRET.encode())
+
+    def submit(self, payload: Dict) -> None:
+        """Queue one Update (as decoded JSON) for processing. Raises on malformed payloads."""
+        update = Update.de_json(payload, self.app.bot)
+        self.loop.call_soon_threadsafe(self.app.update_queue.put_nowait, update)
+
+    def start(self) -> None:
+        if not WEBHOOK_SECRET:
+            raise RuntimeError("Set GIVEAWAY_WEBHOOK_SECRET to run in webhook mode")
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self) -> None:
+        app = self.app
+        await app.initialize()
+        # post_init/post_stop are only run by run_polling/run_webhook.
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info("Webhook set to %s", WEBHOOK_URL)
+        else:
+            logger.info("Webhook mode without GIVEAWAY_WEBHOOK_URL: only local POSTs to %s", WEBHOOK_PATH)
+
+    def stop(self) -> None:
+        if not self._thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    async def _stop(self) -> None:
+        app = self.app
+        if app.running:
+            await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+
+
+def migrate_to_sqlite(target: str = SQLITE_FILE) -> None:
+    """Import DATA_FILE, its campaign files and its journal into a SQLite database."""
+    source = GiveawayStore()
+    source.load()
+    data = source.export_data()
+    store = SqliteStore(target)
+    store.load()
+    store.import_data(data)
+    store.conn.close()
+    logger.info("Imported %d codes and %d users into %s", len(data["codes"]), len(data["users"]), target)
+
 
 def main():
+    if sys.argv[1:2] == ["migrate"]:
+        # python new.py migrate [target.db]
+        migrate_to_sqlite(*sys.argv[2:3])
+        return
+
+    if RUN_MODE == "webhook":
+        raise SystemExit("GIVEAWAY_MODE=webhook: the bot runs inside app.py, not by polling")
+
     app = build_application()
     logger.info("Starting Giveaway Bot...")
 
@@ -821,7 +4712,8 @@ def main():
     loop.run_until_complete(app.bot.initialize())
 
     # Start polling
-    app.run_polling(drop_pending_updates=True)
+    # ALL_TYPES includes chat_member updates, which Telegram only sends on request.
+    app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
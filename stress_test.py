@@ -0,0 +1,283 @@
+"""Concurrency stress test: no code is ever awarded twice.
+
+Drives the handlers registered by new.build_application() with bursts of
+concurrent updates against a stubbed Bot API: many more users than codes,
+each sending several codes (as /redeem and as plain text) and /claim, so
+redemptions of the same code and by the same user interleave. Half of the
+redemptions skip the redemption queue (which holds one code per user) and
+call complete_redemption() / complete_claim() directly, so the store's own
+guarantees are exercised too. Afterwards, and again after reloading the
+store from disk, it checks that:
+
+- every code has at most one winner,
+- no user won more than once (all codes share one campaign),
+- every "Congratulations" reply matches the code's recorded winner,
+- every queued redemption was timed as a "redemption" handler call,
+  Bot API time included.
+
+For the json backend it also checks that a journal write failing part-way
+(injected) loses nothing when the journal is replayed after a crash.
+
+Exits non-zero if any check fails.
+
+    python stress_test.py                              # json and sqlite
+    python stress_test.py --backend sqlite --users 20000 --codes 2000
+"""
+
+import argparse
+import asyncio
+import errno
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from telegram.ext import CallbackContext
+
+import new
+from benchmark import USER_ID_BASE, StubRequest, bench_code, make_update, write_pool
+
+# ---------------------------
+# Stub Bot API
+# ---------------------------
+
+
+class RecordingRequest(StubRequest):
+    """StubRequest that keeps every (chat_id, text) the bot sends."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.sent: List[Tuple[int, str]] = []
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        if url.endswith("/sendMessage") and request_data is not None:
+            params = request_data.parameters
+            self.sent.append((int(params["chat_id"]), params.get("text", "")))
+        return await super().do_request(url, method, request_data, **timeouts)
+
+
+# ---------------------------
+# Scenario
+# ---------------------------
+
+WIN_RE = re.compile(r"You redeemed: `([A-Z0-9-]+)`")
+
+
+def winners_by_code(store, codes: int) -> Dict[str, int]:
+    result = {}
+    for i in range(codes):
+        details = store.get_code(bench_code(i))
+        if details and details.get("redeemed_by"):
+            result[bench_code(i)] = int(details["redeemed_by"])
+    return result
+
+
+def handler_totals(name: str) -> Dict[str, float]:
+    """Sum giveaway_handler_calls_total and the storage/api/own time series of handler `name`."""
+    totals: Dict[str, float] = Counter()
+    for line in new.metrics.render().splitlines():
+        if f'handler="{name}"' not in line:
+            continue
+        if line.startswith("giveaway_handler_calls_total"):
+            totals["calls"] += float(line.rsplit(" ", 1)[1])
+        elif line.startswith("giveaway_handler_time_seconds_total"):
+            totals[re.search(r'part="(\w+)"', line).group(1)] += float(line.rsplit(" ", 1)[1])
+    return totals
+
+
+def check_timing(before: Dict[str, float], after: Dict[str, float], queued: int) -> List[str]:
+    """Queued redemptions run outside their handler, so they must be timed on their own."""
+    problems = []
+    if after["calls"] - before["calls"] != queued:
+        problems.append(f"timing: {queued} redemptions queued but {after['calls'] - before['calls']:.0f} timed")
+    if queued and after["api"] <= before["api"]:
+        problems.append("timing: no Bot API time recorded for queued redemptions")
+    return problems
+
+
+def check(winners: Dict[str, int], replies: List[Tuple[int, str]], where: str) -> List[str]:
+    """Return the violated invariants (empty if all hold)."""
+    problems = []
+    repeat_winners = [uid for uid, n in Counter(winners.values()).items() if n > 1]
+    if repeat_winners:
+        problems.append(f"{where}: {len(repeat_winners)} users won more than once")
+    won = [(uid, m.group(1)) for uid, text in replies for m in [WIN_RE.search(text)] if m]
+    double_replies = [code for code, n in Counter(code for _, code in won).items() if n > 1]
+    if double_replies:
+        problems.append(f"{where}: {len(double_replies)} codes were confirmed to more than one user")
+    mismatched = [code for uid, code in won if winners.get(code) != uid]
+    if mismatched:
+        problems.append(f"{where}: {len(mismatched)} confirmed codes are not recorded for their winner")
+    return problems
+
+
+async def run_backend(args, backend: str) -> Dict:
+    new.STORAGE_BACKEND = backend
+    new.BOT_TOKEN = "1:stress"
+    request = RecordingRequest(args.api_latency)
+    app = new.build_application(request)
+    await app.initialize()
+    await app.start()
+    await new.on_startup(app)
+
+    rng = random.Random(args.seed)
+    jobs = []
+    for n in range(args.users):
+        user_id = USER_ID_BASE + n
+        for attempt in range(args.attempts):
+            code = bench_code(rng.randrange(args.codes))
+            text = ("/claim", f"/redeem {code}", code)[attempt % 3] if args.claims else (f"/redeem {code}", code)[attempt % 2]
+            jobs.append((make_update(app.bot, user_id, text), code if text != "/claim" else None, rng.random() < 0.5))
+    rng.shuffle(jobs)
+
+    async def one(update, code, direct: bool) -> None:
+        if not direct:
+            await app.process_update(update)
+            return
+        context = CallbackContext.from_update(update, app)
+        if code is None:
+            await new.complete_claim(update, context, None, None)
+        else:
+            await new.complete_redemption(update, context, code)
+
+    queue = app.bot_data["redemption_queue"]
+    submit, queued = queue.submit, 0
+
+    def counting_submit(user_id, job):
+        nonlocal queued
+        rejected = submit(user_id, job)
+        queued += rejected is None
+        return rejected
+
+    queue.submit = counting_submit
+    timed_before = handler_totals("redemption")
+    for i in range(0, len(jobs), args.burst):
+        await asyncio.gather(*(one(*job) for job in jobs[i:i + args.burst]))
+    await queue.queue.join()
+    timing = check_timing(timed_before, handler_totals("redemption"), queued)
+
+    store = new.get_store_from_app(app)
+    winners = winners_by_code(store, args.codes)
+    problems = timing + check(winners, request.sent, "live")
+    await app.stop()
+    await new.on_shutdown(app)
+    await app.shutdown()
+
+    # Everything acknowledged must have survived the shutdown.
+    reloaded = new.create_store()
+    reloaded.load()
+    persisted = winners_by_code(reloaded, args.codes)
+    if backend == "sqlite":
+        reloaded.conn.close()
+    problems += check(persisted, request.sent, "reloaded")
+    if persisted != winners:
+        problems.append(f"reloaded: {len(set(persisted.items()) ^ set(winners.items()))} winners differ from before shutdown")
+    return {
+        "backend": backend,
+        "updates": len(jobs),
+        "redeemed": len(winners),
+        "confirmed": sum(1 for _, text in request.sent if WIN_RE.search(text)),
+        "queued": queued,
+        "problems": problems,
+    }
+
+
+class TornWrite:
+    """Journal file stand-in: writes half of the first batch to disk, then fails."""
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.failed = False
+
+    def __getattr__(self, name):
+        return getattr(self.journal, name)
+
+    def write(self, payload: bytes) -> int:
+        if self.failed:
+            return self.journal.write(payload)
+        self.failed = True
+        self.journal.write(payload[:len(payload) // 2])
+        self.journal.flush()
+        raise OSError(errno.EIO, "injected journal write failure")
+
+
+async def check_torn_write(codes: int) -> List[str]:
+    """Fail a journal write part-way, keep going, then replay the journal as after a crash."""
+    store = new.GiveawayStore()
+    store.load()
+    store.start()
+    store.add_codes([bench_code(i) for i in range(codes)])
+    store._journal = TornWrite(store._journal)
+    await store.commit()  # the first attempt fails, the writer retries
+    for i in range(codes):
+        store.redeem_code(bench_code(i), USER_ID_BASE + i, f"user{i}")
+    await store.commit()
+    winners = winners_by_code(store, codes)
+    # Crash: no close(), so nothing is compacted and the reload replays the journal.
+    store._writer_task.cancel()
+    store._journal.close()
+
+    reloaded = new.GiveawayStore()
+    reloaded.load()
+    replayed = winners_by_code(reloaded, codes)
+    if len(winners) != codes or replayed != winners:
+        return [f"torn write: {len(replayed)} of {len(winners)} redemptions replayed after a failed journal write"]
+    return []
+
+
+# ---------------------------
+# Driver
+# ---------------------------
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", default="json,sqlite", help="comma-separated backends to test")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--codes", type=int, default=500, help="code pool size, all in one campaign")
+    parser.add_argument("--attempts", type=int, default=3, help="updates per user")
+    parser.add_argument("--burst", type=int, default=5000, help="updates processed concurrently")
+    parser.add_argument("--no-claims", dest="claims", action="store_false", help="only send codes, no /claim")
+    parser.add_argument("--api-latency", type=float, default=0.001, help="seconds added to every Bot API call")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    # Slow-update warnings are expected under these bursts.
+    for name in ("new", "apscheduler", "telegram"):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+    failed = False
+    cwd = os.getcwd()
+    for backend in args.backend.split(","):
+        workdir = tempfile.mkdtemp(prefix="giveaway-stress-")
+        try:
+            os.chdir(workdir)
+            write_pool(backend, args.codes, 0)
+            result = asyncio.run(run_backend(args, backend))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(json.dumps(result))
+        failed = failed or bool(result["problems"])
+    if "json" in args.backend.split(","):
+        workdir = tempfile.mkdtemp(prefix="giveaway-stress-")
+        # The injected failure is logged as an error by design.
+        logging.getLogger("new").setLevel(logging.CRITICAL)
+        try:
+            os.chdir(workdir)
+            problems = asyncio.run(check_torn_write(args.codes))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(json.dumps({"backend": "json", "check": "torn journal write", "problems": problems}))
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()